@@ -17,6 +17,10 @@ class TomEsoConfig(AppConfig):
         logger.debug(f'Initializing {app_name} AppConfig - module: {app_module}')
         super().__init__(app_name, app_module)
 
+    def ready(self):
+        # connect the ESOProfile signal receivers
+        import tom_eso.signals  # noqa: F401
+
     # TOMToolkit Integration Points
 
     def include_url_paths(self):
@@ -0,0 +1,55 @@
+"""
+Look up the data products of an observation block in the ESO Science Archive.
+
+The raw frames of an observation block are found with a query of the archive's TAP service
+(``dbo.raw``, by ``ob_id``), and downloaded from the archive's data portal. Only public data
+(whose proprietary period has ended) can be downloaded without ESO archive authentication.
+
+The archive URLs can be changed with the optional ``archive`` dictionary in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'archive': {
+            'tap_url': 'https://archive.eso.org/tap_obs/sync',
+            'download_url': 'https://dataportal.eso.org/dataportal_new/file/{dp_id}',
+        },
+    }
+"""
+import csv
+import io
+import logging
+
+import requests
+
+from tom_eso.conf import get_eso_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TAP_URL = 'https://archive.eso.org/tap_obs/sync'
+DEFAULT_DOWNLOAD_URL = 'https://dataportal.eso.org/dataportal_new/file/{dp_id}'
+TAP_TIMEOUT = 60  # seconds
+
+
+def observation_block_products(ob_id, session=None):
+    """Return the data products of the observation block as a list of dicts, in the form
+    expected from ``data_products()``: ``[{'id': dp_id, 'filename': ..., 'url': ...}, ...]``.
+    """
+    archive_settings = get_eso_setting('archive', {})
+    tap_url = archive_settings.get('tap_url', DEFAULT_TAP_URL)
+    download_url = archive_settings.get('download_url', DEFAULT_DOWNLOAD_URL)
+
+    query = f'SELECT dp_id FROM dbo.raw WHERE ob_id = {int(ob_id)} ORDER BY dp_id'
+    params = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'csv', 'QUERY': query}
+    response = (session or requests).get(tap_url, params=params, timeout=TAP_TIMEOUT)
+    response.raise_for_status()
+
+    products = []
+    for row in csv.DictReader(io.StringIO(response.text)):
+        dp_id = row['dp_id'].strip()
+        products.append({
+            'id': dp_id,
+            'filename': f'{dp_id}.fits',
+            'url': download_url.format(dp_id=dp_id),
+        })
+    logger.debug(f'observation_block_products: {len(products)} products for OB {ob_id}')
+    return products
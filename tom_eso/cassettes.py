@@ -0,0 +1,367 @@
+"""
+Recording, and replaying, of the traffic between tom_eso and the ESO APIs, to reproduce
+production slowdowns offline.
+
+In ``record`` mode, every call that ``ESOAPI`` makes to ESO (the logins, the p2api and p1api
+method calls, and the conditional requests that revalidate cached responses) is appended to a
+*cassette*, a JSON Lines file, with its arguments, its result (or error), when it started and how
+long it took. Credentials are never recorded: logins are recorded without their username and
+password (accounts are identified by a hash), and the values of keys such as ``password`` and
+``access_token`` are scrubbed from the recorded data.
+
+In ``replay`` mode, no connection is made to ESO: ``ESOAPI`` is served the recorded responses,
+each after its recorded duration multiplied by ``timing_scale`` (1 for the original timing, 0 for
+none). A call is served the first unused recording of the same call (same method and arguments,
+by the same account or else by any account). Failing that (e.g. because the new code saves a
+slightly different OB), it is served the first unused recording of the same method, and failing
+that, the last recording of the same call again. A call whose method was never recorded raises
+``CassetteMissError``. ``Cassette.report()`` compares the number and duration of the calls of the
+recording with those of the replay so far.
+
+A cassette is configured with the optional ``cassette`` dictionary in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'cassette': {
+            'mode': 'record',  # or 'replay'
+            'path': '/var/log/tom/p2-cassette.jsonl',
+            'timing_scale': 1.0,  # replay only
+        },
+    }
+
+or for a block of code (e.g. a benchmark) with ``use_cassette()``::
+
+    with use_cassette('p2-cassette.jsonl', mode='replay', timing_scale=0.5) as cassette:
+        ...
+    cassette.report()
+
+The mode only applies to the connections made while it is active: pooled connections made before
+are not recorded (``use_cassette()`` clears the connection pool on entry and exit).
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import p1api
+import p2api
+import requests
+
+from tom_eso.conf import get_eso_setting
+
+logger = logging.getLogger(__name__)
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+# the (case-insensitive) keys whose values are scrubbed from the recorded data
+SCRUBBED_KEYS = {'password', 'p2_password', 'access_token', 'authorization', 'token'}
+SCRUBBED = '<scrubbed>'
+
+# the exceptions that recorded errors are raised as again when replayed (see _deserialize_error)
+ERROR_CLASSES = {'P2Error': p2api.P2Error, 'P1Error': p1api.P1Error}
+
+
+class CassetteMissError(Exception):
+    """Raised when replaying a call that the cassette has no recording of."""
+
+
+class ReplayedError(Exception):
+    """Raised when replaying a recorded error of a type that cannot be re-created."""
+
+
+def scrub(value):
+    """Return a copy of ``value`` with the values of the ``SCRUBBED_KEYS`` of its dictionaries replaced."""
+    if isinstance(value, dict):
+        return {key: SCRUBBED if str(key).lower() in SCRUBBED_KEYS else scrub(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [scrub(item) for item in value]
+    return value
+
+
+def account_id(environment, username):
+    """Return an identifier of an ESO account that does not reveal its username."""
+    return hashlib.sha256(f'{environment}:{username}'.encode()).hexdigest()[:12]
+
+
+def _jsonable(value):
+    return json.loads(json.dumps(value, default=str))
+
+
+def _serialize_error(exception):
+    return {'type': type(exception).__name__, 'args': scrub(_jsonable(list(exception.args)))}
+
+
+def _deserialize_error(error):
+    error_class = ERROR_CLASSES.get(error['type']) or getattr(requests.exceptions, error['type'], None)
+    if isinstance(error_class, type) and issubclass(error_class, Exception):
+        return error_class(*error['args'])
+    return ReplayedError(f'{error["type"]}: {", ".join(str(arg) for arg in error["args"])}')
+
+
+def _call_keys(phase, account, method, args_key):
+    """The keys that a call is matched to recordings by, from the best match to the worst."""
+    return [('call', phase, account, method, args_key),
+            ('call', phase, None, method, args_key),
+            ('method', phase, account, method),
+            ('method', phase, None, method)]
+
+
+class Cassette:
+    """A recording of the calls made to the ESO APIs, in ``record`` or ``replay`` mode (see the module docstring)."""
+
+    def __init__(self, path, mode=REPLAY, timing_scale=1.0, clock=time.time, sleep=time.sleep):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f'Unknown cassette mode {mode!r}: use {RECORD!r} or {REPLAY!r}')
+        self.path = path
+        self.mode = mode
+        self.timing_scale = timing_scale
+        self.recorded = []  # the recorded interactions (dicts)
+        self.replayed = []  # the (phase, method, duration) of the replayed calls
+        self.misses = 0
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._index = {}  # call key -> deque of the indexes of the matching recordings
+        self._used = set()
+        self._last_used = {}  # call key -> index of the recording last served for it
+
+        if mode == REPLAY:
+            with open(path) as cassette_file:
+                self.recorded = [json.loads(line) for line in cassette_file if line.strip()]
+            for index, interaction in enumerate(self.recorded):
+                args_key = json.dumps(interaction['args'], sort_keys=True)
+                for key in _call_keys(interaction['phase'], interaction['account'], interaction['method'], args_key):
+                    self._index.setdefault(key, deque()).append(index)
+
+    def connect(self, api_connection_class, phase, environment, username, password):
+        """Return an ``api_connection_class`` connection that is recorded, or replayed, to this cassette."""
+        account = account_id(environment, username)
+        if self.mode == RECORD:
+            connection = self.record(phase, account, 'login', [],
+                                     lambda: api_connection_class(environment, username, password))
+            return RecordingConnection(self, connection, phase, account)
+        self.replay(phase, account, 'login', [])
+        return ReplayConnection(self, phase, account, environment)
+
+    def record(self, phase, account, method, args, call, serialize=None):
+        """Return ``call()``, recording it (and its result, serialized with ``serialize``, or error) as ``method``."""
+        interaction = {'phase': phase, 'account': account, 'method': method,
+                       'args': scrub(_jsonable(list(args))), 'start': self._clock()}
+        start = time.perf_counter()
+        try:
+            result = call()
+        except Exception as ex:
+            interaction['error'] = _serialize_error(ex)
+            raise
+        else:
+            if method != 'login':  # the result of a login is the connection itself
+                if serialize is not None:
+                    interaction['result'] = scrub(_jsonable(serialize(result)))
+                else:
+                    interaction['result'] = scrub(_jsonable(result))
+                    interaction['tuple'] = isinstance(result, tuple)
+            return result
+        finally:
+            interaction['duration'] = time.perf_counter() - start
+            self._write(interaction)
+
+    def _write(self, interaction):
+        line = json.dumps(interaction, default=str) + '\n'
+        with self._lock:
+            self.recorded.append(interaction)
+            try:
+                with open(self.path, 'a') as cassette_file:
+                    cassette_file.write(line)
+            except OSError as ex:
+                logger.warning(f'Cassette: cannot record to {self.path}: {ex}')
+
+    def replay(self, phase, account, method, args):
+        """Serve the recording of a call of ``method(*args)``: wait for its (scaled) duration, then
+        return its result or raise its error.
+        """
+        interaction = self._find(phase, account, method, scrub(_jsonable(list(args))))
+        duration = interaction['duration'] * self.timing_scale
+        if duration > 0:
+            self._sleep(duration)
+        with self._lock:
+            self.replayed.append((phase, method, duration))
+        if 'error' in interaction:
+            raise _deserialize_error(interaction['error'])
+        result = interaction.get('result')
+        return tuple(result) if interaction.get('tuple') else result
+
+    def _find(self, phase, account, method, args):
+        keys = _call_keys(phase, account, method, json.dumps(args, sort_keys=True))
+        with self._lock:
+            for key in keys:
+                candidates = self._index.get(key)
+                while candidates and candidates[0] in self._used:
+                    candidates.popleft()
+                if candidates:
+                    index = candidates.popleft()
+                    self._used.add(index)
+                    interaction = self.recorded[index]
+                    interaction_args_key = json.dumps(interaction['args'], sort_keys=True)
+                    for interaction_key in _call_keys(phase, interaction['account'], method, interaction_args_key):
+                        self._last_used[interaction_key] = index
+                    return interaction
+            for key in keys[:2]:  # all used: serve the same call again
+                if key in self._last_used:
+                    return self.recorded[self._last_used[key]]
+            self.misses += 1
+        raise CassetteMissError(f'{self.path} has no recording of {phase} {method}{tuple(args)}')
+
+    def report(self):
+        """Return, for each method (prefixed with its phase), the number and total duration (in seconds)
+        of the recorded calls and of the replayed calls, and the number of calls that missed.
+        """
+        methods = {}
+        for interaction in self.recorded:
+            totals = methods.setdefault(f'{interaction["phase"]} {interaction["method"]}', _empty_totals())
+            totals['recorded_calls'] += 1
+            totals['recorded_seconds'] += interaction['duration']
+        for phase, method, duration in self.replayed:
+            totals = methods.setdefault(f'{phase} {method}', _empty_totals())
+            totals['replayed_calls'] += 1
+            totals['replayed_seconds'] += duration
+        return {'methods': methods, 'misses': self.misses}
+
+
+def _empty_totals():
+    return {'recorded_calls': 0, 'recorded_seconds': 0.0, 'replayed_calls': 0, 'replayed_seconds': 0.0}
+
+
+def _serialize_response(response):
+    content_type = response.headers.get('Content-Type', '')
+    return {
+        'status_code': response.status_code,
+        'headers': {name: response.headers[name] for name in ('Content-Type', 'ETag') if name in response.headers},
+        'json': response.json() if response.status_code == 200 and content_type.startswith('application/json')
+        else None,
+    }
+
+
+class RecordingConnection:
+    """An ESO ``ApiConnection`` whose method calls (and session requests) are recorded to a cassette."""
+
+    def __init__(self, cassette, connection, phase, account):
+        self._cassette = cassette
+        self._connection = connection
+        self._phase = phase
+        self._account = account
+
+    def __getattr__(self, name):
+        attribute = getattr(self._connection, name)
+        if name == 'session':
+            return RecordingSession(self._cassette, attribute, self._connection.apiUrl, self._phase, self._account)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def recorded_call(*args):
+            return self._cassette.record(self._phase, self._account, name, args, lambda: attribute(*args))
+        return recorded_call
+
+
+class RecordingSession:
+    """The ``requests`` session of a ``RecordingConnection``, whose requests (under the API URL) are recorded."""
+
+    def __init__(self, cassette, session, api_url, phase, account):
+        self._cassette = cassette
+        self._session = session
+        self._api_url = api_url
+        self._phase = phase
+        self._account = account
+
+    def request(self, method, url, headers=None, **kwargs):
+        headers = headers or {}
+        args = [url[len(self._api_url):] if url.startswith(self._api_url) else url, headers.get('If-None-Match')]
+        return self._cassette.record(self._phase, self._account, f'session.{method}', args,
+                                     lambda: self._session.request(method, url, headers=headers, **kwargs),
+                                     serialize=_serialize_response)
+
+
+class ReplayConnection:
+    """A stand-in for an ESO ``ApiConnection`` that serves the recordings of a cassette."""
+
+    def __init__(self, cassette, phase, account, environment):
+        self.apiUrl = f'replay://{environment}'
+        self.access_token = SCRUBBED
+        self.session = ReplaySession(cassette, self.apiUrl, phase, account)
+        self._cassette = cassette
+        self._phase = phase
+        self._account = account
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def replayed_call(*args):
+            return self._cassette.replay(self._phase, self._account, name, args)
+        return replayed_call
+
+
+class ReplayedResponse:
+    """The recorded ``requests.Response`` of a ``ReplaySession`` request."""
+
+    def __init__(self, status_code, headers, json_data):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self._json = json_data
+
+    def json(self):
+        return self._json
+
+
+class ReplaySession:
+    """The ``requests`` session of a ``ReplayConnection``, which serves the recorded session requests."""
+
+    def __init__(self, cassette, api_url, phase, account):
+        self._cassette = cassette
+        self._api_url = api_url
+        self._phase = phase
+        self._account = account
+
+    def request(self, method, url, headers=None, **kwargs):
+        headers = headers or {}
+        args = [url[len(self._api_url):] if url.startswith(self._api_url) else url, headers.get('If-None-Match')]
+        response = self._cassette.replay(self._phase, self._account, f'session.{method}', args)
+        return ReplayedResponse(response['status_code'], response['headers'], response['json'])
+
+
+_cassettes = {}  # (path, mode, timing_scale) -> Cassette, for the cassettes configured in the settings
+_cassettes_lock = threading.Lock()
+_active_cassette = None  # set by use_cassette()
+
+
+def get_cassette():
+    """Return the cassette that ESO API connections should be recorded to, or replayed from, or None."""
+    if _active_cassette is not None:
+        return _active_cassette
+    cassette_settings = get_eso_setting('cassette')
+    if not cassette_settings:
+        return None
+    key = (cassette_settings['path'], cassette_settings.get('mode', RECORD), cassette_settings.get('timing_scale', 1.0))
+    with _cassettes_lock:
+        if key not in _cassettes:
+            _cassettes[key] = Cassette(*key)
+        return _cassettes[key]
+
+
+@contextmanager
+def use_cassette(path, mode=REPLAY, timing_scale=1.0):
+    """Record the ESO API connections made in the ``with`` block to the cassette at ``path``, or replay them from it."""
+    global _active_cassette
+    from tom_eso.connections import get_connection_pool  # tom_eso.connections imports ESOAPI, which imports this
+
+    cassette = Cassette(path, mode=mode, timing_scale=timing_scale)
+    get_connection_pool().clear()
+    _active_cassette = cassette
+    try:
+        yield cassette
+    finally:
+        _active_cassette = None
+        get_connection_pool().clear()
@@ -0,0 +1,122 @@
+"""
+Observation form choice lists, shared by all workers through Django's cache framework.
+
+``ESOFacility.get_observing_run_choices``, ``get_folder_name_choices`` and
+``get_observation_block_choices`` store the choice lists they build in a Django
+cache backend, so that one worker's fetch from ESO serves every worker using the
+same backend (use a shared backend such as Redis, Memcached, the file-based cache or the
+database cache for this; the default local-memory backend is per-process).
+
+Each choice list is also kept, for ``stale_timeout``, as the last known choices, which are served
+(marked as stale) while ESO is unavailable (see ``tom_eso/circuit_breaker.py``).
+
+Entries are keyed per credential set by a hash of the ESO environment, the username and an HMAC
+of the password (keyed with ``settings.SECRET_KEY``, so that it's the same in every worker), so
+that only the credentials that fetched a choice list are served it. They are stored as
+zlib-compressed compact JSON.
+
+The cache is configured with the optional ``choice_cache`` dictionary in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'choice_cache': {
+            'alias': 'default',  # the settings.CACHES entry to use
+            'timeout': 300,  # seconds
+            'stale_timeout': 604800,  # seconds
+        },
+    }
+"""
+import hashlib
+import json
+import logging
+import time
+import zlib
+
+from django.core.cache import caches
+from django.utils.crypto import salted_hmac
+
+from tom_eso.conf import get_eso_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_ALIAS = 'default'
+DEFAULT_TIMEOUT = 5 * 60  # seconds
+DEFAULT_STALE_TIMEOUT = 7 * 24 * 60 * 60  # seconds
+KEY_PREFIX = 'tom_eso:choices'
+
+
+def credential_key(environment, username, password=None):
+    """Return an opaque key identifying an ESO account (without exposing the username in cache keys).
+
+    With a password, the key identifies the credential set rather than the account.
+    """
+    credentials = f'{environment}:{username}'
+    if password is not None:
+        credentials += ':' + salted_hmac(KEY_PREFIX, password, algorithm='sha256').hexdigest()
+    return hashlib.sha256(credentials.encode('utf-8')).hexdigest()[:32]
+
+
+def serialize_choices(choices):
+    return zlib.compress(json.dumps(choices, separators=(',', ':')).encode('utf-8'))
+
+
+def deserialize_choices(data):
+    return [tuple(choice) for choice in json.loads(zlib.decompress(data).decode('utf-8'))]
+
+
+class ChoiceCache:
+    """Store and fetch choice lists in a Django cache backend, keyed per ESO credential set."""
+
+    def __init__(self, alias=DEFAULT_CACHE_ALIAS, timeout=DEFAULT_TIMEOUT, stale_timeout=DEFAULT_STALE_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def make_key(self, cred_key, kind, *args):
+        return ':'.join([KEY_PREFIX, cred_key, kind, *(str(arg) for arg in args)])
+
+    def get(self, cred_key, kind, *args):
+        """Return the cached choice list, or None if there isn't one (or the cache is unavailable)."""
+        try:
+            data = self.cache.get(self.make_key(cred_key, kind, *args))
+            return None if data is None else deserialize_choices(data)
+        except Exception as ex:
+            logger.warning(f'ChoiceCache.get: cache unavailable: {ex}')
+            return None
+
+    def get_stale(self, cred_key, kind, *args):
+        """Return the last known choice list and the time (a Unix timestamp) it was cached,
+        or None if there isn't one (or the cache is unavailable).
+        """
+        try:
+            stale = self.cache.get(self.make_key(cred_key, kind, *args, 'stale'))
+            if stale is None:
+                return None
+            cached_at, data = stale
+            return deserialize_choices(data), cached_at
+        except Exception as ex:
+            logger.warning(f'ChoiceCache.get_stale: cache unavailable: {ex}')
+            return None
+
+    def set(self, cred_key, kind, args, choices):
+        data = serialize_choices(choices)
+        try:
+            self.cache.set(self.make_key(cred_key, kind, *args), data, self.timeout)
+            self.cache.set(self.make_key(cred_key, kind, *args, 'stale'), (time.time(), data), self.stale_timeout)
+        except Exception as ex:
+            logger.warning(f'ChoiceCache.set: cache unavailable: {ex}')
+
+    def delete(self, cred_key, kind, *args):
+        try:
+            self.cache.delete(self.make_key(cred_key, kind, *args))
+        except Exception as ex:
+            logger.warning(f'ChoiceCache.delete: cache unavailable: {ex}')
+
+
+def get_choice_cache():
+    """Return a ``ChoiceCache`` configured from the settings."""
+    return ChoiceCache(**get_eso_setting('choice_cache', {}))
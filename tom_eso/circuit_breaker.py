@@ -0,0 +1,137 @@
+"""
+A circuit breaker for the ESO P2 API, so that an ESO outage doesn't block every page that uses it.
+
+Each ESO environment has a ``CircuitBreaker`` (per process) that every upstream P2 call, Phase 2
+login (``ESOAPI.connect()`` and the login a call may need) and connection pool health check goes
+through. After ``failure_threshold`` consecutive calls have failed with a transient error
+(a connection error or timeout, or an HTTP 408, 429 or 5xx response, after their retries), the
+circuit opens: for the next ``reset_timeout`` seconds calls fail immediately with
+``CircuitOpenError`` instead of waiting on ESO. After that the circuit is half-open: a single call
+is let through as a probe, and closes the circuit if it succeeds (or reopens it if it fails).
+
+While the circuit is open, ``ESOFacility`` serves the last known choice lists (see
+``ChoiceCache.get_stale()``), marked as stale, instead of an error. That includes facilities that
+couldn't log in because ESO is unavailable: they keep their credential status, with a connection
+that isn't logged in (yet).
+
+The circuit breaker is configured in ``settings.FACILITIES['ESO']`` (the defaults are shown):
+
+    'ESO': {
+        ...
+        'circuit_breaker': {
+            'failure_threshold': 5,  # consecutive failures
+            'reset_timeout': 30,  # seconds
+        },
+    }
+"""
+import logging
+import threading
+import time
+
+from tom_eso.conf import get_eso_setting
+from tom_eso.throttling import is_transient_error
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30  # seconds
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """ESO is unavailable: the circuit breaker is open, so the call was not made."""
+
+
+def is_outage(exception):
+    """Return True if ``exception`` means that ESO is (or was recently) unavailable."""
+    return isinstance(exception, CircuitOpenError) or is_transient_error(exception)
+
+
+class CircuitBreaker:
+    """A thread-safe circuit breaker (see the module docstring)."""
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def call(self, func, *args):
+        """Return ``func(*args)``, or raise ``CircuitOpenError`` without calling it if the circuit is open."""
+        self._before_call()
+        try:
+            result = func(*args)
+        except Exception as ex:
+            if is_outage(ex):
+                self._record_failure(ex)
+            else:
+                self._record_success()  # ESO answered, so it's up
+            raise
+        self._record_success()
+        return result
+
+    def _before_call(self):
+        with self._lock:
+            state = self._state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                logger.info(f'Circuit breaker {self.name}: probing ESO')
+                return
+        raise CircuitOpenError(f'ESO P2 ({self.name}) is unavailable; not retrying for up to '
+                               f'{self.reset_timeout} seconds')
+
+    def _record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f'Circuit breaker {self.name}: closed, ESO is available again')
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def _record_failure(self, exception):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warning(f'Circuit breaker {self.name}: opened after {self._failures} '
+                                   f'consecutive failures ({exception})')
+                self._opened_at = self._clock()
+                self._probing = False
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(environment):
+    """Return the circuit breaker of the ESO ``environment``, configured from the settings."""
+    breaker_settings = get_eso_setting('circuit_breaker', {})
+    failure_threshold = breaker_settings.get('failure_threshold', DEFAULT_FAILURE_THRESHOLD)
+    reset_timeout = breaker_settings.get('reset_timeout', DEFAULT_RESET_TIMEOUT)
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(environment)
+        if breaker is None or (breaker.failure_threshold, breaker.reset_timeout) != (failure_threshold, reset_timeout):
+            breaker = _circuit_breakers[environment] = CircuitBreaker(environment, failure_threshold, reset_timeout)
+        return breaker
@@ -0,0 +1,124 @@
+"""
+Helpers for making several ESO API calls at the same time.
+
+The p2api calls are blocking HTTP requests, so independent calls (e.g. the contents
+of every folder in an observing run) are made from a bounded pool of threads.
+The default number of threads is set with the optional ``max_workers`` value in
+``settings.FACILITIES['ESO']``.
+
+Async code (the async views) runs blocking ESO API calls with ``run_blocking()``, in a
+process-wide executor bounded by the optional ``async_max_workers`` value (which defaults
+to ``max_workers``), so that slow ESO responses never block the event loop. The executor's
+threads are not managed by Django, so what runs there must not use the ORM (their database
+connections would never be closed): database work goes through ``sync_to_async()`` instead.
+
+``SingleFlight`` coalesces identical concurrent calls, so that threads asking for the same
+thing at the same moment share one call instead of each making their own.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from tom_eso.conf import get_eso_setting
+
+DEFAULT_MAX_WORKERS = 8
+
+
+def get_max_workers(max_workers=None):
+    """Return ``max_workers`` if given, else the configured (or default) number of worker threads."""
+    if max_workers is None:
+        max_workers = get_eso_setting('max_workers', DEFAULT_MAX_WORKERS)
+    return max(1, int(max_workers))
+
+
+def map_concurrently(func, items, max_workers=None, return_exceptions=False):
+    """Return ``[func(item) for item in items]``, calling ``func`` from at most ``max_workers`` threads.
+
+    The results are in the order of ``items``. If ``return_exceptions`` is True, an exception
+    raised by ``func`` is returned in place of its result instead of being raised.
+    Each call runs in a copy of the caller's context (so it sees the caller's context variables).
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    def call(item):
+        try:
+            return func(item)
+        except Exception as ex:
+            if return_exceptions:
+                return ex
+            raise
+
+    max_workers = min(get_max_workers(max_workers), len(items))
+    if max_workers == 1:
+        return [call(item) for item in items]
+    # a context can only be entered by one thread at a time, hence a copy for each call
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tom_eso') as executor:
+        return list(executor.map(lambda context, item: context.run(call, item), contexts, items))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the process-wide, bounded executor for blocking ESO API calls made from async code."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=get_max_workers(get_eso_setting('async_max_workers')),
+                                               thread_name_prefix='tom_eso_async')
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Await ``func(*args, **kwargs)``, run in the bounded executor for blocking ESO API calls
+    (in a copy of the caller's context, like ``asyncio.to_thread()``).
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), functools.partial(context.run, func, *args, **kwargs))
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one.
+
+    The first thread to call ``do(key, ...)`` makes the call; threads calling ``do()`` with the
+    same key while it is in flight wait for it and receive its result (or its exception).
+    Once the call has returned, the next ``do(key, ...)`` makes a new call.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> Future of the call in flight
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """Return a (result, shared) tuple: the result of ``func(*args)``, or of the identical call
+        already in flight, and whether it was shared (i.e. came from another thread's call).
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                shared = True
+            else:
+                shared = False
+                future = self._calls[key] = Future()
+        if shared:
+            return future.result(), True
+
+        try:
+            result = func(*args)
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,13 @@
+"""Access to the optional tom_eso tuning settings.
+
+All tom_eso settings live in the ``ESO`` entry of ``settings.FACILITIES`` (next to the
+default ``environment``, ``username`` and ``password`` credentials described in the README).
+Every tuning setting is optional and has a sensible default.
+"""
+from django.conf import settings
+
+
+def get_eso_setting(name, default=None):
+    """Return the value of ``settings.FACILITIES['ESO'][name]``, or ``default`` if it is not set."""
+    facilities = getattr(settings, 'FACILITIES', {}) or {}
+    return facilities.get('ESO', {}).get(name, default)
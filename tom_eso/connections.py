@@ -0,0 +1,261 @@
+"""
+A process-level pool of authenticated ESO API connections.
+
+Creating an ``ESOAPI`` logs in to ESO, which is by far the slowest part of an HTMX
+dropdown request. The pool keeps one authenticated ``ESOAPI`` per (environment, username)
+and hands it out to every ``ESOFacility`` that needs it, so that a user pays for the
+login once rather than on every request.
+
+Pooled connections are:
+- evicted after being idle for ``idle_ttl`` seconds,
+- re-authenticated proactively before their access token expires
+  (``token_lifetime`` minus ``refresh_margin`` seconds after login),
+- health-checked (with a cheap ``getUser()`` call) before being handed out
+  if they have not been used for ``health_check_interval`` seconds,
+- invalidated when the owning ``ESOProfile`` is saved or deleted (see ``tom_eso/signals.py``).
+
+Logins and health checks go through the environment's circuit breaker (see
+tom_eso/circuit_breaker.py). A health check that fails because ESO is unavailable keeps the
+connection, whose calls then fail fast while the circuit is open. A pooled connection is only
+replaced once the login replacing it has succeeded, so a login with a wrong password for the
+same P2 username doesn't evict the valid connection.
+
+The pool also remembers (by a digest of the password) the credentials of the last successful
+login of each P2 account, even after its connection is dropped, so that ``is_verified()`` can
+tell whether credentials that can't be checked during an ESO outage have been authenticated
+before (see ``ESOFacility._connect()``).
+
+The pool is configured with the optional ``connection_pool`` dictionary in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'connection_pool': {
+            'idle_ttl': 900,
+            'token_lifetime': 3600,
+            'refresh_margin': 300,
+            'health_check_interval': 300,
+            'max_size': 100,
+        },
+    }
+"""
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from tom_eso.circuit_breaker import get_circuit_breaker, is_outage
+from tom_eso.conf import get_eso_setting
+from tom_eso.eso_api import ESOAPI
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SETTINGS = {
+    'idle_ttl': 15 * 60,  # seconds
+    'token_lifetime': 60 * 60,  # seconds
+    'refresh_margin': 5 * 60,  # seconds
+    'health_check_interval': 5 * 60,  # seconds
+    'max_size': 100,  # connections
+}
+
+# the number of P2 accounts whose last verified password digest is remembered
+MAX_VERIFIED_ACCOUNTS = 10000
+
+# The password digests are keyed with a per-process secret so that they are
+# useless outside of this process (and they are never written anywhere).
+_DIGEST_KEY = os.urandom(32)
+
+
+def _password_digest(password):
+    return hmac.new(_DIGEST_KEY, (password or '').encode('utf-8'), hashlib.sha256).digest()
+
+
+class PooledConnection:
+    """An ``ESOAPI`` in the pool, with the bookkeeping needed to expire and refresh it."""
+
+    def __init__(self, eso_api, password_digest):
+        self.eso_api = eso_api
+        self.password_digest = password_digest
+        self.logged_in_at = time.monotonic()
+        self.last_used_at = self.logged_in_at
+        self.last_checked_at = self.logged_in_at
+
+
+class KeyLock:
+    """The lock serializing the logins of a credential set, with the number of threads holding or waiting for it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class ESOConnectionPool:
+    """Thread-safe pool of authenticated ``ESOAPI`` instances keyed by (environment, username)."""
+
+    def __init__(self, idle_ttl=None, token_lifetime=None, refresh_margin=None,
+                 health_check_interval=None, max_size=None):
+        self.idle_ttl = DEFAULT_POOL_SETTINGS['idle_ttl'] if idle_ttl is None else idle_ttl
+        self.token_lifetime = DEFAULT_POOL_SETTINGS['token_lifetime'] if token_lifetime is None else token_lifetime
+        self.refresh_margin = DEFAULT_POOL_SETTINGS['refresh_margin'] if refresh_margin is None else refresh_margin
+        self.health_check_interval = (DEFAULT_POOL_SETTINGS['health_check_interval']
+                                      if health_check_interval is None else health_check_interval)
+        self.max_size = DEFAULT_POOL_SETTINGS['max_size'] if max_size is None else max_size
+
+        self._connections = {}  # (environment, username) -> PooledConnection
+        self._key_locks = {}  # (environment, username) -> KeyLock (dropped once no thread uses it)
+        self._verified = OrderedDict()  # (environment, username) -> digest of the last password that logged in
+        self._lock = threading.Lock()  # guards the three dicts above
+
+    def __len__(self):
+        return len(self._connections)
+
+    @contextmanager
+    def _key_lock(self, key):
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, KeyLock())
+            key_lock.users += 1
+        try:
+            with key_lock.lock:
+                yield
+        finally:
+            # only a lock that no thread holds or waits for can go: another thread
+            # would otherwise create a second lock for the key, and log in concurrently
+            with self._lock:
+                key_lock.users -= 1
+                if key_lock.users == 0:
+                    del self._key_locks[key]
+
+    def acquire(self, environment, username, password):
+        """Return an authenticated ``ESOAPI`` for these credentials, logging in only if necessary.
+
+        Raises whatever ``ESOAPI`` raises if a (re-)login is needed and fails.
+        """
+        key = (environment, username)
+        digest = _password_digest(password)
+
+        # one lock per credential set so that concurrent requests for the same
+        # user share a single login, while other users are not held up
+        with self._key_lock(key):
+            now = time.monotonic()
+            pooled = self._connections.get(key)
+            previous = None
+            if pooled is not None and not self._is_usable(environment, pooled, digest, now):
+                previous, pooled = pooled, None
+
+            if pooled is None:
+                same_credentials = previous is not None and hmac.compare_digest(previous.password_digest, digest)
+                logger.debug(f'ESOConnectionPool: logging in to {environment} as {username}')
+                try:
+                    eso_api = ESOAPI(environment, username, password)
+                    eso_api.connect()  # validate the credentials (only Phase 2; Phase 1 logs in when first used)
+                except Exception as ex:
+                    # the connection of other credentials (e.g. the right password) stays pooled
+                    if previous is None or same_credentials:
+                        self._discard(key)
+                    if not is_outage(ex):
+                        # e.g. the password was changed at ESO: it isn't verified anymore
+                        self._unverify(key, digest)
+                    raise
+                if same_credentials:
+                    # just a new login: keep the cached P2 responses
+                    eso_api.p2_cache = previous.eso_api.p2_cache
+                pooled = PooledConnection(eso_api, digest)
+                self._store(key, pooled)
+                self._verify(key, digest)
+
+            pooled.last_used_at = now
+            return pooled.eso_api
+
+    def _is_usable(self, environment, pooled, digest, now):
+        """Return True if the pooled connection can be handed out as it is."""
+        # a different password must never be given someone else's authenticated connection
+        if not hmac.compare_digest(pooled.password_digest, digest):
+            return False
+        if now - pooled.last_used_at > self.idle_ttl:
+            return False
+        # refresh proactively, before the access token expires mid-request
+        if now - pooled.logged_in_at > self.token_lifetime - self.refresh_margin:
+            return False
+        if now - pooled.last_checked_at > self.health_check_interval:
+            try:
+                get_circuit_breaker(environment).call(pooled.eso_api.api2.getUser)
+            except Exception as ex:
+                if is_outage(ex):
+                    # logging in again wouldn't help: keep the connection (checking it again next time)
+                    logger.info(f'ESOConnectionPool: health check failed, ESO is unavailable: {ex}')
+                    return True
+                logger.info(f'ESOConnectionPool: health check failed, logging in again: {ex}')
+                return False
+            pooled.last_checked_at = now
+        return True
+
+    def _store(self, key, pooled):
+        with self._lock:
+            self._connections[key] = pooled
+            if len(self._connections) > self.max_size:
+                # evict the least recently used connection
+                lru_key = min(self._connections, key=lambda k: self._connections[k].last_used_at)
+                del self._connections[lru_key]
+
+    def is_verified(self, environment, username, password):
+        """Return True if these credentials are those of the last successful login of this P2 account."""
+        with self._lock:
+            verified_digest = self._verified.get((environment, username))
+        return verified_digest is not None and hmac.compare_digest(verified_digest, _password_digest(password))
+
+    def _verify(self, key, digest):
+        with self._lock:
+            self._verified[key] = digest
+            self._verified.move_to_end(key)
+            while len(self._verified) > MAX_VERIFIED_ACCOUNTS:
+                self._verified.popitem(last=False)
+
+    def _unverify(self, key, digest):
+        with self._lock:
+            verified_digest = self._verified.get(key)
+            if verified_digest is not None and hmac.compare_digest(verified_digest, digest):
+                del self._verified[key]
+
+    def _discard(self, key):
+        with self._lock:
+            self._connections.pop(key, None)
+
+    def invalidate(self, environment=None, username=None):
+        """Drop the pooled connections (and verified credentials) matching the given environment and/or username.
+
+        With no arguments, every connection in the pool is dropped.
+        """
+        with self._lock:
+            for key in list(self._verified):
+                if environment is not None and key[0] != environment:
+                    continue
+                if username is not None and key[1] != username:
+                    continue
+                del self._verified[key]
+            for key in list(self._connections):
+                if environment is not None and key[0] != environment:
+                    continue
+                if username is not None and key[1] != username:
+                    continue
+                del self._connections[key]
+
+    def clear(self):
+        """Drop every connection in the pool."""
+        self.invalidate()
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """Return the process-wide ``ESOConnectionPool``, creating it from the settings on first use."""
+    global _connection_pool
+    if _connection_pool is None:
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                _connection_pool = ESOConnectionPool(**get_eso_setting('connection_pool', {}))
+    return _connection_pool
@@ -0,0 +1,99 @@
+"""
+Vectorized formatting of RA/Dec for ESO Phase 2 observation block target blocks.
+
+The ESO P2 API expects the target coordinates as sexagesimal strings::
+
+    RA:  HH:MM:SS.sss   (e.g. '0:42:44.330')
+    Dec: [+|-]DD:MM:SS.sss   (e.g. '+41:16:07.500')
+
+``ra_to_sexagesimal()`` and ``dec_to_sexagesimal()`` produce exactly the strings that
+``Angle(ra, unit=u.deg).to_string(unit=u.hourangle, sep=':', precision=3)`` and
+``Angle(dec, unit=u.deg).to_string(unit=u.deg, sep=':', precision=3, alwayssign=True)``
+produce, but for a whole array of coordinates at once with NumPy, instead of building and
+formatting two ``Angle`` objects per target.
+
+To guarantee identical output, the (rare) values whose rounding to milliseconds can not be
+decided reliably in floating point (those within a hair of a half-millisecond), and values that
+are not finite, are formatted by astropy itself.
+"""
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import Angle
+
+PRECISION = 3  # decimal places of the seconds field
+
+# the carry threshold that astropy uses: seconds this close to 60 are shown as 00 (of the next minute)
+_ROUNDING_THRESHOLD = 60.0 - 10.0 ** -PRECISION
+_SCALE = 10 ** PRECISION
+# how close (in units of the last decimal place) to a rounding tie a value must be to be handed to astropy
+_TIE_TOLERANCE = 1e-6
+
+
+def ra_to_sexagesimal(ra):
+    """Format RA(s) in degrees as ``H:MM:SS.sss`` hour-angle strings (as expected by ESO P2).
+
+    ``ra`` may be a scalar or array-like; return a str for a scalar, or else an array of str.
+    """
+    hours = u.Quantity(ra, u.deg).to_value(u.hourangle)
+    return _to_sexagesimal(hours, u.hourangle, alwayssign=False)
+
+
+def dec_to_sexagesimal(dec):
+    """Format Dec(s) in degrees as signed ``[+|-]D:MM:SS.sss`` strings (as expected by ESO P2).
+
+    ``dec`` may be a scalar or array-like; return a str for a scalar, or else an array of str.
+    """
+    degrees = u.Quantity(dec, u.deg).to_value(u.deg)
+    return _to_sexagesimal(degrees, u.deg, alwayssign=True)
+
+
+def _to_sexagesimal(values, unit, alwayssign):
+    """Format ``values`` (in ``unit``) like ``Angle.to_string(sep=':', precision=3)`` does, but vectorized."""
+    values = np.asarray(values, dtype=float)
+    flat = values.ravel()
+    if not flat.size:
+        return values.astype(str)
+
+    # split into (whole, minutes, seconds) exactly as astropy does, so the floating point errors match
+    negative = np.signbit(flat)
+    whole_fraction, whole = np.modf(np.fabs(flat))
+    minute_fraction, minutes = np.modf(whole_fraction * 60.0)
+    seconds = minute_fraction * 60.0
+
+    # carry seconds that would round up to 60 into the minutes, and minutes into the whole field
+    carry = seconds >= _ROUNDING_THRESHOLD
+    seconds = np.where(carry, 0.0, seconds)
+    minutes = minutes + carry
+    carry = minutes >= 60.0
+    minutes = np.where(carry, 0.0, minutes)
+    whole = whole + carry
+
+    # round the seconds to integral milliseconds; values too close to a tie are left to astropy
+    scaled = seconds * _SCALE
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < _TIE_TOLERANCE
+    fallback = near_tie | ~np.isfinite(flat)
+    milliseconds = np.rint(np.where(fallback, 0.0, scaled)).astype(np.int64)
+    whole = np.where(fallback, 0.0, whole).astype(np.int64)
+    minutes = np.where(fallback, 0.0, minutes).astype(np.int64)
+
+    if alwayssign:
+        signs = np.where(negative, '-', '+')
+    else:
+        signs = np.where(negative, '-', '')
+    strings = np.char.add(signs, whole.astype(str))
+    strings = np.char.add(strings, ':')
+    strings = np.char.add(strings, np.char.zfill(minutes.astype(str), 2))
+    strings = np.char.add(strings, ':')
+    strings = np.char.add(strings, np.char.zfill((milliseconds // _SCALE).astype(str), 2))
+    strings = np.char.add(strings, '.')
+    strings = np.char.add(strings, np.char.zfill((milliseconds % _SCALE).astype(str), PRECISION))
+
+    if fallback.any():
+        strings = strings.astype(object)
+        for index in np.flatnonzero(fallback):
+            strings[index] = Angle(flat[index], unit=unit).to_string(
+                unit=unit, sep=':', precision=PRECISION, alwayssign=alwayssign)
+        strings = strings.astype(str)
+
+    strings = strings.reshape(values.shape)
+    return strings if strings.ndim else str(strings[()])
@@ -0,0 +1,89 @@
+"""
+An in-memory cache of the ESO credentials resolved for each user.
+
+Resolving a user's credentials (see ``ESOFacility._resolve_credentials``) costs an ``ESOProfile``
+query and the decryption of the P2 password, or a look at the default credentials in the settings.
+Every HTMX request needs the credentials, and so does a full page several times over, so they are
+resolved once and then kept for ``timeout`` seconds, keyed by the user's id. Failed resolutions (no
+usable credentials) are cached too.
+
+The cache is per process, and deliberately not a Django cache: the decrypted P2 passwords must
+never be written to shared storage. It is invalidated (see tom_eso/signals.py) when an ESOProfile is
+saved or deleted, when a user logs in or out (which changes whether their password can be
+decrypted), and when the ``FACILITIES`` setting changes (in tests).
+
+The timeout is configured with the optional ``credential_cache`` dictionary in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'credential_cache': {
+            'timeout': 60,  # seconds; 0 to resolve the credentials on every request
+        },
+    }
+"""
+import threading
+import time
+from collections import namedtuple
+
+from tom_eso.conf import get_eso_setting
+
+DEFAULT_TIMEOUT = 60  # seconds
+
+# The credentials to use for a user, and where they came from. ``profile_credentials`` is the
+# dict of the credentials in the user's ESOProfile (complete or not), or None if they have none.
+ResolvedCredentials = namedtuple(
+    'ResolvedCredentials',
+    ['p2_environment', 'p2_username', 'p2_password', 'credential_status', 'profile_credentials'],
+)
+
+
+class CredentialResolver:
+    """Resolve the credentials of each user at most once per ``timeout`` seconds."""
+
+    def __init__(self, timeout=None, clock=time.monotonic):
+        self._timeout = timeout
+        self._clock = clock
+        self._resolved = {}  # user id -> (expiry time, ResolvedCredentials)
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        if self._timeout is not None:
+            return self._timeout
+        return get_eso_setting('credential_cache', {}).get('timeout', DEFAULT_TIMEOUT)
+
+    def resolve(self, user, resolve_credentials):
+        """Return the cached ``ResolvedCredentials`` of ``user``, or cache and return ``resolve_credentials(user)``.
+
+        Exceptions raised by ``resolve_credentials`` are not cached.
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._resolved.get(user.pk)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+
+        credentials = resolve_credentials(user)
+        timeout = self.timeout
+        if timeout:
+            with self._lock:
+                self._resolved[user.pk] = (now + timeout, credentials)
+        return credentials
+
+    def invalidate(self, user_id):
+        """Forget the credentials resolved for the user with id ``user_id``."""
+        with self._lock:
+            self._resolved.pop(user_id, None)
+
+    def clear(self):
+        """Forget the credentials resolved for all the users."""
+        with self._lock:
+            self._resolved.clear()
+
+
+_credential_resolver = CredentialResolver()
+
+
+def get_credential_resolver():
+    """Return the process-wide ``CredentialResolver``."""
+    return _credential_resolver
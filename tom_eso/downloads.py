@@ -0,0 +1,229 @@
+"""
+Streaming, resumable downloads of (possibly very large) data product files.
+
+``StreamingDownloader.download()`` streams a file to disk in chunks, so it is never held in
+memory, and computes its checksum as the chunks are written. The file is written to
+``<path>.part`` and only renamed to ``<path>`` when it is complete. If the download is interrupted,
+the next attempt (a retry, or a later call for the same path) resumes from the end of the
+``.part`` file with an HTTP ``Range`` request, when the server supports it.
+
+``DownloadLimiter`` limits the number of concurrent downloads per user (in this process), and
+``download_lock()`` keeps concurrent downloads to the same path (from any thread or process)
+from resuming the same ``.part`` file at once.
+
+The downloads are configured with the optional ``downloads`` dictionary in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'downloads': {
+            'directory': '/tmp/tom_eso_downloads',  # where the .part files are kept
+            'chunk_size': 1048576,  # bytes
+            'max_retries': 3,
+            'max_per_user': 2,  # concurrent downloads
+        },
+    }
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import requests
+
+from tom_eso.conf import get_eso_setting
+
+try:
+    import fcntl
+except ImportError:  # not POSIX
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # bytes
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_MAX_PER_USER = 2
+DEFAULT_TIMEOUT = 60  # seconds, between bytes (not for the whole download)
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class DownloadError(Exception):
+    """A download failed, or the downloaded file doesn't match its expected checksum."""
+
+
+@dataclass
+class DownloadResult:
+    path: str
+    size: int  # bytes
+    checksum: str  # hex digest
+    resumed_from: int  # bytes already on disk when the download started (0 for a fresh download)
+    filename: str = None  # from the Content-Disposition header, if there was one
+
+
+def get_download_directory():
+    directory = get_eso_setting('downloads', {}).get('directory',
+                                                     os.path.join(tempfile.gettempdir(), 'tom_eso_downloads'))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class StreamingDownloader:
+    """Download files by streaming them to disk, resuming interrupted downloads."""
+
+    def __init__(self, session=None, chunk_size=DEFAULT_CHUNK_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                 timeout=DEFAULT_TIMEOUT, checksum_algorithm='sha256'):
+        self.session = session or requests.Session()
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.checksum_algorithm = checksum_algorithm
+
+    def download(self, url, path, expected_checksum=None):
+        """Download ``url`` to ``path`` and return a ``DownloadResult``.
+
+        Raise ``DownloadError`` if the download still fails after ``max_retries`` retries, or if
+        ``expected_checksum`` (a hex digest) is given and doesn't match (in which case the partial
+        file is removed, so the next attempt starts afresh).
+        """
+        part_path = path + '.part'
+        resumed_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        attempts = 0
+        while True:
+            try:
+                checksum, filename = self._download(url, part_path)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                attempts += 1
+                if attempts > self.max_retries:
+                    raise DownloadError(f'Download of {url} failed after {attempts} attempts: {e}') from e
+                logger.warning(f'Download of {url} interrupted at {os.path.getsize(part_path)} bytes '
+                               f'({e}); resuming (attempt {attempts + 1})')
+
+        if expected_checksum and checksum != expected_checksum.lower():
+            os.remove(part_path)
+            raise DownloadError(f'Checksum mismatch for {url}: expected {expected_checksum}, got {checksum}')
+
+        os.replace(part_path, path)
+        return DownloadResult(path=path, size=os.path.getsize(path), checksum=checksum,
+                              resumed_from=resumed_from, filename=filename)
+
+    def _download(self, url, part_path):
+        """Download (the rest of) ``url`` to ``part_path``. Return the checksum of the whole file and its filename."""
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416 and offset:
+                # the .part file is already complete (or longer than the file, in which case start afresh)
+                total = self._total_size(response.headers.get('Content-Range', ''))
+                if total == offset:
+                    return self._checksum_of_file(part_path).hexdigest(), self._filename(response)
+                os.remove(part_path)
+                return self._download(url, part_path)
+            if response.status_code >= 400:
+                raise DownloadError(f'Download of {url} failed: HTTP {response.status_code}')
+
+            if response.status_code == 206 and offset:
+                match = CONTENT_RANGE_PATTERN.match(response.headers.get('Content-Range', ''))
+                if not match or int(match.group(1)) != offset:
+                    raise DownloadError(f'Unexpected Content-Range from {url}: {response.headers.get("Content-Range")}')
+                # resuming: the checksum covers the bytes already on disk too
+                checksum = self._checksum_of_file(part_path)
+                mode = 'ab'
+            else:
+                # the server ignored the Range request (or there was none): start from the beginning
+                checksum = hashlib.new(self.checksum_algorithm)
+                mode = 'wb'
+
+            with open(part_path, mode) as part_file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    part_file.write(chunk)
+                    checksum.update(chunk)
+            return checksum.hexdigest(), self._filename(response)
+
+    def _checksum_of_file(self, path):
+        checksum = hashlib.new(self.checksum_algorithm)
+        with open(path, 'rb') as existing_file:
+            for chunk in iter(lambda: existing_file.read(self.chunk_size), b''):
+                checksum.update(chunk)
+        return checksum
+
+    @staticmethod
+    def _total_size(content_range):
+        match = re.match(r'bytes (?:\*|\d+-\d+)/(\d+)', content_range)
+        return int(match.group(1)) if match else None
+
+    @staticmethod
+    def _filename(response):
+        match = re.search(r'filename="?([^";]+)"?', response.headers.get('Content-Disposition', ''))
+        return os.path.basename(match.group(1)) if match else None
+
+
+@contextmanager
+def download_lock(path):
+    """Hold an exclusive lock on the download to ``path`` for the duration of the ``with`` block.
+
+    The lock is an ``flock()`` of ``<path>.lock`` (removed on release), so it also excludes other
+    processes. Without ``fcntl`` (on Windows), nothing is locked.
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_path = path + '.lock'
+    while True:
+        lock_file = open(lock_path, 'a')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            # the lock file might have been removed (by the previous holder) while we waited for it
+            if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
+        lock_file.close()
+
+
+class DownloadLimiter:
+    """Limit the number of concurrent downloads of each user (within this process)."""
+
+    def __init__(self, max_per_user=DEFAULT_MAX_PER_USER):
+        self.max_per_user = max_per_user
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, user_key):
+        """Wait for, and hold, one of the user's download slots for the duration of the ``with`` block."""
+        with self._lock:
+            semaphore = self._semaphores.setdefault(user_key, threading.BoundedSemaphore(self.max_per_user))
+        with semaphore:
+            yield
+
+
+_download_limiter = None
+_download_limiter_lock = threading.Lock()
+
+
+def get_download_limiter():
+    """Return the process-wide ``DownloadLimiter``, configured from the settings."""
+    global _download_limiter
+    with _download_limiter_lock:
+        if _download_limiter is None:
+            _download_limiter = DownloadLimiter(
+                get_eso_setting('downloads', {}).get('max_per_user', DEFAULT_MAX_PER_USER))
+        return _download_limiter
+
+
+def get_downloader(session=None):
+    """Return a ``StreamingDownloader`` configured from the settings."""
+    download_settings = get_eso_setting('downloads', {})
+    return StreamingDownloader(session=session,
+                               chunk_size=download_settings.get('chunk_size', DEFAULT_CHUNK_SIZE),
+                               max_retries=download_settings.get('max_retries', DEFAULT_MAX_RETRIES))
@@ -18,20 +18,45 @@ Workflow:
 At the moment, this pattern is followed by both tom_eso and tom_swift plugins.
 """
 import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
 
+import numpy as np
+from asgiref.sync import sync_to_async
 from crispy_forms.layout import Layout, HTML, Submit, ButtonHolder, Div
 
+from django.core.files import File
 from django.urls import reverse_lazy
+from django.utils.text import get_valid_filename
+from django.utils.timesince import timesince
 from django import forms
 
 from tom_observations.facility import (
+    AUTO_THUMBNAILS,
     BaseRoboticObservationForm,
     BaseRoboticObservationFacility,
     CredentialStatus
 )
-from tom_eso import __version__
-from tom_eso.eso_api import ESOAPI
+from tom_dataproducts.models import DataProduct
+from tom_dataproducts.utils import create_image_dataproduct
+from tom_eso import __version__, timing
+from tom_eso.archive import observation_block_products
+from tom_eso.choice_cache import credential_key, get_choice_cache
+from tom_eso.circuit_breaker import CLOSED, get_circuit_breaker, is_outage
+from tom_eso.concurrency import run_blocking
+from tom_eso.conf import get_eso_setting
+from tom_eso.connections import get_connection_pool
+from tom_eso.credentials import ResolvedCredentials, get_credential_resolver
+from tom_eso.downloads import download_lock, get_download_directory, get_download_limiter, get_downloader
+from tom_eso.eso_api import CONTAINER_ITEM_TYPES, ESOAPI
+from tom_eso.mirror import get_p2_mirror
 from tom_eso.models import ESOProfile
+from tom_eso.name_index import get_name_index
+from tom_eso.request_facility import get_shared_facility, share_facility
+from tom_eso.status import TERMINAL_OB_STATUSES, ObservationStatusUpdater, observation_status
+from tom_eso.visibility import eso_period, eso_period_dates, target_visibility
 from tom_targets.models import Target
 from tom_common.session_utils import get_encrypted_field
 
@@ -40,6 +65,51 @@ logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG)
 
 
+# the async endpoints that the HTMX dropdowns use when settings.FACILITIES['ESO']['async_views'] is True
+ASYNC_HTMX_URL_NAMES = {
+    'p2_observing_run': 'tom_eso:observing-run-folders-async',
+    'p2_folder_name': 'tom_eso:folder-observation-blocks-async',
+    'observation_blocks': 'tom_eso:show-observation-block-async',
+}
+
+
+# the P2Mirror method serving each kind of choice list (see ESOFacility._get_cached_choices)
+MIRROR_CHOICE_METHODS = {
+    'observing_runs': 'observing_run_choices',
+    'folders': 'folder_name_choices',
+    'observation_blocks': 'observation_block_choices',
+}
+
+
+# the number of observation blocks per page of ESOFacility.search_observation_blocks()
+DEFAULT_OBSERVATION_BLOCK_PAGE_SIZE = 100
+# the number of results of ESOFacility.search_p2_names()
+DEFAULT_NAME_SEARCH_LIMIT = 20
+
+# A page of the observation block choices of a folder that match a search (see
+# ESOFacility.search_observation_blocks). ``notices`` are the placeholder choices (errors, stale
+# choices) to show above the first page, and ``total`` is the number of matching observation blocks.
+ObservationBlockPage = namedtuple('ObservationBlockPage', ['choices', 'notices', 'total', 'page', 'has_more'])
+
+
+def lazy_choices(get_choices, *args):
+    """Return a callable to use as ``ChoiceField.choices`` that calls ``get_choices(*args)``
+    the first time the choices are needed and remembers the result.
+
+    (Django calls a callable ``choices`` every time the choices are iterated.)
+    """
+    choices = []
+    evaluated = False
+
+    def evaluate():
+        nonlocal evaluated
+        if not evaluated:  # an empty list of choices is a result too
+            choices.extend(get_choices(*args))
+            evaluated = True
+        return choices
+    return evaluate
+
+
 class ESOObservationForm(BaseRoboticObservationForm):
 
     # 1. define the form fields,
@@ -127,6 +197,12 @@ class ESOObservationForm(BaseRoboticObservationForm):
                         }
                     }
 
+                    // a new folder: start a new search
+                    let obs_search = document.querySelector("#id_observation_block_search");
+                    if (obs_search) {
+                        obs_search.value = '';
+                    }
+
                     // this creates the ob_select element so updateObsSpinner function can update it
                     obs_select.innerHTML = '<option value="">⠋ Loading observation blocks...</option>';
 
@@ -203,6 +279,25 @@ class ESOObservationForm(BaseRoboticObservationForm):
                 })
     )
 
+    # Large folders are sent to the observation_blocks dropdown a page at a time (see
+    # ESOFacility.search_observation_blocks); typing here replaces the dropdown's options with the
+    # observation blocks of the selected folder that match.
+    observation_block_search = forms.CharField(
+        label='Search Observation Blocks',
+        required=False,
+        widget=forms.TextInput(
+            attrs={
+                'type': 'search',
+                'placeholder': 'Type to search the folder',
+                'autocomplete': 'off',
+                'hx-get': reverse_lazy('tom_eso:search-observation-blocks'),  # send GET request to this URL
+                'hx-trigger': 'input changed delay:300ms, search',  # once the user pauses typing
+                'hx-include': '#id_p2_folder_name',  # send the selected folder along
+                'hx-target': '#id_observation_blocks',
+                'hx-swap': 'innerHTML',  # replace the <option>s of the observation blocks dropdown
+            })
+    )
+
     # for new observation blocks, the user will enter the observation block name
     observation_block_name = forms.CharField(
         label='Observation Block Name',
@@ -230,10 +325,16 @@ class ESOObservationForm(BaseRoboticObservationForm):
         # Store facility reference for use in validation
         self.facility = facility
 
+        if get_eso_setting('async_views', False):
+            # point the HTMX dropdowns at the async versions of the endpoints (see views.py)
+            for field_name, url_name in ASYNC_HTMX_URL_NAMES.items():
+                self.fields[field_name].widget.attrs['hx-get'] = reverse_lazy(url_name)
+
         if facility.credential_status in [CredentialStatus.USING_USER_CREDS, CredentialStatus.USING_DEFAULTS]:
-            # Get choices from facility (business logic handled there)
-            observing_run_choices = facility.get_observing_run_choices()
-            self.fields['p2_observing_run'].choices = observing_run_choices
+            # Get choices from facility (business logic handled there), but only when the field
+            # is actually rendered or validated. The HTMX views render a single field of this form,
+            # and must not pay for a getRuns call to ESO that they don't need.
+            self.fields['p2_observing_run'].choices = lazy_choices(facility.get_observing_run_choices)
         else:
             # Disable form fields until credentials are added
             for field in self.fields:
@@ -260,7 +361,9 @@ class ESOObservationForm(BaseRoboticObservationForm):
             Div(
                 Div('p2_observing_run', css_class='col'),
                 Div('p2_folder_name', css_class='col'),
-                Div('observation_blocks', css_class='col'),
+                Div('observation_block_search', 'observation_blocks',
+                    HTML('<div id="id_observation_blocks_more"></div>'),  # "load more" (see views.py)
+                    css_class='col'),
                 css_class='form-row',
             ),
 
@@ -369,11 +472,52 @@ class ESOFacility(BaseRoboticObservationFacility):
         self.facility_settings = ESOSettings()
         super().__init__(*args, **kwargs)
         self.eso_api = None
+        self._p2_mirror = None
+        self._credentials = None  # (user id, ResolvedCredentials) of the user, once resolved
+        self._prefetched_mirror_choices = {}  # (kind, *args) -> choices (or None), see aprefetch_mirror_choices()
+        self.stale_choices = {}  # kind of choice list -> when the stale choices served were cached
 
     def set_user(self, user):
-        """Set the user and configure ESO-specific credentials."""
+        """Set the user and configure ESO-specific credentials.
+
+        If a facility was already set up for the user in the current request, its configuration
+        is shared instead (see tom_eso/request_facility.py).
+        """
         super().set_user(user)
+        shared_facility = get_shared_facility(user)
+        if shared_facility is not None:
+            self._share_configuration(shared_facility)
+            return
         self._configure_credentials()
+        share_facility(self)
+
+    async def aset_user(self, user):
+        """Async version of ``set_user()``, for the async views.
+
+        The ESOProfile query and password decryption run through ``sync_to_async``, while the
+        (possibly blocking) ESO login runs in the bounded executor for ESO API calls.
+        """
+        shared_facility = get_shared_facility(user)
+        if shared_facility is not None:
+            super().set_user(user)
+            self._share_configuration(shared_facility)
+            return
+        credentials = await sync_to_async(self._set_user_and_resolve_credentials)(user)
+        if credentials is not None:
+            await run_blocking(self._connect, *credentials)
+        share_facility(self)
+
+    def _share_configuration(self, facility):
+        """Use the credentials and ESO API connection of ``facility``, which is set up for the same user."""
+        self.eso_api = facility.eso_api
+        self.credential_status = facility.credential_status
+        self.facility_settings.profile_credentials = dict(facility.facility_settings.profile_credentials)
+        self._p2_mirror = facility._p2_mirror
+        self._credentials = facility._credentials
+
+    def _set_user_and_resolve_credentials(self, user):
+        super().set_user(user)
+        return self._resolve_credentials()
 
     def _configure_credentials(self):
         """
@@ -387,77 +531,201 @@ class ESOFacility(BaseRoboticObservationFacility):
         The credential_status property tracks the current state.
         """
         logger.debug('ESOFacility._configure_credentials called...')
+        credentials = self._resolve_credentials()
+        if credentials is not None:
+            self._connect(*credentials)
+
+    def _resolve_credentials(self):
+        """Find the ESO credentials to use, from the user's ESOProfile or the settings defaults.
+
+        The credentials are looked up (see ``_lookup_credentials()``) at most once per user every few
+        seconds, and cached in memory in between (see tom_eso/credentials.py).
+
+        Return a (p2_environment, p2_username, p2_password, credential_status) tuple, or None if
+        there are no usable credentials (in which case eso_api and credential_status are set here).
+        """
         if self.user is None or not self.user.is_authenticated:
             logger.warning('ESOFacility._configure_credentials called with None user!')
             self.eso_api = None
             self.credential_status = CredentialStatus.NOT_INITIALIZED  # set_user() hasn't been called yet
-            return
+            return None
+
+        try:
+            credentials = self._get_resolved_credentials()
+        except Exception as ex:
+            # Unexpected errors
+            logger.error(f'Unexpected exception setting up ESO API for user {self.user.username}: {ex}')
+            self.eso_api = None
+            self.credential_status = CredentialStatus.NOT_INITIALIZED
+            raise
+
+        if credentials.profile_credentials is not None:
+            # set configured_credentials to reflect what we found in ESOProfile
+            self.facility_settings.profile_credentials = dict(credentials.profile_credentials)
+        if credentials.credential_status == CredentialStatus.NOT_INITIALIZED:
+            self.eso_api = None
+            self.credential_status = CredentialStatus.NOT_INITIALIZED
+            return None
+        return (credentials.p2_environment, credentials.p2_username, credentials.p2_password,
+                credentials.credential_status)
 
+    def _get_resolved_credentials(self):
+        """Return the (cached) ``ResolvedCredentials`` of the user, or None if there is no authenticated user.
+
+        The credentials are kept on the facility too, so that they are resolved once per facility
+        (and so once per request; see tom_eso/request_facility.py) even with the cache disabled.
+        """
+        if self.user is None or not self.user.is_authenticated:
+            return None
+        if self._credentials is None or self._credentials[0] != self.user.pk:
+            credentials = get_credential_resolver().resolve(self.user, self._lookup_credentials)
+            self._credentials = (self.user.pk, credentials)
+        return self._credentials[1]
+
+    def _lookup_credentials(self, user):
+        """Look up the ESO credentials of ``user``: those of their ESOProfile if it is complete, or else
+        the settings defaults. Return them as ``ResolvedCredentials`` (with a NOT_INITIALIZED
+        credential_status if there are no usable credentials).
+        """
+        profile_credentials = None
         try:
             # Try to get user's ESOProfile
-            try:
-                eso_profile = ESOProfile.objects.get(user=self.user)
-                # Profile exists - use its credentials (but not if incomplete)
-                p2_environment = eso_profile.p2_environment
-                p2_username = eso_profile.p2_username
-                p2_password = get_encrypted_field(self.user, eso_profile, 'p2_password')
-
-                # set configured_credentials to reflect what we found in ESOProfile
-                self.facility_settings.profile_credentials = {
-                    'p2_environment': p2_environment,
-                    'p2_username': p2_username,
-                    'p2_password': p2_password,
-                }
-
-                # check for missing creds in ESOProfile
-                if not self.facility_settings.get_unconfigured_settings():
-                    credential_status = CredentialStatus.USING_USER_CREDS
-                    logger.info(f'Using ESOProfile credentials for user {self.user.username}')
-                else:
-                    # if there are missing creds, act like the ESOProfile doesn't exist
-                    raise ESOProfile.DoesNotExist
-
-            except ESOProfile.DoesNotExist:
-                # No profile exists - try to use settings defaults
-                logger.warning(f'No ESOProfile found for user {self.user.username}, trying settings defaults')
-                try:
-                    creds_from_settings = self._get_setting_credentials(
-                        'ESO',
-                        self.facility_settings.required_credentials
-                    )
-                    p2_environment = creds_from_settings['p2_environment']
-                    p2_username = creds_from_settings['p2_username']
-                    p2_password = creds_from_settings['p2_password']
-                    credential_status = CredentialStatus.USING_DEFAULTS
-                    logger.warning(
-                        f'Using default ESO credentials from settings.FACILITIES for user {self.user.username}. '
-                        f'Create/Update ESOProfile to enable user-specific credentials.'
-                    )
-                except Exception as ex:
-                    logger.warning(f'No defaults available: {ex}')
-                    self.eso_api = None
-                    self.credential_status = CredentialStatus.NOT_INITIALIZED
-                    return
+            with timing.timed('eso_profile'):
+                eso_profile = ESOProfile.objects.get(user=user)
+            # Profile exists - use its credentials (but not if incomplete)
+            with timing.timed('decrypt'):
+                p2_password = get_encrypted_field(user, eso_profile, 'p2_password')
+            profile_credentials = {
+                'p2_environment': eso_profile.p2_environment,
+                'p2_username': eso_profile.p2_username,
+                'p2_password': p2_password,
+            }
+            self.facility_settings.profile_credentials = profile_credentials
+
+            # check for missing creds in ESOProfile
+            if not self.facility_settings.get_unconfigured_settings():
+                logger.info(f'Using ESOProfile credentials for user {user.username}')
+                return ResolvedCredentials(eso_profile.p2_environment, eso_profile.p2_username, p2_password,
+                                           CredentialStatus.USING_USER_CREDS, profile_credentials)
+            # if there are missing creds, act like the ESOProfile doesn't exist
+            raise ESOProfile.DoesNotExist
 
-            # Initialize API and update configured credentials
+        except ESOProfile.DoesNotExist:
+            # No profile exists - try to use settings defaults
+            logger.warning(f'No ESOProfile found for user {user.username}, trying settings defaults')
             try:
-                # now, all creds should be present from ESOProfile or settings (might not be valid)
-                self.eso_api = ESOAPI(p2_environment, p2_username, p2_password)
-                self.credential_status = credential_status
-                logger.debug(f'Successfully configured ESO API with credentials: {p2_environment}, {p2_username}')
-            except Exception as api_ex:
-                # Handle invalid credentials or API connection errors
-                logger.error(f'Failed to initialize ESO API for user {self.user.username}: {api_ex}')
+                creds_from_settings = self._get_setting_credentials(
+                    'ESO',
+                    self.facility_settings.required_credentials
+                )
+                logger.warning(
+                    f'Using default ESO credentials from settings.FACILITIES for user {user.username}. '
+                    f'Create/Update ESOProfile to enable user-specific credentials.'
+                )
+                return ResolvedCredentials(creds_from_settings['p2_environment'], creds_from_settings['p2_username'],
+                                           creds_from_settings['p2_password'], CredentialStatus.USING_DEFAULTS,
+                                           profile_credentials)
+            except Exception as ex:
+                logger.warning(f'No defaults available: {ex}')
+                return ResolvedCredentials(None, None, None, CredentialStatus.NOT_INITIALIZED, profile_credentials)
+
+    def _connect(self, p2_environment, p2_username, p2_password, credential_status):
+        """Initialize the ESO API with the given credentials and update the credential_status."""
+        try:
+            # now, all creds should be present from ESOProfile or settings (might not be valid)
+            # borrow an already-authenticated connection from the pool (logging in only if needed)
+            self.eso_api = get_connection_pool().acquire(p2_environment, p2_username, p2_password)
+            self.credential_status = credential_status
+            logger.debug(f'Successfully configured ESO API with credentials: {p2_environment}, {p2_username}')
+        except Exception as api_ex:
+            if is_outage(api_ex):
+                pool = get_connection_pool()
+                if pool.is_verified(p2_environment, p2_username, p2_password):
+                    # ESO is unavailable, but these credentials have logged in before: carry on with a connection
+                    # that logs in when first used, so that the last known choices can be served meanwhile
+                    logger.warning(f'ESO is unavailable, not logged in for user {self.user.username}: {api_ex}')
+                    self.eso_api = ESOAPI(p2_environment, p2_username, p2_password)
+                    self.credential_status = credential_status
+                    return
+                # credentials that can't be checked must not be given the data of the P2 account
+                logger.warning(f'ESO is unavailable, could not verify the credentials of user '
+                               f'{self.user.username}: {api_ex}')
                 self.eso_api = None
-                self.credential_status = CredentialStatus.VALIDATION_FAILED_AUTH
+                self.credential_status = CredentialStatus.VALIDATION_FAILED_NETWORK
                 return
+            # Handle invalid credentials or API connection errors
+            logger.error(f'Failed to initialize ESO API for user {self.user.username}: {api_ex}')
+            self.eso_api = None
+            self.credential_status = CredentialStatus.VALIDATION_FAILED_AUTH
+
+    def _get_p2_mirror(self):
+        """Return the ``P2Mirror`` of the P2 account in use (see ``tom_eso/mirror.py``)."""
+        if self._p2_mirror is None:
+            self._p2_mirror = get_p2_mirror(self.eso_api.environment, self.eso_api.username)
+        return self._p2_mirror
+
+    def _get_mirror_choices(self, kind, *args):
+        """Return a choice list from the local P2 mirror, or None if the mirror can't serve it."""
+        key = (kind, *args)
+        if key in self._prefetched_mirror_choices:
+            return self._prefetched_mirror_choices.pop(key)
+        if not self.eso_api:
+            return None
+        try:
+            return getattr(self._get_p2_mirror(), MIRROR_CHOICE_METHODS[kind])(*args)
+        except Exception as ex:
+            logger.warning(f'Error reading {kind} from the P2 mirror: {ex}')
+            return None
 
+    async def aprefetch_mirror_choices(self, kind, *args):
+        """Read a choice list from the local P2 mirror for the next choice getter that needs it.
+
+        The mirror is read with the ORM, so in Django's thread for it (``sync_to_async()``): the async
+        views prefetch it before running the getter, whose P2 calls block, with ``run_blocking()``,
+        whose threads must not use the ORM.
+        """
+        self._prefetched_mirror_choices[(kind, *args)] = await sync_to_async(self._get_mirror_choices)(kind, *args)
+
+    def _get_cached_choices(self, kind, fetch_choices, *args):
+        """Return a choice list from the local P2 mirror (while it is fresh) or else the shared
+        choice cache, calling ``fetch_choices(*args)`` on a miss.
+
+        See ``tom_eso/mirror.py`` and ``tom_eso/choice_cache.py``. Choice lists containing a
+        placeholder choice (with a value of 0), which is how the ESOAPI methods report errors, are not cached.
+        If ESO is unavailable, the last known choice list is returned instead, headed by a choice
+        saying that it is stale (see ``tom_eso/circuit_breaker.py``).
+        """
+        choices = self._get_mirror_choices(kind, *args)
+        if choices is not None:
+            return choices
+
+        choice_cache = get_choice_cache()
+        cred_key = credential_key(self.eso_api.environment, self.eso_api.username, self.eso_api.password)
+        choices = choice_cache.get(cred_key, kind, *args)
+        if choices is None:
+            try:
+                choices = fetch_choices(*args)
+            except Exception as ex:
+                stale = choice_cache.get_stale(cred_key, kind, *args) if is_outage(ex) else None
+                if stale is None:
+                    raise
+                logger.warning(f'ESO is unavailable ({ex}); serving the last known {kind}')
+                stale_choices, cached_at = stale
+                self.stale_choices[kind] = datetime.fromtimestamp(cached_at, tz=timezone.utc)
+                return [('', f'ESO P2 is unavailable: showing the {kind.replace("_", " ")} of '
+                             f'{timesince(self.stale_choices[kind])} ago')] + stale_choices
+            if all(value for value, _ in choices):
+                choice_cache.set(cred_key, kind, args, choices)
+        return choices
+
+    def _observation_blocks_changed(self, eso_api, folder_id):
+        """The folder has new observation blocks, so its cached and mirrored choices are out of date."""
+        get_choice_cache().delete(credential_key(eso_api.environment, eso_api.username, eso_api.password),
+                                  'observation_blocks', folder_id)
+        try:
+            get_p2_mirror(eso_api.environment, eso_api.username).invalidate_container(folder_id)
         except Exception as ex:
-            # Unexpected errors
-            logger.error(f'Unexpected exception setting up ESO API for user {self.user.username}: {ex}')
-            self.eso_api = None
-            self.credential_status = CredentialStatus.NOT_INITIALIZED
-            raise
+            logger.warning(f'Error invalidating folder {folder_id} in the P2 mirror: {ex}')
 
     def get_observing_run_choices(self):
         """Get observing run choices for the current user."""
@@ -469,9 +737,11 @@ class ESOFacility(BaseRoboticObservationFacility):
             return [(0, "No ESO credentials configured")]
 
         try:
-            observing_run_choices = self.eso_api.observing_run_choices()
+            observing_run_choices = self._get_cached_choices('observing_runs', self.eso_api.observing_run_choices)
             if not observing_run_choices:
                 return [(0, 'No observing runs available')]
+            if 'observing_runs' in self.stale_choices:
+                return observing_run_choices  # headed by the stale choices notice instead
             return [('', 'Please select an Observing Run')] + observing_run_choices
         except Exception as ex:
             logger.error(f'Error getting observing runs: {ex}')
@@ -487,7 +757,7 @@ class ESOFacility(BaseRoboticObservationFacility):
             return [(0, "No ESO credentials configured")]
 
         try:
-            return self.eso_api.folder_name_choices(observing_run_id=observing_run_id)
+            return self._get_cached_choices('folders', self.eso_api.folder_name_choices, observing_run_id)
         except Exception as ex:
             logger.error(f'Error getting folder names: {ex}')
             return [(0, f'Error loading folders: {str(ex)}')]
@@ -502,11 +772,99 @@ class ESOFacility(BaseRoboticObservationFacility):
             return [(0, "No ESO credentials configured")]
 
         try:
-            return self.eso_api.folder_ob_choices(folder_id)
+            return self._get_cached_choices('observation_blocks', self.eso_api.folder_ob_choices, folder_id)
         except Exception as ex:
             logger.error(f'Error getting observation blocks: {ex}')
             return [(0, f'Error loading observation blocks: {str(ex)}')]
 
+    def search_observation_blocks(self, folder_id, query='', page=1, page_size=None):
+        """Return an ``ObservationBlockPage`` of the observation block choices for the given folder
+        whose labels contain ``query`` (case-insensitively).
+
+        The choices are filtered and paginated here, from the cached choice list of the folder (see
+        ``get_observation_block_choices()``), so that a folder with thousands of observation blocks
+        is never sent to the browser, or rendered, all at once. The page size is the
+        ``observation_block_page_size`` setting (default 100) unless ``page_size`` is given.
+        """
+        if page_size is None:
+            page_size = get_eso_setting('observation_block_page_size', DEFAULT_OBSERVATION_BLOCK_PAGE_SIZE)
+        page = max(page, 1)
+        query = query.strip().casefold()
+
+        choices = self.get_observation_block_choices(folder_id)
+        notices = [choice for choice in choices if not choice[0]]
+        matches = [choice for choice in choices if choice[0] and query in choice[1].casefold()]
+        start = (page - 1) * page_size
+        return ObservationBlockPage(choices=matches[start:start + page_size],
+                                    notices=notices if page == 1 else [],
+                                    total=len(matches),
+                                    page=page,
+                                    has_more=start + page_size < len(matches))
+
+    def search_p2_names(self, query, limit=DEFAULT_NAME_SEARCH_LIMIT):
+        """Return the containers and observation blocks of the user's P2 account whose names best
+        match ``query``, as a list of dicts suitable for JSON (for a typeahead).
+
+        The names are looked up in the account's in-memory name index, which is seeded from the
+        local P2 mirror and kept up to date with the P2 responses received since (see
+        tom_eso/name_index.py), so this never contacts ESO.
+        """
+        if (
+            self.credential_status
+            not in [CredentialStatus.USING_USER_CREDS, CredentialStatus.USING_DEFAULTS]
+            or not self.eso_api
+        ):
+            return []
+
+        name_index = get_name_index(self.eso_api.environment, self.eso_api.username)
+        try:
+            self._get_p2_mirror().seed_name_index(name_index)
+        except Exception as ex:
+            logger.warning(f'Error seeding the name index from the P2 mirror: {ex}')
+
+        results = []
+        for match in name_index.search(query, limit):
+            is_container = match.item_type in CONTAINER_ITEM_TYPES
+            results.append({
+                'id': match.item_id,
+                'name': match.name,
+                'itemType': match.item_type,
+                'containerId': match.container_id,
+                'runId': match.run_id,
+                'p2_tool_url': (self.get_p2_tool_url(container_id=match.item_id) if is_container
+                                else self.get_p2_tool_url(observation_block_id=match.item_id)),
+            })
+        return results
+
+    def get_observing_run_tree(self, observing_run_id):
+        """Get the folders of the given observing run, and the observation blocks in each folder,
+        in one go (see ``ESOAPI.observing_run_tree``).
+
+        The folder and observation block choices in the tree are also put in the choice cache, so
+        the HTMX dropdown views don't have to go back to ESO for them.
+        """
+        if (
+            self.credential_status
+            not in [CredentialStatus.USING_USER_CREDS, CredentialStatus.USING_DEFAULTS]
+            or not self.eso_api
+        ):
+            return {'error': 'No ESO credentials configured'}
+
+        try:
+            tree = self.eso_api.observing_run_tree(observing_run_id)
+        except Exception as ex:
+            logger.error(f'Error getting observing run tree: {ex}')
+            return {'error': f'Error loading observing run: {str(ex)}'}
+
+        choice_cache = get_choice_cache()
+        cred_key = credential_key(self.eso_api.environment, self.eso_api.username, self.eso_api.password)
+        choice_cache.set(cred_key, 'folders', (observing_run_id,),
+                         [(folder['id'], folder['name']) for folder in tree['folders']])
+        for folder in tree['folders']:
+            if 'error' not in folder:
+                choice_cache.set(cred_key, 'observation_blocks', (folder['id'],), folder['observation_blocks'])
+        return tree
+
     def get_p2_tool_url(self,
                         observation_run_id=None,
                         container_id=None,
@@ -526,17 +884,17 @@ class ESOFacility(BaseRoboticObservationFacility):
         Observation Blocks take precedence over containers,
         which take precedence over an observing run.
         """
-        try:
-            eso_profile = ESOProfile.objects.get(user=self.user)
-            if eso_profile.p2_environment == 'production':
+        credentials = self._get_resolved_credentials()
+        if credentials is not None and credentials.profile_credentials is not None:
+            if credentials.profile_credentials['p2_environment'] == 'production':
                 eso_env = ''  # url is https://www.eso.org/p2/home
-            elif eso_profile.p2_environment == 'demo':
+            elif credentials.profile_credentials['p2_environment'] == 'demo':
                 eso_env = 'demo'  # url is https://www.eso.org/p2demo/home
             else:
                 eso_env = 'demo'  # safest default
             p2_tool_url = f'https://www.eso.org/p2{eso_env}/home'
-        except ESOProfile.DoesNotExist:
-            p2_tool_url = ''
+        else:
+            p2_tool_url = ''  # the user has no ESOProfile
 
         # if an object ID is provided, add it to the URL
         if observation_block_id:
@@ -562,16 +920,10 @@ class ESOFacility(BaseRoboticObservationFacility):
 
         # Get ESO username from ESOProfile instead of Django username
         eso_username = 'None. Please check ESO credentials.'
-        if self.user:
-            if self.credential_status == CredentialStatus.USING_USER_CREDS:
-                eso_profile = ESOProfile.objects.get(user=self.user)
-                eso_username = eso_profile.p2_username
-            elif self.credential_status == CredentialStatus.USING_DEFAULTS:
-                creds_from_settings = self._get_setting_credentials(
-                    'ESO',
-                    self.facility_settings.required_credentials
-                )
-                eso_username = creds_from_settings['p2_username']
+        if self.user and self.credential_status in [CredentialStatus.USING_USER_CREDS,
+                                                    CredentialStatus.USING_DEFAULTS]:
+            # the ESOProfile's username, or the default one from the settings
+            eso_username = self._get_resolved_credentials().p2_username
 
         new_context_data = {
             'version': __version__,  # from tom_eso/__init__.py
@@ -579,6 +931,8 @@ class ESOFacility(BaseRoboticObservationFacility):
             'iframe_url': p2_tool_url,
             'observation_form': self.get_form(kwargs.get('observation_type')),
             'credential_status': self.credential_status,
+            'p2_mirror': self._get_p2_mirror().freshness() if self.eso_api else None,
+            'p2_unavailable': bool(self.eso_api) and get_circuit_breaker(self.eso_api.environment).state != CLOSED,
         }
         # logger.debug(f'eso new_context_data: {new_context_data}')
 
@@ -596,10 +950,70 @@ class ESOFacility(BaseRoboticObservationFacility):
         return self.observation_forms.get(observation_type, ESOObservationForm)
 
     def data_products(self, observation_id, product_id=None):
-        raise NotImplementedError
+        """Return the data products of the observation block with the P2 obId ``observation_id``
+        in the ESO Science Archive (see ``tom_eso/archive.py``), or just the one with ``product_id``.
+        """
+        products = observation_block_products(observation_id)
+        if product_id:
+            products = [product for product in products if product['id'] == product_id]
+        return products
+
+    def save_data_products(self, observation_record, product_id=None):
+        """Download the data products of the ObservationRecord and save them as DataProducts.
+
+        Unlike the base class, which holds each file in memory, the files are streamed to disk
+        (resuming interrupted downloads) and then into the DataProduct's storage; at most
+        ``max_per_user`` downloads of each user run at once (see ``tom_eso/downloads.py``).
+        Each DataProduct has its own partial file, which one thread or process at a time downloads.
+        A DataProduct whose download failed is downloaded again on the next call.
+        """
+        final_products = []
+        downloader = get_downloader()
+        download_directory = get_download_directory()
+        for product in self.data_products(observation_record.observation_id, product_id):
+            dp, created = DataProduct.objects.get_or_create(
+                product_id=product['id'],
+                target=observation_record.target,
+                observation_record=observation_record,
+            )
+            if not dp.data:
+                # (one partial download per DataProduct, and one download of it at a time)
+                path = os.path.join(download_directory, f'{observation_record.pk}_{get_valid_filename(product["id"])}')
+                with download_lock(path):
+                    dp.refresh_from_db(fields=['data'])
+                    if not dp.data:  # (unless a concurrent download has just saved it)
+                        self._download_data_product(dp, product, path, downloader)
+            if AUTO_THUMBNAILS:
+                create_image_dataproduct(dp)
+                dp.get_preview()
+            final_products.append(dp)
+        return final_products
+
+    def _download_data_product(self, dp, product, path, downloader):
+        """Download the archive ``product`` (via ``path``) into the storage of DataProduct ``dp``."""
+        with get_download_limiter().slot(self.user.pk if self.user else None):
+            result = downloader.download(product['url'], path, expected_checksum=product.get('checksum'))
+        try:
+            with open(result.path, 'rb') as downloaded_file:
+                dp.data.save(result.filename or product['filename'], File(downloaded_file))
+        finally:
+            os.remove(result.path)
+        logger.info(f'Saved new dataproduct: {dp.data} ({result.size} bytes, sha256 {result.checksum})')
 
     def get_observation_status(self, observation_id):
-        raise NotImplementedError
+        """Return the status of the observation block with the P2 obId ``observation_id``."""
+        if not self.eso_api:
+            raise ValueError('Cannot get the observation status without ESO credentials')
+        return observation_status(self.eso_api.getOB(int(observation_id)))
+
+    def update_all_observation_statuses(self, target=None):
+        """Update the status of all the non-terminal ESO ObservationRecords (of the ``target``, if given).
+
+        Unlike the base class, which updates the records one at a time, the records are updated in
+        batches, with the observation blocks of each batch fetched concurrently (see ``tom_eso/status.py``).
+        Return a list of the (observation_id, error message) of the records that could not be updated.
+        """
+        return ObservationStatusUpdater(self).update(target=target)
 
     def get_observation_url(self, observation_id):
         raise NotImplementedError
@@ -623,8 +1037,67 @@ class ESOFacility(BaseRoboticObservationFacility):
             },
         }
 
+    def get_target_visibility(self, targets, period=None):
+        """Rank ``targets`` by how long they are observable from the ESO observing sites during ESO
+        period ``period`` (by default, the current one); see tom_eso/visibility.py.
+
+        Return a dict with the ``period``, its ``start`` and ``end`` dates, the ``sites`` and the
+        ``ranking``, best first: for each target, the ``site`` where it is observable longest, its
+        observable ``hours`` there, the ``first_night`` and ``last_night`` it is observable there,
+        its ``best_airmass`` and closest approach to the Moon (``min_moon_distance``, in degrees),
+        and its observable hours at each of the ``sites`` (``site_hours``). Targets without fixed
+        coordinates (non-sidereal targets) can't be ranked, and are listed as ``unranked``.
+        """
+        if period is None:
+            period = eso_period(datetime.now(timezone.utc))
+        targets = list(targets)
+        ranked_targets = [target for target in targets if target.ra is not None and target.dec is not None]
+        sites = self.get_observing_sites()
+
+        with timing.timed('visibility'):
+            ras = [target.ra for target in ranked_targets]
+            decs = [target.dec for target in ranked_targets]
+            site_visibilities = [target_visibility(ras, decs, site, period) for site in sites.values()]
+
+        # (sites x targets) arrays
+        site_hours = np.array([visibility.nightly_steps.sum(axis=1) * grid.time_step / 60
+                               for grid, visibility in site_visibilities]).reshape(len(sites), len(ranked_targets))
+        best_airmasses = np.array([np.fmin.reduce(visibility.nightly_best_airmass, axis=1)
+                                   for _, visibility in site_visibilities]).reshape(site_hours.shape)
+        best_sites = site_hours.argmax(axis=0)
+
+        ranking = []
+        site_names = list(sites)
+        for index, target in enumerate(ranked_targets):
+            best_site = best_sites[index]
+            grid, visibility = site_visibilities[best_site]
+            observable_nights = np.flatnonzero(visibility.nightly_steps[index])
+            best_airmass = best_airmasses[best_site, index]
+            min_moon_distance = visibility.min_moon_distance[index]
+            ranking.append({
+                'target': target,
+                'site': site_names[best_site] if len(observable_nights) else None,
+                'hours': float(site_hours[best_site, index]),
+                'first_night': grid.night_date(observable_nights[0]) if len(observable_nights) else None,
+                'last_night': grid.night_date(observable_nights[-1]) if len(observable_nights) else None,
+                'best_airmass': None if np.isnan(best_airmass) else float(best_airmass),
+                'min_moon_distance': None if np.isnan(min_moon_distance) else float(min_moon_distance),
+                'site_hours': [float(hours) for hours in site_hours[:, index]],
+            })
+        ranking.sort(key=lambda row: (-row['hours'], row['best_airmass'] or np.inf))
+
+        start, end = eso_period_dates(period)
+        return {
+            'period': period,
+            'start': start.date(),
+            'end': (end - timedelta(days=1)).date(),
+            'sites': site_names,
+            'ranking': ranking,
+            'unranked': [target for target in targets if target.ra is None or target.dec is None],
+        }
+
     def get_terminal_observing_states(self):
-        return []
+        return TERMINAL_OB_STATUSES
 
     def submit_new_observation_block(self, observation_payload):
         """
@@ -641,20 +1114,85 @@ class ESOFacility(BaseRoboticObservationFacility):
             logger.error('Cannot submist new observation block without user: {self.user}')
             return  # so early return
 
-        try:
-            eso_profile = ESOProfile.objects.get(user=self.user)
-            decrypted_p2_password = get_encrypted_field(self.user, eso_profile, 'p2_password')
-            eso = ESOAPI(eso_profile.p2_environment, eso_profile.p2_username, decrypted_p2_password)
-            new_observation_block = eso.create_observation_block(
-                folder_id=observation_payload['params']['p2_folder_name'],
-                ob_name=observation_payload['params']['observation_block_name'],
-                target=target
-            )
-            # TODO: redirect with new observation block id in the ESO P2 Tool iframe
-            logger.debug(f'ESOFacility.submit_new_observation_block new_observation_block: {new_observation_block}')
-        except ESOProfile.DoesNotExist:
+        credentials = self._get_resolved_credentials()
+        if credentials is None or credentials.profile_credentials is None:
             # Handle the case where the user has no ESOProfile
             logger.error(f'User {self.user} has no ESOProfile')
+            return
+
+        profile_credentials = credentials.profile_credentials
+        eso = get_connection_pool().acquire(profile_credentials['p2_environment'], profile_credentials['p2_username'],
+                                            profile_credentials['p2_password'])
+        folder_id = observation_payload['params']['p2_folder_name']
+        new_observation_block = eso.create_observation_block(
+            folder_id=folder_id,
+            ob_name=observation_payload['params']['observation_block_name'],
+            target=target
+        )
+        self._observation_blocks_changed(eso, folder_id)
+        # TODO: redirect with new observation block id in the ESO P2 Tool iframe
+        logger.debug(f'ESOFacility.submit_new_observation_block new_observation_block: {new_observation_block}')
+
+    def submit_observation_blocks_for_targets(self, folder_id, targets, ob_name_template='{target_name}',
+                                              max_workers=None):
+        """Create an observation block in the given folder for each of many targets.
+
+        ``targets`` can be a TargetList, an iterable of Targets, or an iterable of Target ids
+        (which are loaded in a single query). Each observation block is named with
+        ``ob_name_template.format(target_name=..., target_id=...)``. The blocks are created
+        concurrently over this facility's (pooled) ESO API connection, by at most ``max_workers``
+        threads (default: the ``bulk_max_workers`` setting, or ``max_workers``).
+
+        Return a dict with a result for each target, the number of blocks created and failed,
+        and the total wall time in seconds::
+
+            {'results': [{'target_id': 1, 'target_name': 'M31', 'ob_name': 'M31', 'ob_id': 123},
+                         {'target_id': 2, 'target_name': 'M33', 'ob_name': 'M33', 'error': '...'}],
+             'created': 1, 'failed': 1, 'wall_time': 1.23}
+        """
+        if (
+            self.credential_status
+            not in [CredentialStatus.USING_USER_CREDS, CredentialStatus.USING_DEFAULTS]
+            or not self.eso_api
+        ):
+            raise ValueError('Cannot create observation blocks without ESO credentials')
+
+        start = time.perf_counter()
+        if hasattr(targets, 'targets'):  # a TargetList
+            targets = targets.targets.all()
+        targets = list(targets)
+        if targets and not isinstance(targets[0], Target):
+            targets_by_id = Target.objects.in_bulk(targets)
+            targets = [targets_by_id[target_id] for target_id in targets if target_id in targets_by_id]
+
+        ob_names_and_targets = [
+            (ob_name_template.format(target_name=target.name, target_id=target.id), target) for target in targets
+        ]
+        if max_workers is None:
+            max_workers = get_eso_setting('bulk_max_workers')
+        new_observation_blocks = self.eso_api.create_observation_blocks(folder_id, ob_names_and_targets,
+                                                                        max_workers=max_workers)
+
+        results = []
+        for (ob_name, target), new_observation_block in zip(ob_names_and_targets, new_observation_blocks):
+            result = {'target_id': target.id, 'target_name': target.name, 'ob_name': ob_name}
+            if isinstance(new_observation_block, Exception):
+                logger.error(f'Error creating observation block {ob_name} for target {target.name}: '
+                             f'{new_observation_block}')
+                result['error'] = str(new_observation_block)
+            else:
+                result['ob_id'] = new_observation_block['obId']
+            results.append(result)
+
+        self._observation_blocks_changed(self.eso_api, folder_id)
+
+        n_failed = sum('error' in result for result in results)
+        return {
+            'results': results,
+            'created': len(results) - n_failed,
+            'failed': n_failed,
+            'wall_time': time.perf_counter() - start,
+        }
 
     def submit_observation(self, observation_payload):
         """For the ESO Facility we're limited to creating new observation blocks for
@@ -1,20 +1,60 @@
 import logging
-
-from astropy.coordinates import Angle
-from astropy import units as u
+import threading
 
 import p1api
 import p2api  # these are the ESO APIs for phase1 and phase2
 
+from tom_eso.cassettes import get_cassette
+from tom_eso.circuit_breaker import OPEN, get_circuit_breaker, is_outage
+from tom_eso import metrics, timing
+from tom_eso.concurrency import SingleFlight, map_concurrently
+from tom_eso.coordinates import dec_to_sexagesimal, ra_to_sexagesimal
+from tom_eso.conf import get_eso_setting
+from tom_eso.p2_cache import P2ResponseCache
+from tom_eso.throttling import call_with_retries, get_rate_limiter, throttle
+
 logger = logging.getLogger(__name__)
 
+# API paths of the cacheable p2api GET methods (see p2api.ApiConnection), used to revalidate cache entries
+P2_GET_PATHS = {
+    'getRuns': '/obsRuns',
+    'getRun': '/obsRuns/%d',
+    'getItems': '/containers/%d/items',
+}
+
+
+# returned by ESOAPI._revalidate() when a cached response is still current
+NOT_MODIFIED = object()
+
+# itemTypes of the P2 items that contain other items. Their id is a containerId (OBs and CBs have an obId)
+CONTAINER_ITEM_TYPES = ('Folder', 'Concatenation', 'Group', 'TimeLink')
+DEFAULT_CONTAINER_DEPTH = 4  # levels of nested containers to descend into
+CHOICE_INDENT = '\u00a0' * 4  # non-breaking, so the indentation survives in an <option>
+OBS_RUN_BLACK_LIST = [60925302, 60925303]  # observing runs never offered as choices
+NAME_INDEX_METHODS = ('getRuns', 'getRun', 'getItems')  # the responses added to the name index
+
+# identical concurrent read-only P2 calls (same account, method and arguments) share one request
+_single_flight = SingleFlight()
+
+
+def get_item_id(item):
+    """Return the id of a P2 container item: the containerId of a container, or the obId of an OB or CB."""
+    if item['itemType'] in CONTAINER_ITEM_TYPES or 'obId' not in item:
+        return int(item['containerId'])
+    return int(item['obId'])
+
 
 class ESOAPI:
-    """A class to hold ESO p1 and p2 ApiConnections."""
+    """A class to hold ESO p1 and p2 ApiConnections.
+
+    The ApiConnections are created (i.e. logged in to) lazily, the first time the
+    ``api1`` or ``api2`` attribute is accessed. Most requests only ever need Phase 2,
+    so they never pay for a Phase 1 login.
+    """
 
     def __init__(self, environment, username, password):
         """
-        Initializes the ESOAPI object.
+        Initializes the ESOAPI object. No connection to ESO is made until one is needed.
 
         Args:
             environment (str): The ESO environment to use ('production', 'demo', etc.).
@@ -25,19 +65,203 @@ class ESOAPI:
         self.username = username
         self.password = password
 
+        self._api1 = None
+        self._api2 = None
+        self._connection_lock = threading.Lock()
+
+        # cache of the read-only Phase 2 responses (see tom_eso/p2_cache.py)
+        self.p2_cache = P2ResponseCache(**get_eso_setting('p2_cache', {}))
+
+    def _connect(self, api_connection_class, phase):
+        metrics.increment('p2_logins_total', phase=phase, environment=self.environment)
+        cassette = get_cassette()
         try:
-            self.api1 = p1api.ApiConnection(self.environment, self.username, self.password)
-            self.api2 = p2api.ApiConnection(self.environment, self.username, self.password)
+            with (timing.timed('eso_login'),
+                  metrics.timed('p2_login_duration_seconds', phase=phase, environment=self.environment)):
+                if cassette is not None:  # record the connection's traffic, or replay it (see tom_eso/cassettes.py)
+                    return cassette.connect(api_connection_class, phase, self.environment, self.username,
+                                            self.password)
+                return api_connection_class(self.environment, self.username, self.password)
         except Exception as e:
-            logger.error(f"ESOAPI.__init__: Error creating API connections: {e}")
+            metrics.increment('p2_login_errors_total', phase=phase, environment=self.environment)
+            logger.error(f"ESOAPI: Error creating {phase} API connection: {e}")
             raise
 
-    def create_observation_block(self, folder_id, ob_name, target=None):
+    @property
+    def api1(self):
+        """The Phase 1 ``p1api.ApiConnection``, logged in to on first access."""
+        if self._api1 is None:
+            with self._connection_lock:
+                if self._api1 is None:
+                    self._api1 = self._connect(p1api.ApiConnection, 'Phase 1')
+        return self._api1
+
+    @property
+    def api2(self):
+        """The Phase 2 ``p2api.ApiConnection``, logged in to on first access."""
+        if self._api2 is None:
+            with self._connection_lock:
+                if self._api2 is None:
+                    self._api2 = self._connect(p2api.ApiConnection, 'Phase 2')
+        return self._api2
+
+    def connect(self):
+        """Log in to the Phase 2 API now (if not already logged in).
+
+        Raises the p2api exception if the credentials are rejected, which makes this
+        the way to validate a set of credentials. The login goes through the environment's
+        circuit breaker, so while ESO is unavailable it fails immediately with ``CircuitOpenError``.
+        """
+        if self._api2 is None:
+            get_circuit_breaker(self.environment).call(lambda: self.api2)
+        return self.api2
+
+    def _p2_call(self, method_name, *args):
+        """Call the ``p2api.ApiConnection`` method ``method_name`` and return its (data, version) tuple.
+
+        All Phase 2 traffic goes through here. Identical concurrent calls of the read-only ``get*``
+        methods, from any thread, are coalesced into one. Responses of the methods in the response
+        cache are served from it while fresh, and revalidated against their version after that.
+        """
+        if not method_name.startswith('get'):
+            return self._p2_call_once(method_name, *args)
+
+        # the password is part of the key, so a caller with the wrong password never shares a result
+        key = (self.environment, self.username, self.password, method_name, *args)
+        result, shared = _single_flight.do(key, self._p2_call_once, method_name, *args)
+        if shared:
+            metrics.increment('p2_calls_coalesced_total', method=method_name, environment=self.environment)
+        self._index_names(method_name, args, result)
+        return result
+
+    def _index_names(self, method_name, args, result):
+        """Add the runs, containers and observation blocks of a response to the account's name index
+        (see tom_eso/name_index.py).
+        """
+        if method_name not in NAME_INDEX_METHODS:
+            return
+        from tom_eso.name_index import get_name_index  # tom_eso.name_index imports this module
+
+        try:
+            data, version = result
+            index = get_name_index(self.environment, self.username)
+            if method_name == 'getItems':
+                index.update_container(args[0], data, version)
+            else:
+                index.add_observing_runs(data if method_name == 'getRuns' else [data])
+        except Exception as e:
+            logger.warning(f'ESOAPI: Error indexing the names of a {method_name} response: {e}')
+
+    def _p2_call_once(self, method_name, *args):
+        """Make the ``_p2_call()``, through the response cache for the cacheable methods."""
+        if not self.p2_cache.is_cacheable(method_name):
+            return self._call_upstream(method_name, *args)
+
+        key = (method_name, *args)
+        entry = self.p2_cache.get(key)
+        if entry is not None:
+            if self.p2_cache.is_fresh(key, entry):
+                metrics.increment('p2_cache_hits_total', method=method_name, environment=self.environment)
+                return entry.data, entry.version
+            if entry.version:
+                revalidated = self._revalidate(P2_GET_PATHS[method_name] % args, entry.version)
+                if revalidated is NOT_MODIFIED:
+                    metrics.increment('p2_cache_hits_total', method=method_name, environment=self.environment)
+                    entry.touch()
+                    return entry.data, entry.version
+                if revalidated is not None:
+                    metrics.increment('p2_cache_misses_total', method=method_name, environment=self.environment)
+                    self.p2_cache.put(key, *revalidated)
+                    return revalidated
+
+        metrics.increment('p2_cache_misses_total', method=method_name, environment=self.environment)
+        data, version = self._call_upstream(method_name, *args)
+        self.p2_cache.put(key, data, version)
+        return data, version
+
+    def _call_upstream(self, method_name, *args):
+        """Call the ``p2api.ApiConnection`` method ``method_name`` on ESO's servers.
+
+        The call is rate limited per ESO account, and retried with backoff if it fails with a
+        transient error (see tom_eso/throttling.py). While ESO is unavailable, it fails immediately
+        with ``CircuitOpenError`` (see tom_eso/circuit_breaker.py).
+        """
+        def call():
+            try:
+                with (timing.timed('p2'),
+                      metrics.timed('p2_request_duration_seconds', method=method_name, environment=self.environment)):
+                    return getattr(self.api2, method_name)(*args)
+            except Exception:
+                metrics.increment('p2_request_errors_total', method=method_name, environment=self.environment)
+                raise
+
+        return get_circuit_breaker(self.environment).call(
+            call_with_retries, call, method_name, self.environment, get_rate_limiter(self.environment, self.username))
+
+    def fetch_if_changed(self, version, method_name, *args):
+        """Return the (data, version) of ``method_name(*args)``, or ``NOT_MODIFIED`` if it is still ``version``.
+
+        When a ``version`` is known (and the response cache has nothing fresher), a conditional
+        request is made, so an unchanged response costs a round trip but no download.
+        """
+        key = (method_name, *args)
+        entry = self.p2_cache.get(key)
+        if version and method_name in P2_GET_PATHS and (entry is None or not self.p2_cache.is_fresh(key, entry)):
+            revalidated = self._revalidate(P2_GET_PATHS[method_name] % args, version)
+            if revalidated is NOT_MODIFIED:
+                return NOT_MODIFIED
+            if revalidated is not None:
+                if self.p2_cache.is_cacheable(method_name):
+                    self.p2_cache.put(key, *revalidated)
+                return revalidated
+
+        data, new_version = self._p2_call(method_name, *args)
+        if version and new_version == version:
+            return NOT_MODIFIED
+        return data, new_version
+
+    def _revalidate(self, path, version):
+        """Make a conditional GET request for ``path`` with ``If-None-Match: version``.
+
+        Return ``NOT_MODIFIED`` if the resource has not changed, the new (data, version)
+        tuple if it has, or None if the response was anything else (in which case the
+        caller should fall back to the regular p2api method, which handles errors).
+        p2api has no conditional requests, so this uses its authenticated requests session.
+        """
+        if get_circuit_breaker(self.environment).state == OPEN:
+            return None
+        api2 = self.api2
+        headers = {
+            'Authorization': f'Bearer {api2.access_token}',
+            'Accept': 'application/json',
+            'If-None-Match': version,
+        }
+        throttle(get_rate_limiter(self.environment, self.username), 'revalidate', self.environment)
+        try:
+            with (timing.timed('p2'),
+                  metrics.timed('p2_request_duration_seconds', method='revalidate', environment=self.environment)):
+                response = api2.session.request('GET', api2.apiUrl + path, headers=headers)
+        except Exception as e:
+            metrics.increment('p2_request_errors_total', method='revalidate', environment=self.environment)
+            logger.debug(f'ESOAPI._revalidate: conditional request for {path} failed: {e}')
+            return None
+
+        if response.status_code == 304:
+            return NOT_MODIFIED
+        if response.status_code == 200 and response.headers.get('Content-Type', '').startswith('application/json'):
+            return response.json(), response.headers.get('ETag', None)
+        return None
+
+    def create_observation_block(self, folder_id, ob_name, target=None, coordinates=None):
         """Create a new Observation Block in the specified folder. Return the new OB's id.
         If a Target is specified, add it to the OB.
 
+        ``coordinates`` is an optional (ra, dec) pair of the target's coordinates already
+        formatted for ESO P2 (see ``tom_eso.coordinates``); by default they are formatted here.
         """
-        new_OB, ob_version = self.api2.createOB(folder_id, ob_name)
+        new_OB, ob_version = self._p2_call('createOB', folder_id, ob_name)
+        self.p2_cache.invalidate(('getItems', folder_id))  # the folder has a new item
+        saved_observation_block = new_OB
 
         if target:
             # add the target data to the new OB by modifying the OB JSON
@@ -46,29 +270,48 @@ class ESOAPI:
             # For ESO P2 API, the RA and Dec have specific formats:
             # RA: Valid format is HH:MM:SS.sss, with 0 <= HH <= 23, 0 <= MM < 60 and 0 <= SS < 60.]
             # Dec: Valid format is [+|-]DD:MM:SS.sss, with -90 <= DD <= 90, 0 <= MM < 60 and 0 <= SS < 60.]
-            new_OB['target']['ra'] = Angle(target.ra, unit=u.deg).to_string(unit=u.hourangle, sep=':', precision=3)
-            new_OB['target']['dec'] = Angle(target.dec, unit=u.deg).to_string(unit=u.deg, sep=':', precision=3,
-                                                                              alwayssign=True)
+            if coordinates is None:
+                coordinates = (ra_to_sexagesimal(target.ra), dec_to_sexagesimal(target.dec))
+            new_OB['target']['ra'], new_OB['target']['dec'] = coordinates
             # save the updated observation block
-            saved_observation_block, ob_version = self.api2.saveOB(new_OB, ob_version)
+            saved_observation_block, ob_version = self._p2_call('saveOB', new_OB, ob_version)
 
         return saved_observation_block
 
+    def create_observation_blocks(self, folder_id, ob_names_and_targets, max_workers=None):
+        """Create an Observation Block for each (ob_name, target) pair in the specified folder.
+
+        The targets' coordinates are formatted for ESO P2 in one vectorized pass, and the
+        createOB/saveOB round trips for the different targets are made concurrently,
+        by at most ``max_workers`` threads. Return a list with, for each pair (in order),
+        either the new OB or the exception that prevented its creation.
+        """
+        targets = [target for _, target in ob_names_and_targets if target]
+        formatted_coordinates = iter(zip(ra_to_sexagesimal([target.ra for target in targets]).tolist(),
+                                         dec_to_sexagesimal([target.dec for target in targets]).tolist()))
+        observation_blocks = [(ob_name, target, next(formatted_coordinates) if target else None)
+                              for ob_name, target in ob_names_and_targets]
+
+        def create(observation_block):
+            ob_name, target, coordinates = observation_block
+            return self.create_observation_block(folder_id, ob_name, target=target, coordinates=coordinates)
+
+        return map_concurrently(create, observation_blocks, max_workers=max_workers, return_exceptions=True)
+
     def observing_run_choices(self):
         """Return a list of tuples for the ESO Phase 2 observing runs available to the user.
 
         Uses ESO Phase2 API method `getRuns()` to get the observing runs, and creates
         the list of form.ChoiceField tuples from the result.
         """
-        # TODO: this and other methods should be cached
-
-        OBS_RUN_BLACK_LIST = [60925302, 60925303]
         try:
-            observing_runs, _ = self.api2.getRuns()
+            observing_runs, _ = self._p2_call('getRuns')
         except KeyError as e:
             logger.error(f'observing_run_choices: KeyError: {e}')
             return [(0, 'Are there any observing runs?')]
         except Exception as e:
+            if is_outage(e):
+                raise  # let the caller fall back to the last known choices
             logger.error(f'observing_run_choices: Unexpected error: {e}')
             return [(0, f'Error fetching runs: {str(e)}')]
 
@@ -76,24 +319,79 @@ class ESOAPI:
                    for run in observing_runs if not int(run['runId']) in OBS_RUN_BLACK_LIST]
         return choices
 
-    def folder_name_choices(self, observing_run_id):
+    def folder_name_choices(self, observing_run_id, max_depth=None):
         """Return a list of tuples for the ESO Phase 2 folder names available to the user.
-        (These are the folders in the selected Observing Run).
+        (These are the folders, and other containers, in the selected Observing Run).
 
         Uses ESO Phase2 API method `getItems()` for the ObservingRun's continer_id
-        to get the items and filters on itemType to select Folders.
+        to get the items and descends into the containers among them, up to ``max_depth`` levels
+        (see ``container_tree_choices()``). Nested containers are indented below their parents.
         Creates the list of form.ChoiceField tuples from the result.
         """
-        observing_run, _ = self.api2.getRun(observing_run_id)
+        observing_run, _ = self._p2_call('getRun', observing_run_id)
         container_id = observing_run['containerId']
+        return self.container_tree_choices(container_id, max_depth=max_depth)
 
-        items_in_run_container, _ = self.api2.getItems(container_id)
+    def walk_container(self, container_id, max_depth=None, max_workers=None):
+        """Generate ``(depth, parent_container_id, item)`` for every item below ``container_id``.
 
-        # NOTE: here we know id is containerId, b/c we filter on itemType == 'Folder'
-        # see TODO in folder_item_choices() about get_item_id() method
-        folder_name_choices = [(int(folder['containerId']), folder['name'])
-                               for folder in items_in_run_container if folder['itemType'] == 'Folder']
-        return folder_name_choices
+        The container tree is walked breadth-first: the items directly in ``container_id`` have
+        depth 0, the items in the containers among them have depth 1, and so on, down to (but not
+        including) ``max_depth``. The containers of each level are fetched concurrently (by at most
+        ``max_workers`` threads), and the items of a level are yielded as soon as the level has been
+        fetched, so callers can stream results. Containers that fail to load are logged and skipped.
+        """
+        if max_depth is None:
+            max_depth = get_eso_setting('container_depth', DEFAULT_CONTAINER_DEPTH)
+
+        def fetch_items(level_container_id):
+            items, _ = self._p2_call('getItems', level_container_id)
+            return items
+
+        visited = {container_id}
+        level = [container_id]
+        depth = 0
+        while level and depth < max_depth:
+            level_items = map_concurrently(fetch_items, level, max_workers=max_workers, return_exceptions=True)
+            next_level = []
+            for parent_id, items in zip(level, level_items):
+                if isinstance(items, Exception):
+                    logger.error(f'walk_container: error fetching items of container {parent_id}: {items}')
+                    continue
+                for item in items:
+                    yield depth, parent_id, item
+                    if item['itemType'] in CONTAINER_ITEM_TYPES:
+                        child_id = get_item_id(item)
+                        if child_id not in visited:
+                            visited.add(child_id)
+                            next_level.append(child_id)
+            level = next_level
+            depth += 1
+
+    def container_tree_choices(self, container_id, max_depth=None, max_workers=None):
+        """Return the form.ChoiceField tuples for every container (Folder, Concatenation, Group, ...)
+        below ``container_id``, flattened in tree order, with nested containers indented
+        (see ``walk_container()``).
+        """
+        children = {}
+        for _, parent_id, item in self.walk_container(container_id, max_depth=max_depth, max_workers=max_workers):
+            if item['itemType'] in CONTAINER_ITEM_TYPES:
+                children.setdefault(parent_id, []).append(item)
+
+        choices = []
+        added = {container_id}
+
+        def add_choices(parent_id, depth):
+            for item in children.get(parent_id, []):
+                item_id = get_item_id(item)
+                if item_id in added:
+                    continue
+                added.add(item_id)
+                label = item['name'] if item['itemType'] == 'Folder' else f"{item['name']} : {item['itemType']}"
+                choices.append((item_id, CHOICE_INDENT * depth + label))
+                add_choices(item_id, depth + 1)
+        add_choices(container_id, 0)
+        return choices
 
     # TODO: consider renaming this to folder_content_choices
     def folder_item_choices(self, folder_id):
@@ -105,27 +403,16 @@ class ESOAPI:
         Creates the list of form.ChoiceField tuples from the result.
         """
         try:
-            items_in_folder, _ = self.api2.getItems(folder_id)
+            items_in_folder, _ = self._p2_call('getItems', folder_id)
         except p2api.p2api.P2Error as e:
+            if is_outage(e):
+                raise  # let the caller fall back to the last known choices
             logger.error(f'API Error: {e}')
             return [(0, 'Are there any items in this folder?')]
         # logger.debug(f'items: {items_in_folder}')
 
-        # TODO: we might need a get_item_id() method that uses the itemType to determing the
-        # dict key of the id: OB -> obId, Folder -> containerId, etc.
-        # folder_item_choices = [(item['obId'], f"{item['name']} : {item['itemType']} : {item['obStatus']}")
-        #                        for item in items_in_folder]
-
-        # or this loop where we try obID and fall back to containerId on KeyError
-        folder_item_choices = []
-        for item in items_in_folder:
-            try:
-                folder_item_choices.append((int(item['obId']), f"{item['name']} : {item['itemType']}"))
-            except KeyError as e:
-                logger.debug(f'{__name__}: folder_item_choices: KeyError: {e} for item: {item}')
-
-                # the item doesn't have an obId, so fallback and assume it has a containerId to use
-                folder_item_choices.append((item['containerId'], f"{item['name']} : {item['itemType']}"))
+        folder_item_choices = [(get_item_id(item), f"{item['name']} : {item['itemType']}")
+                               for item in items_in_folder]
         # logger.debug(f'folder_item_choices: {folder_item_choices}')
         return folder_item_choices
 
@@ -138,17 +425,18 @@ class ESOAPI:
         Creates the list of form.ChoiceField tuples from the result.
         """
         try:
-            items_in_folder, _ = self.api2.getItems(folder_id)
+            items_in_folder, _ = self._p2_call('getItems', folder_id)
         except p2api.p2api.P2Error as e:
+            if is_outage(e):
+                raise  # let the caller fall back to the last known choices
             logger.error(f'API Error: {e}')
             return [(0, 'Are there any items in this folder?')]
 
-        # TODO: we might need a get_item_id() method that uses the itemType to determing the
-        # dict key of the id: OB -> obId, Folder -> containerId, etc.
-        # folder_item_choices = [(item['obId'], f"{item['name']} : {item['itemType']} : {item['obStatus']}")
-        #                        for item in items_in_folder]
+        return self._ob_choices(items_in_folder)
 
-        # or this loop where we try obID and fall back to containerId on KeyError
+    @staticmethod
+    def _ob_choices(items_in_folder):
+        """Return the form.ChoiceField tuples for the Observation Blocks among the items of a folder."""
         folder_ob_choices = []
         for item in items_in_folder:
             try:
@@ -160,10 +448,46 @@ class ESOAPI:
 
         return folder_ob_choices
 
+    def observing_run_tree(self, observing_run_id, max_workers=None):
+        """Return the folders of an observing run together with the Observation Blocks in each folder.
+
+        The folders are the flattened ``container_tree_choices()`` of the run, so nested containers
+        are included. The contents of the folders are fetched concurrently, by at most ``max_workers`` threads.
+        The result is a compact dict, suitable for JSON, of the form::
+
+            {'runId': 60925301, 'containerId': 1234,
+             'folders': [{'id': 2345, 'name': 'Folder', 'observation_blocks': [[3456, 'OB : OB'], ...]},
+                         {'id': 4567, 'name': 'Empty', 'observation_blocks': [], 'error': '...'}]}
+
+        A folder whose contents could not be fetched has an ``error`` instead of failing the whole tree.
+        """
+        observing_run, _ = self._p2_call('getRun', observing_run_id)
+        container_id = observing_run['containerId']
+        folder_name_choices = self.container_tree_choices(container_id, max_workers=max_workers)
+
+        def fetch_folder(folder_choice):
+            items_in_folder, _ = self._p2_call('getItems', folder_choice[0])
+            return self._ob_choices(items_in_folder)
+
+        folder_contents = map_concurrently(fetch_folder, folder_name_choices,
+                                           max_workers=max_workers, return_exceptions=True)
+
+        folders = []
+        for (folder_id, folder_name), contents in zip(folder_name_choices, folder_contents):
+            folder = {'id': folder_id, 'name': folder_name, 'observation_blocks': []}
+            if isinstance(contents, Exception):
+                logger.error(f'observing_run_tree: error fetching folder {folder_id}: {contents}')
+                folder['error'] = str(contents)
+            else:
+                folder['observation_blocks'] = [list(choice) for choice in contents]
+            folders.append(folder)
+
+        return {'runId': int(observing_run_id), 'containerId': int(container_id), 'folders': folders}
+
     def getOB(self, ob_id):
         """Return the observation block corresponding to the ob_id.
 
         This is a straight passthrough (wrapper) to the ESO Phase2 API method `getOB()`.
         """
-        ob, _ = self.api2.getOB(ob_id)
+        ob, _ = self._p2_call('getOB', ob_id)
         return ob
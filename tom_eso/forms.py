@@ -1,7 +1,14 @@
+import copy
+import string
+
 from django import forms
+from tom_eso.eso import ESOObservationForm, lazy_choices
 from tom_eso.models import ESOProfile
 from tom_common.session_utils import set_encrypted_field, get_encrypted_field
 
+# the fields that can be used in the observation block name template of ESOBulkObservationBlockForm
+OB_NAME_TEMPLATE_FIELDS = ('target_name', 'target_id')
+
 
 class ESOProfileForm(forms.ModelForm):
 
@@ -48,3 +55,64 @@ class ESOProfileForm(forms.ModelForm):
         if commit and not self.errors:
             instance.save()
         return instance
+
+
+class ESOBulkObservationBlockForm(forms.Form):
+    """Form for creating an observation block for each of the targets in a TargetList.
+
+    The observing run -> folder -> observation block dropdowns are those of the ESOObservationForm
+    (with the same HTMX endpoints); like that form, this one gets its choices from the facility.
+    """
+    p2_observing_run = copy.deepcopy(ESOObservationForm.base_fields['p2_observing_run'])
+    p2_folder_name = copy.deepcopy(ESOObservationForm.base_fields['p2_folder_name'])
+    p2_folder_name.required = True
+    observation_blocks = copy.deepcopy(ESOObservationForm.base_fields['observation_blocks'])
+    observation_block_search = copy.deepcopy(ESOObservationForm.base_fields['observation_block_search'])
+
+    ob_name_template = forms.CharField(
+        label='Observation Block Name',
+        initial='{target_name}',
+        help_text='{target_name} and {target_id} are replaced by the name and id of each target.'
+    )
+    targets = forms.ModelMultipleChoiceField(
+        queryset=None,  # set in __init__
+        widget=forms.CheckboxSelectMultiple,
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.facility = kwargs.pop('facility')
+        targets = kwargs.pop('targets')
+        super().__init__(*args, **kwargs)
+
+        self.fields['targets'].queryset = targets
+        self.fields['targets'].initial = [target.pk for target in targets]
+        self.fields['p2_observing_run'].choices = lazy_choices(self.facility.get_observing_run_choices)
+
+        # a bound form must be validated against the choices for the selected run and folder
+        try:
+            observing_run_id = int(self.data.get('p2_observing_run'))
+            self.fields['p2_folder_name'].choices = lazy_choices(self.facility.get_folder_name_choices,
+                                                                 observing_run_id)
+        except (TypeError, ValueError):
+            pass
+        try:
+            folder_id = int(self.data.get('p2_folder_name'))
+            self.fields['observation_blocks'].choices = lazy_choices(self.facility.get_observation_block_choices,
+                                                                     folder_id)
+        except (TypeError, ValueError):
+            pass
+
+    def clean_ob_name_template(self):
+        ob_name_template = self.cleaned_data['ob_name_template']
+        # only the bare fields are allowed: no attributes, indexes, conversions or format specs
+        try:
+            fields = list(string.Formatter().parse(ob_name_template))
+        except ValueError as ex:
+            raise forms.ValidationError(f'Invalid observation block name template: {ex}')
+        for _, field_name, format_spec, conversion in fields:
+            if field_name is None:
+                continue
+            if field_name not in OB_NAME_TEMPLATE_FIELDS or format_spec or conversion:
+                raise forms.ValidationError(
+                    'Invalid observation block name template: only {target_name} and {target_id} can be used')
+        return ob_name_template
@@ -0,0 +1,59 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from tom_eso.eso import ESOFacility
+from tom_eso.mirror import P2MirrorSync
+from tom_eso.models import ESOProfile
+
+
+class Command(BaseCommand):
+    """
+    Syncs the local mirror of the ESO P2 accounts of the users with an ESOProfile (see tom_eso/mirror.py).
+    Each P2 account is synced once, however many ESOProfiles use it. A username can be specified to sync only
+    the P2 account used by that user (which may be the default account from settings.FACILITIES).
+    """
+
+    help = 'Syncs the local mirror of the ESO P2 observing runs, folders and observation blocks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--username',
+            required=False,
+            help='The username of the user whose P2 account should be synced'
+        )
+
+    def handle(self, *args, **options):
+        if options.get('username'):
+            try:
+                users = [User.objects.get(username=options['username'])]
+            except User.DoesNotExist:
+                raise CommandError('Invalid username provided')
+        else:
+            users = [eso_profile.user for eso_profile in ESOProfile.objects.select_related('user')]
+
+        synced_accounts = set()
+        failures = 0
+        for user in users:
+            facility = ESOFacility()
+            facility.set_user(user)
+            if facility.eso_api is None:
+                self.stderr.write(f'No usable ESO credentials for {user.username} ({facility.credential_status})')
+                failures += 1
+                continue
+
+            account = (facility.eso_api.environment, facility.eso_api.username)
+            if account in synced_accounts:
+                continue
+            synced_accounts.add(account)
+            try:
+                stats = P2MirrorSync(facility.eso_api).sync()
+            except Exception as ex:
+                self.stderr.write(f'Error syncing P2 account {account[1]} ({account[0]}): {ex}')
+                failures += 1
+                continue
+            self.stdout.write(f'Synced P2 account {account[1]} ({account[0]}): {stats}')
+            failures += bool(stats['errors'])
+
+        if failures:
+            return f'Sync completed with {failures} error(s)'
+        return 'Sync completed successfully'
@@ -0,0 +1,240 @@
+"""
+Metrics of what tom_eso does with the ESO API: counters (throttled calls, retries, errors,
+cache hits, logins, ...) and latency histograms, labelled e.g. by P2 method and environment::
+
+    metrics.increment('p2_calls_retried_total', method='getItems', environment='demo')
+    metrics.observe('p2_request_duration_seconds', 0.25, method='getItems', environment='demo')
+    metrics.get_counter('p2_calls_retried_total', method='getItems', environment='demo')
+
+The metrics are collected per process. So that a scrape of the ``tom_eso:metrics`` endpoint
+(which any one worker may serve) reports the metrics of all the workers, each process publishes
+a snapshot of its metrics to the Django cache (at most every ``publish_interval`` seconds), and
+the endpoint adds up the snapshots of all the processes (see ``collect()``). This needs a cache
+backend shared by the workers (e.g. Redis or Memcached; the default local-memory cache is per-process).
+
+The metrics are configured with the optional ``metrics`` dictionary in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'metrics': {
+            'cache_alias': 'default',  # the settings.CACHES entry to publish the snapshots to
+            'publish_interval': 10,  # seconds
+            'token': None,  # the bearer token that scrapes must send (without it, only staff users have access)
+        },
+    }
+"""
+import bisect
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.core.cache import caches
+
+from tom_eso.conf import get_eso_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_ALIAS = 'default'
+DEFAULT_PUBLISH_INTERVAL = 10  # seconds
+SNAPSHOT_TIMEOUT = 60 * 60  # seconds; the snapshots of processes that have stopped expire after this
+KEY_PREFIX = 'tom_eso:metrics'
+METRIC_NAME_PREFIX = 'tom_eso_'
+
+# upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# the help text of the metrics, for the Prometheus exposition format
+METRIC_HELP = {
+    'p2_request_duration_seconds': 'Duration of the requests made to the ESO P2 API.',
+    'p2_request_errors_total': 'Requests to the ESO P2 API that failed.',
+    'p2_cache_hits_total': 'P2 calls served from the response cache (including revalidated responses).',
+    'p2_cache_misses_total': 'P2 calls that were not in the response cache (or had changed).',
+    'p2_logins_total': 'Logins to the ESO Phase 1 and Phase 2 APIs.',
+    'p2_login_errors_total': 'Logins to the ESO Phase 1 and Phase 2 APIs that failed.',
+    'p2_login_duration_seconds': 'Duration of the logins to the ESO Phase 1 and Phase 2 APIs.',
+    'p2_calls_throttled_total': 'P2 calls that waited for the rate limiter.',
+    'p2_calls_retried_total': 'P2 calls retried after a transient failure.',
+    'p2_calls_coalesced_total': 'P2 calls that shared an identical call already in flight.',
+}
+
+# identifies this process's snapshot in the cache
+PROCESS_ID = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+_counters = {}  # (name, labels) -> count
+_histograms = {}  # (name, labels) -> [bucket upper bounds, bucket counts, sum, count]
+_lock = threading.Lock()
+_published_at = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    """Add ``amount`` to the counter ``name`` with the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    _maybe_publish()
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """Record ``value`` (e.g. a duration in seconds) in the histogram ``name`` with the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [tuple(buckets), [0] * len(buckets), 0.0, 0]
+        bucket = bisect.bisect_left(histogram[0], value)
+        if bucket < len(histogram[1]):
+            histogram[1][bucket] += 1
+        histogram[2] += value
+        histogram[3] += 1
+    _maybe_publish()
+
+
+@contextmanager
+def timed(name, **labels):
+    """Record the duration of the ``with`` block (even if it raises) in the histogram ``name``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def get_counter(name, **labels):
+    """Return the value of the counter ``name`` with exactly the given labels (0 if it was never incremented)."""
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+
+def get_histogram(name, **labels):
+    """Return the (bucket upper bounds, bucket counts, sum, count) of the histogram ``name`` with
+    exactly the given labels, or None if nothing was recorded in it.
+    """
+    with _lock:
+        histogram = _histograms.get(_key(name, labels))
+        return None if histogram is None else (histogram[0], list(histogram[1]), histogram[2], histogram[3])
+
+
+def snapshot():
+    """Return a snapshot of this process's metrics, as a dict of counters and histograms."""
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'histograms': {key: (bounds, list(counts), total, count)
+                           for key, (bounds, counts, total, count) in _histograms.items()},
+        }
+
+
+def get_counters():
+    """Return a snapshot of all the counters, as a dict of {(name, ((label, value), ...)): count}."""
+    return snapshot()['counters']
+
+
+def reset():
+    """Reset all the metrics of this process (for tests)."""
+    global _published_at
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _published_at = None
+
+
+def _get_cache():
+    return caches[get_eso_setting('metrics', {}).get('cache_alias', DEFAULT_CACHE_ALIAS)]
+
+
+def _maybe_publish():
+    interval = get_eso_setting('metrics', {}).get('publish_interval', DEFAULT_PUBLISH_INTERVAL)
+    if _published_at is None or time.monotonic() - _published_at >= interval:
+        publish()
+
+
+def publish():
+    """Publish this process's metrics snapshot to the cache, for ``collect()``."""
+    global _published_at
+    _published_at = time.monotonic()
+    try:
+        cache = _get_cache()
+        cache.set(f'{KEY_PREFIX}:process:{PROCESS_ID}', snapshot(), SNAPSHOT_TIMEOUT)
+        # the index of the processes isn't updated atomically, but every process re-adds itself when it publishes
+        processes = cache.get(f'{KEY_PREFIX}:processes') or []
+        if PROCESS_ID not in processes:
+            cache.set(f'{KEY_PREFIX}:processes', processes + [PROCESS_ID], None)
+    except Exception as ex:
+        logger.warning(f'metrics.publish: cache unavailable: {ex}')
+
+
+def collect():
+    """Return the metrics of all the processes (publishing to the same cache), added up.
+
+    Snapshots that have expired are dropped from the index of processes.
+    """
+    publish()
+    merged = {'counters': {}, 'histograms': {}}
+    try:
+        cache = _get_cache()
+        processes = cache.get(f'{KEY_PREFIX}:processes') or []
+        snapshots = cache.get_many([f'{KEY_PREFIX}:process:{process_id}' for process_id in processes])
+        live_processes = [process_id for process_id in processes
+                          if f'{KEY_PREFIX}:process:{process_id}' in snapshots]
+        if live_processes != processes:
+            cache.set(f'{KEY_PREFIX}:processes', live_processes, None)
+    except Exception as ex:
+        logger.warning(f'metrics.collect: cache unavailable, reporting this process only: {ex}')
+        snapshots = {PROCESS_ID: snapshot()}
+
+    for process_snapshot in snapshots.values():
+        for key, count in process_snapshot['counters'].items():
+            merged['counters'][key] = merged['counters'].get(key, 0) + count
+        for key, (bounds, counts, total, count) in process_snapshot['histograms'].items():
+            histogram = merged['histograms'].get(key)
+            if histogram is None or histogram[0] != bounds:
+                merged['histograms'][key] = (bounds, list(counts), total, count)
+            else:
+                merged['histograms'][key] = (bounds, [a + b for a, b in zip(histogram[1], counts)],
+                                             histogram[2] + total, histogram[3] + count)
+    return merged
+
+
+def _format_labels(labels, **extra_labels):
+    labels = list(labels) + list(extra_labels.items())
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def render_prometheus(metrics=None):
+    """Return the ``metrics`` (by default, those of all the processes) in the Prometheus text format."""
+    if metrics is None:
+        metrics = collect()
+
+    lines = []
+    for metric_type, series in (('counter', metrics['counters']), ('histogram', metrics['histograms'])):
+        for name in sorted({name for name, _ in series}):
+            full_name = METRIC_NAME_PREFIX + name
+            if name in METRIC_HELP:
+                lines.append(f'# HELP {full_name} {METRIC_HELP[name]}')
+            lines.append(f'# TYPE {full_name} {metric_type}')
+            for (series_name, labels), value in sorted(series.items()):
+                if series_name != name:
+                    continue
+                if metric_type == 'counter':
+                    lines.append(f'{full_name}{_format_labels(labels)} {value}')
+                    continue
+                bounds, counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(bounds, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{full_name}_bucket{_format_labels(labels, le=repr(float(bound)))} {cumulative}')
+                lines.append(f'{full_name}_bucket{_format_labels(labels, le="+Inf")} {count}')
+                lines.append(f'{full_name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'{full_name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,115 @@
+"""
+tom_eso middleware.
+
+``ServerTimingMiddleware`` adds a ``Server-Timing`` header to the responses of requests that used
+tom_eso. ``ESOFacilityMiddleware`` shares one configured ``ESOFacility`` between everything that
+needs one during a request (see tom_eso/request_facility.py). To use them, add them to
+``settings.MIDDLEWARE`` (anywhere after the authentication middleware)::
+
+    MIDDLEWARE = [
+        ...
+        'tom_eso.middleware.ServerTimingMiddleware',
+        'tom_eso.middleware.ESOFacilityMiddleware',
+    ]
+
+With the Server-Timing middleware, browser devtools show how long each phase of a request took
+(see tom_eso/timing.py). The breakdown is also logged at DEBUG level by the ``tom_eso.middleware`` logger.
+"""
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.asyncio import async_unsafe
+from django.utils.functional import SimpleLazyObject
+
+from tom_eso import request_facility, timing
+
+logger = logging.getLogger(__name__)
+
+
+class ServerTimingMiddleware:
+    """Collect the timings of each request, and report them if any tom_eso code was timed."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        timings, token = timing.start()
+        start_time = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            timing.stop(token)
+        return self._add_server_timing(request, response, timings, time.perf_counter() - start_time)
+
+    async def __acall__(self, request):
+        timings, token = timing.start()
+        start_time = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            timing.stop(token)
+        return self._add_server_timing(request, response, timings, time.perf_counter() - start_time)
+
+    def _add_server_timing(self, request, response, timings, total):
+        if not timings.phases:
+            return response  # not a tom_eso request
+        server_timing = timings.server_timing(total)
+        if response.has_header('Server-Timing'):
+            server_timing = f'{response["Server-Timing"]}, {server_timing}'
+        response['Server-Timing'] = server_timing
+        logger.debug(f'{request.method} {request.path}: {server_timing}')
+        return response
+
+
+def _lazy_request_facility(request):
+    """Return ``request.eso_facility``: the facility of the request, set up when first used.
+
+    Setting the facility up makes blocking calls (database queries, an ESO login), so it can't be
+    done from the event loop: async code awaits ``aget_request_facility(request)`` instead.
+    """
+    return SimpleLazyObject(async_unsafe(
+        'request.eso_facility cannot be used from async code: use aget_request_facility(request)'
+    )(lambda: request_facility.get_request_facility(request)))
+
+
+class ESOFacilityMiddleware:
+    """Make each request the current request for tom_eso, so that the ``ESOFacility`` instances
+    created during the request share one configuration, and add the (lazily set up) facility to
+    the request as ``request.eso_facility``.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        request.eso_facility = _lazy_request_facility(request)
+        token = request_facility.start_request(request)
+        try:
+            return self.get_response(request)
+        finally:
+            request_facility.end_request(token)
+
+    async def __acall__(self, request):
+        request.eso_facility = _lazy_request_facility(request)
+        token = request_facility.start_request(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            request_facility.end_request(token)
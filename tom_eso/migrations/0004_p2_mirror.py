@@ -0,0 +1,103 @@
+# Generated by Django 4.2.27 on 2026-10-17 11:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_eso', '0003_alter_esoprofile_p2_username'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ESOP2Account',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('p2_environment', models.CharField(choices=[('demo', 'Demo'), ('production', 'Production'), ('production_lasilla', 'Production Lasilla')], max_length=32)),
+                ('p2_username', models.CharField(max_length=255)),
+                ('runs_version', models.CharField(blank=True, max_length=255, null=True)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ESOP2ObservingRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.BigIntegerField()),
+                ('container_id', models.BigIntegerField()),
+                ('prog_id', models.CharField(max_length=64)),
+                ('telescope', models.CharField(max_length=64)),
+                ('instrument', models.CharField(max_length=64)),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('items_version', models.CharField(blank=True, max_length=255, null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='observing_runs', to='tom_eso.esop2account')),
+            ],
+            options={
+                'ordering': ['account', 'position'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ESOP2ObservationBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ob_id', models.BigIntegerField()),
+                ('run_id', models.BigIntegerField()),
+                ('container_id', models.BigIntegerField()),
+                ('name', models.CharField(max_length=255)),
+                ('item_type', models.CharField(max_length=32)),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='observation_blocks', to='tom_eso.esop2account')),
+            ],
+            options={
+                'ordering': ['account', 'container_id', 'position'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ESOP2Container',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('container_id', models.BigIntegerField()),
+                ('run_id', models.BigIntegerField()),
+                ('parent_id', models.BigIntegerField()),
+                ('name', models.CharField(max_length=255)),
+                ('item_type', models.CharField(max_length=32)),
+                ('depth', models.PositiveSmallIntegerField(default=0)),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('items_version', models.CharField(blank=True, max_length=255, null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='containers', to='tom_eso.esop2account')),
+            ],
+            options={
+                'ordering': ['account', 'run_id', 'depth', 'position'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='esop2account',
+            constraint=models.UniqueConstraint(fields=('p2_environment', 'p2_username'), name='unique_eso_p2_account'),
+        ),
+        migrations.AddConstraint(
+            model_name='esop2observingrun',
+            constraint=models.UniqueConstraint(fields=('account', 'run_id'), name='unique_eso_p2_observing_run'),
+        ),
+        migrations.AddIndex(
+            model_name='esop2observationblock',
+            index=models.Index(fields=['account', 'container_id', 'position'], name='eso_p2_ob_container_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='esop2observationblock',
+            index=models.Index(fields=['account', 'run_id'], name='eso_p2_ob_run_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='esop2observationblock',
+            constraint=models.UniqueConstraint(fields=('account', 'ob_id'), name='unique_eso_p2_observation_block'),
+        ),
+        migrations.AddIndex(
+            model_name='esop2container',
+            index=models.Index(fields=['account', 'run_id'], name='eso_p2_container_run_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='esop2container',
+            constraint=models.UniqueConstraint(fields=('account', 'container_id'), name='unique_eso_p2_container'),
+        ),
+    ]
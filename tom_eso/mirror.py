@@ -0,0 +1,326 @@
+"""
+A local database mirror of the observing runs, containers and observation blocks of P2 accounts.
+
+``P2MirrorSync`` pulls ``getRuns()`` and the ``getItems()`` of every container in the runs of a
+P2 account into the ``ESOP2*`` models. The sync is incremental: the ETag of each response is
+stored, so unchanged responses are detected with conditional requests (see
+``ESOAPI.fetch_if_changed``), and only the rows that actually changed are written, with
+``bulk_create()``, ``bulk_update()`` and a single delete per model.
+
+``P2Mirror`` serves the observation form's choice lists from the mirror (in a few queries,
+without contacting ESO) as long as the last sync is recent enough; otherwise its methods return
+None and the caller falls back to live P2 calls. The mirror also seeds the account's name index
+for the typeahead search (see ``P2Mirror.seed_name_index``), fresh or not. Run the sync
+periodically (e.g. from cron) with::
+
+    $ ./manage.py sync_eso_p2_mirror
+
+The mirror is configured with the optional ``mirror`` dictionary in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'mirror': {
+            'enabled': True,
+            'max_age': 900,  # seconds after a sync during which the mirror is used
+        },
+    }
+"""
+import logging
+import time
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from tom_eso.concurrency import map_concurrently
+from tom_eso.conf import get_eso_setting
+from tom_eso.eso_api import (CHOICE_INDENT, CONTAINER_ITEM_TYPES, DEFAULT_CONTAINER_DEPTH, NOT_MODIFIED,
+                             OBS_RUN_BLACK_LIST, get_item_id)
+from tom_eso.models import ESOP2Account, ESOP2Container, ESOP2ObservationBlock, ESOP2ObservingRun
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE = 15 * 60  # seconds
+
+# the fields of each mirror model that a sync compares and writes
+RUN_FIELDS = ['container_id', 'prog_id', 'telescope', 'instrument', 'position', 'items_version']
+CONTAINER_FIELDS = ['run_id', 'parent_id', 'name', 'item_type', 'depth', 'position', 'items_version']
+OB_FIELDS = ['run_id', 'container_id', 'name', 'item_type', 'position']
+
+
+class P2Mirror:
+    """Read the choice lists of a P2 account from its local mirror.
+
+    Each ``*_choices()`` method returns the same choices as the corresponding ``ESOAPI`` method,
+    or None if the mirror is disabled, not fresh, or doesn't have the requested data.
+    """
+
+    def __init__(self, environment, username, enabled=True, max_age=DEFAULT_MAX_AGE):
+        self.environment = environment
+        self.username = username
+        self.enabled = enabled
+        self.max_age = max_age
+
+    @cached_property
+    def account(self):
+        return ESOP2Account.objects.filter(p2_environment=self.environment, p2_username=self.username).first()
+
+    def age(self):
+        """Return the number of seconds since the last complete sync, or None if there hasn't been one."""
+        if self.account is None or self.account.synced_at is None:
+            return None
+        return (timezone.now() - self.account.synced_at).total_seconds()
+
+    def is_fresh(self):
+        age = self.age()
+        return self.enabled and age is not None and age <= self.max_age
+
+    def freshness(self):
+        """Return a dict describing how up to date the mirror is (for display)."""
+        return {
+            'synced_at': self.account.synced_at if self.account else None,
+            'age': self.age(),
+            'is_fresh': self.is_fresh(),
+        }
+
+    def observing_run_choices(self):
+        if not self.is_fresh():
+            return None
+        return [(run.run_id, str(run)) for run in self.account.observing_runs.all()
+                if run.run_id not in OBS_RUN_BLACK_LIST]
+
+    def folder_name_choices(self, observing_run_id, max_depth=None):
+        """Return the choices of ``ESOAPI.folder_name_choices()``: the run's containers, indented, in tree order."""
+        if not self.is_fresh():
+            return None
+        if max_depth is None:
+            max_depth = get_eso_setting('container_depth', DEFAULT_CONTAINER_DEPTH)
+        run = self.account.observing_runs.filter(run_id=observing_run_id, items_version__isnull=False).first()
+        if run is None:
+            return None
+
+        children = {}
+        for container in self.account.containers.filter(run_id=run.run_id, depth__lt=max_depth):
+            children.setdefault(container.parent_id, []).append(container)
+
+        choices = []
+        added = {run.container_id}
+
+        def add_choices(parent_id, depth):
+            for container in children.get(parent_id, []):
+                if container.container_id in added:
+                    continue
+                added.add(container.container_id)
+                label = container.name if container.item_type == 'Folder' else str(container)
+                choices.append((container.container_id, CHOICE_INDENT * depth + label))
+                add_choices(container.container_id, depth + 1)
+        add_choices(run.container_id, 0)
+        return choices
+
+    def observation_block_choices(self, container_id):
+        """Return the choices of ``ESOAPI.folder_ob_choices()``: the observation blocks in the container."""
+        if not self.is_fresh():
+            return None
+        if not self.account.containers.filter(container_id=container_id, items_version__isnull=False).exists():
+            return None
+        return [(ob.ob_id, str(ob)) for ob in self.account.observation_blocks.filter(container_id=container_id)]
+
+    def seed_name_index(self, index):
+        """Seed the account's ``NameIndex`` (see tom_eso/name_index.py) with the runs, containers and
+        observation blocks in the mirror, unless it already has been since the last sync.
+
+        This reads the mirror whether or not it is fresh: the index keeps what it learnt from P2
+        responses since, and a stale mirror is still the most complete list of names there is.
+        """
+        if self.account is None or self.account.synced_at is None or index.seeded_from == self.account.synced_at:
+            return
+        runs = [{'runId': run_id, 'containerId': container_id}
+                for run_id, container_id in self.account.observing_runs.values_list('run_id', 'container_id')]
+        container_items = {run['containerId']: [] for run in runs}
+        for container_id, parent_id, name, item_type in self.account.containers.order_by('position').values_list(
+                'container_id', 'parent_id', 'name', 'item_type'):
+            container_items.setdefault(parent_id, []).append(
+                {'containerId': container_id, 'name': name, 'itemType': item_type})
+            container_items.setdefault(container_id, [])
+        for ob_id, container_id, name, item_type in self.account.observation_blocks.order_by(
+                'position').values_list('ob_id', 'container_id', 'name', 'item_type'):
+            container_items.setdefault(container_id, []).append({'obId': ob_id, 'name': name, 'itemType': item_type})
+        index.seed(runs, container_items, self.account.synced_at, updated_at=self.account.synced_at.timestamp())
+        logger.info(f'P2Mirror: seeded the name index of {self.account} with {len(index)} names')
+
+    def invalidate_container(self, container_id):
+        """Mark the items of a container (or run container) as out of date, until the next sync."""
+        if self.account is None:
+            return
+        self.account.containers.filter(container_id=container_id).update(items_version=None)
+        self.account.observing_runs.filter(container_id=container_id).update(items_version=None)
+
+
+def get_p2_mirror(environment, username):
+    """Return a ``P2Mirror`` for the account, configured from the settings."""
+    return P2Mirror(environment, username, **get_eso_setting('mirror', {}))
+
+
+class P2MirrorSync:
+    """Bring the local mirror of the P2 account of an ``ESOAPI`` up to date."""
+
+    def __init__(self, eso_api, max_depth=None, max_workers=None):
+        self.eso_api = eso_api
+        if max_depth is None:
+            max_depth = get_eso_setting('container_depth', DEFAULT_CONTAINER_DEPTH)
+        self.max_depth = max_depth
+        self.max_workers = max_workers
+
+    def sync(self):
+        """Sync the account's runs and their containers and observation blocks. Return a dict of statistics.
+
+        The account is only marked as synced (and so used for choices) if every P2 call succeeded;
+        the rows of containers that could not be fetched are kept as they were.
+        """
+        start = time.perf_counter()
+        self.stats = {'fetched': 0, 'not_modified': 0, 'errors': 0}
+        account, _ = ESOP2Account.objects.get_or_create(p2_environment=self.eso_api.environment,
+                                                        p2_username=self.eso_api.username)
+        runs = {run.run_id: run for run in account.observing_runs.all()}
+        containers = {container.container_id: container for container in account.containers.all()}
+        obs = {ob.ob_id: ob for ob in account.observation_blocks.all()}
+
+        run_values, runs_version = self._sync_runs(account, runs)
+        container_values, ob_values = self._sync_items(run_values, containers, obs)
+
+        with transaction.atomic():
+            counts = [
+                self._write(account, ESOP2ObservingRun, 'run_id', runs, run_values, RUN_FIELDS),
+                self._write(account, ESOP2Container, 'container_id', containers, container_values, CONTAINER_FIELDS),
+                self._write(account, ESOP2ObservationBlock, 'ob_id', obs, ob_values, OB_FIELDS),
+            ]
+            account.runs_version = runs_version
+            if not self.stats['errors']:
+                account.synced_at = timezone.now()
+            account.save()
+
+        for name, index in [('created', 0), ('updated', 1), ('deleted', 2)]:
+            self.stats[name] = sum(count[index] for count in counts)
+        self.stats['wall_time'] = time.perf_counter() - start
+        logger.info(f'P2MirrorSync: synced {account}: {self.stats}')
+        return self.stats
+
+    def _count(self, result):
+        if isinstance(result, Exception):
+            self.stats['errors'] += 1
+        else:
+            self.stats['not_modified' if result is NOT_MODIFIED else 'fetched'] += 1
+
+    def _sync_runs(self, account, runs):
+        """Return the field values of the account's runs (keyed by runId) and the getRuns() version."""
+        result = self.eso_api.fetch_if_changed(account.runs_version, 'getRuns')
+        self._count(result)
+        if result is NOT_MODIFIED:
+            return {run_id: {field: getattr(run, field) for field in RUN_FIELDS}
+                    for run_id, run in runs.items()}, account.runs_version
+
+        observing_runs, runs_version = result
+        run_values = {}
+        for position, observing_run in enumerate(observing_runs):
+            run_id = int(observing_run['runId'])
+            container_id = observing_run.get('containerId')
+            if container_id is None:
+                container_id = self.eso_api._p2_call('getRun', run_id)[0]['containerId']
+            # the version of the items is kept (for a conditional getItems) unless the run's container changed
+            known_run = runs.get(run_id)
+            items_version = known_run.items_version if known_run and known_run.container_id == container_id else None
+            run_values[run_id] = {
+                'container_id': int(container_id),
+                'prog_id': observing_run['progId'],
+                'telescope': observing_run['telescope'],
+                'instrument': observing_run['instrument'],
+                'position': position,
+                'items_version': items_version,
+            }
+        return run_values, runs_version
+
+    def _sync_items(self, run_values, containers, obs):
+        """Walk the containers of the runs breadth-first (each level concurrently) and return the
+        field values of the containers and observation blocks found, keyed by containerId and obId.
+
+        A container whose items haven't changed since the last sync contributes its mirrored
+        children, which are then walked in turn (their own items might have changed).
+        """
+        children = {}  # the mirrored containers and OBs of each container, for the unchanged ones
+        for row in list(containers.values()) + list(obs.values()):
+            parent_id = row.parent_id if isinstance(row, ESOP2Container) else row.container_id
+            children.setdefault(parent_id, []).append(row)
+
+        container_values = {}
+        ob_values = {}
+        # the (container_id, run_id, field values of the container) of the level being fetched
+        level = [(values['container_id'], run_id, values) for run_id, values in run_values.items()]
+        visited = {container_id for container_id, _, _ in level}
+        depth = 0
+        while level:
+            results = map_concurrently(
+                lambda entry: self.eso_api.fetch_if_changed(entry[2]['items_version'], 'getItems', entry[0]),
+                level, max_workers=self.max_workers, return_exceptions=True)
+            next_level = []
+            for (container_id, run_id, values), result in zip(level, results):
+                self._count(result)
+                if isinstance(result, Exception):
+                    logger.error(f'P2MirrorSync: error fetching items of container {container_id}: {result}')
+                    result = NOT_MODIFIED  # keep what is mirrored
+                if result is NOT_MODIFIED:
+                    rows = sorted(children.get(container_id, []), key=lambda row: row.position)
+                    items = [self._row_item(row) for row in rows]
+                else:
+                    items, values['items_version'] = result
+
+                for position, item in enumerate(items):
+                    item_id = get_item_id(item)
+                    if item['itemType'] not in CONTAINER_ITEM_TYPES:
+                        ob_values[item_id] = {'run_id': run_id, 'container_id': container_id, 'name': item['name'],
+                                              'item_type': item['itemType'], 'position': position}
+                    elif depth < self.max_depth and item_id not in visited:
+                        visited.add(item_id)
+                        known_container = containers.get(item_id)
+                        child_values = {
+                            'run_id': run_id, 'parent_id': container_id, 'name': item['name'],
+                            'item_type': item['itemType'], 'depth': depth, 'position': position,
+                            'items_version': known_container.items_version if known_container else None,
+                        }
+                        container_values[item_id] = child_values
+                        next_level.append((item_id, run_id, child_values))
+            level = next_level
+            depth += 1
+        return container_values, ob_values
+
+    @staticmethod
+    def _row_item(row):
+        """Return a mirrored row as the P2 item it was made from."""
+        if isinstance(row, ESOP2Container):
+            return {'containerId': row.container_id, 'name': row.name, 'itemType': row.item_type}
+        return {'obId': row.ob_id, 'name': row.name, 'itemType': row.item_type}
+
+    @staticmethod
+    def _write(account, model, id_field, rows, values, fields):
+        """Create, update and delete ``model`` rows so they match ``values``, writing only the changed rows.
+
+        Return the numbers of rows (created, updated, deleted).
+        """
+        new_rows = []
+        changed_rows = []
+        for item_id, item_values in values.items():
+            row = rows.get(item_id)
+            if row is None:
+                new_rows.append(model(account=account, **{id_field: item_id}, **item_values))
+            elif any(getattr(row, field) != value for field, value in item_values.items()):
+                for field, value in item_values.items():
+                    setattr(row, field, value)
+                changed_rows.append(row)
+        removed_ids = [row.pk for item_id, row in rows.items() if item_id not in values]
+
+        if removed_ids:
+            model.objects.filter(pk__in=removed_ids).delete()
+        if new_rows:
+            model.objects.bulk_create(new_rows)
+        if changed_rows:
+            model.objects.bulk_update(changed_rows, fields)
+        return len(new_rows), len(changed_rows), len(removed_ids)
@@ -61,3 +61,96 @@ class ESOProfile(EncryptableModelMixin, models.Model):
 
     def __str__(self) -> str:
         return f'{self.user.username} ESO Profile: {self.p2_username}'
+
+
+class ESOP2Account(models.Model):
+    """A P2 account (environment and username) whose runs, containers and OBs are mirrored locally.
+
+    The mirror is filled and kept up to date by ``tom_eso.mirror.P2MirrorSync``. Several
+    ESOProfiles (or the settings.FACILITIES defaults) using the same account share its mirror.
+    """
+    p2_environment = models.CharField(max_length=32, choices=ESOP2Environment.choices())
+    p2_username = models.CharField(max_length=255)
+
+    runs_version = models.CharField(max_length=255, null=True, blank=True)  # the ETag of the last getRuns()
+    synced_at = models.DateTimeField(null=True, blank=True)  # when the last complete sync finished
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['p2_environment', 'p2_username'], name='unique_eso_p2_account'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.p2_username} ({self.p2_environment})'
+
+
+class ESOP2ObservingRun(models.Model):
+    """The local mirror of a P2 observing run (``getRuns()``)."""
+    account = models.ForeignKey(ESOP2Account, on_delete=models.CASCADE, related_name='observing_runs')
+    run_id = models.BigIntegerField()
+    container_id = models.BigIntegerField()
+    prog_id = models.CharField(max_length=64)
+    telescope = models.CharField(max_length=64)
+    instrument = models.CharField(max_length=64)
+    position = models.PositiveIntegerField(default=0)  # order in the getRuns() response
+    # the ETag of the last getItems() of the run's container; None when its items must be fetched again
+    items_version = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        ordering = ['account', 'position']
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'run_id'], name='unique_eso_p2_observing_run'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.prog_id} - {self.telescope} - {self.instrument}'
+
+
+class ESOP2Container(models.Model):
+    """The local mirror of a P2 container (Folder, Concatenation, Group or TimeLink) in an observing run."""
+    account = models.ForeignKey(ESOP2Account, on_delete=models.CASCADE, related_name='containers')
+    container_id = models.BigIntegerField()
+    run_id = models.BigIntegerField()
+    parent_id = models.BigIntegerField()  # the containerId of the run, or of the parent container
+    name = models.CharField(max_length=255)
+    item_type = models.CharField(max_length=32)
+    depth = models.PositiveSmallIntegerField(default=0)  # 0 for the containers directly in the run
+    position = models.PositiveIntegerField(default=0)  # order among the items of the parent
+    # the ETag of the last getItems() of this container; None when its items must be fetched again
+    items_version = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        ordering = ['account', 'run_id', 'depth', 'position']
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'container_id'], name='unique_eso_p2_container'),
+        ]
+        indexes = [
+            models.Index(fields=['account', 'run_id'], name='eso_p2_container_run_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.name} : {self.item_type}'
+
+
+class ESOP2ObservationBlock(models.Model):
+    """The local mirror of a P2 observation (or calibration) block in a container."""
+    account = models.ForeignKey(ESOP2Account, on_delete=models.CASCADE, related_name='observation_blocks')
+    ob_id = models.BigIntegerField()
+    run_id = models.BigIntegerField()
+    container_id = models.BigIntegerField()
+    name = models.CharField(max_length=255)
+    item_type = models.CharField(max_length=32)
+    position = models.PositiveIntegerField(default=0)  # order among the items of the container
+
+    class Meta:
+        ordering = ['account', 'container_id', 'position']
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'ob_id'], name='unique_eso_p2_observation_block'),
+        ]
+        indexes = [
+            models.Index(fields=['account', 'container_id', 'position'], name='eso_p2_ob_container_idx'),
+            models.Index(fields=['account', 'run_id'], name='eso_p2_ob_run_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.name} : {self.item_type}'
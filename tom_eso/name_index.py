@@ -0,0 +1,306 @@
+"""
+An in-memory trigram index over the names of the containers and observation blocks of P2 accounts,
+for the typeahead search of ``ESOFacility.search_p2_names``.
+
+Finding an observation block with the observation form means drilling down through the observing
+run, folder and observation block dropdowns. Instead, the ``NameIndex`` of a P2 account is seeded,
+when it is first searched, with every run, container and observation block in the account's local
+mirror (see ``P2Mirror.seed_name_index`` in tom_eso/mirror.py), and seeded again whenever the
+mirror has been synced since. On top of that, every ``getRuns()``, ``getRun()`` and ``getItems()``
+response that ``ESOAPI`` receives from ESO in the process is added to the index (see
+``ESOAPI._p2_call``): the ``getItems()`` of a container replaces what the index knew about the
+container's items (from the mirror or an earlier response), so items renamed, added or deleted
+since the last sync are kept up to date as the account is browsed.
+
+Names are indexed by their trigrams (as in PostgreSQL's pg_trgm), so a lookup only looks at the
+items that have all the trigrams of the query (or, for a fuzzy match, some of them), and typically
+takes a few milliseconds for accounts with tens of thousands of items (see the ``name_index``
+benchmark). Results are ranked by match quality (an exact match, then a match at the start of the
+name, then at the start of a word, then anywhere, then a fuzzy trigram match), then by closeness
+(the shortest names containing the query, or the most similar names), and then by recency: the
+most recently added or changed items first, and the newest (highest id) items first among those.
+
+The indexes are per process, and kept for the lifetime of the process; the mirror (synced with
+``./manage.py sync_eso_p2_mirror``) is what makes them complete, and what they are rebuilt from
+after a restart.
+"""
+import heapq
+import re
+import threading
+import time
+from collections import namedtuple
+
+from tom_eso.eso_api import CONTAINER_ITEM_TYPES, get_item_id
+
+# the minimum trigram similarity of a fuzzy match (one that doesn't contain the query)
+MIN_SIMILARITY = 0.3
+# Fuzzy matches are looked for among the items having the query's rarer trigrams: those in at most
+# this fraction of the items (and at least the rarest trigram).
+FUZZY_MAX_POSTINGS_FRACTION = 0.02
+DEFAULT_LIMIT = 20
+
+# match qualities, best first
+EXACT, PREFIX, WORD_PREFIX, SUBSTRING, FUZZY = range(5)
+
+IndexedItem = namedtuple('IndexedItem', ['item_id', 'name', 'item_type', 'container_id', 'updated_at'])
+
+# A typeahead result: ``run_id`` is the observing run of the item, or None if not known (yet).
+NameMatch = namedtuple('NameMatch', ['item_id', 'name', 'item_type', 'container_id', 'run_id', 'quality',
+                                     'similarity'])
+
+# whitespace, and the other characters that separate words (all are indexed as single spaces)
+WORD_SEPARATORS = re.compile(r'[\s_\-.:/]+')
+
+
+def normalize(text):
+    """Return ``text`` as it is indexed: case-folded, with runs of whitespace and word separators
+    replaced by single spaces.
+    """
+    return WORD_SEPARATORS.sub(' ', text.casefold()).strip()
+
+
+def trigrams(text):
+    """Return the set of trigrams of the normalized ``text``, padded so that word starts count more."""
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """A trigram index over the names of the containers and observation blocks of one P2 account."""
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._items = {}  # item id -> IndexedItem
+        self._normalized_names = {}  # item id -> normalized name
+        self._trigram_counts = {}  # item id -> number of trigrams of the name
+        self._rank_keys = {}  # item id -> (name length, -updated_at, -item id): shortest, then most recent, first
+        self._postings = {}  # trigram -> set of item ids
+        self._children = {}  # container id -> set of the ids of its items
+        self._container_versions = {}  # container id -> version of the getItems() response indexed
+        self._run_containers = {}  # container id of an observing run -> run id
+        self._seeded_containers = set()  # ids of the containers whose items were last indexed by seed()
+        self.seeded_from = None  # the sync time of the mirror last seeded from (see seed())
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def add_observing_runs(self, runs):
+        """Record the top-level containers of the observing runs of a ``getRuns()`` or ``getRun()`` response."""
+        with self._lock:
+            for run in runs:
+                if run.get('containerId') is not None:
+                    self._run_containers[int(run['containerId'])] = int(run['runId'])
+
+    def update_container(self, container_id, items, version=None):
+        """Index the items of container ``container_id``, from its ``getItems()`` response.
+
+        Items that are no longer in the container are removed from the index. A response with
+        the same (non-empty) ``version`` as the one already indexed is skipped.
+        """
+        with self._lock:
+            if version and self._container_versions.get(container_id) == version:
+                return
+            self._seeded_containers.discard(container_id)
+            self._set_items(container_id, items, version, self._clock())
+
+    def seed(self, runs, container_items, seeded_from, updated_at=0.0):
+        """Index the runs (``getRuns()`` items) and the items of containers (``{container id: items}``)
+        of a snapshot of the account, such as its local mirror, taken at ``seeded_from``.
+
+        The items of the containers indexed from P2 responses are kept as they are (they are at
+        least as recent), those indexed by an earlier ``seed()`` are replaced, and those of the
+        containers no longer in the snapshot are removed. The seeded items are ranked as last
+        changed at ``updated_at``.
+        """
+        with self._lock:
+            for run in runs:
+                if run.get('containerId') is not None:
+                    self._run_containers.setdefault(int(run['containerId']), int(run['runId']))
+            seeded_containers = set()
+            for container_id, items in container_items.items():
+                if container_id in self._children and container_id not in self._seeded_containers:
+                    continue  # indexed from a P2 response
+                self._set_items(container_id, items, None, updated_at)
+                seeded_containers.add(container_id)
+            for container_id in self._seeded_containers - seeded_containers:
+                if container_id not in container_items:  # (but maybe still in another container)
+                    self._set_items(container_id, [], None, updated_at)
+                    self._children.pop(container_id, None)
+                    self._container_versions.pop(container_id, None)
+            self._seeded_containers = seeded_containers
+            self.seeded_from = seeded_from
+
+    def _set_items(self, container_id, items, version, updated_at):
+        """Make ``items`` the indexed items of container ``container_id``."""
+        item_ids = set()
+        for item in items:
+            try:
+                item_id = get_item_id(item)
+                name = item['name']
+            except (KeyError, TypeError, ValueError):
+                continue
+            item_ids.add(item_id)
+            self._add(IndexedItem(item_id, name, item['itemType'], container_id, updated_at))
+        for item_id in self._children.get(container_id, set()) - item_ids:
+            self._remove(item_id)
+        self._children[container_id] = item_ids
+        self._container_versions[container_id] = version
+
+    def _add(self, item):
+        old_item = self._items.get(item.item_id)
+        if old_item is not None:
+            if (old_item.name, old_item.item_type, old_item.container_id) == (
+                    item.name, item.item_type, item.container_id):
+                return  # unchanged, so it keeps its place in the ranking by recency
+            self._remove(item.item_id)
+        normalized_name = normalize(item.name)
+        self._items[item.item_id] = item
+        self._normalized_names[item.item_id] = normalized_name
+        name_trigrams = trigrams(normalized_name)
+        self._trigram_counts[item.item_id] = len(name_trigrams)
+        self._rank_keys[item.item_id] = (len(normalized_name), -item.updated_at, -item.item_id)
+        for trigram in name_trigrams:
+            self._postings.setdefault(trigram, set()).add(item.item_id)
+
+    def _remove(self, item_id):
+        item = self._items.pop(item_id, None)
+        if item is None:
+            return
+        del self._trigram_counts[item_id]
+        del self._rank_keys[item_id]
+        self._children.get(item.container_id, set()).discard(item_id)
+        for trigram in trigrams(self._normalized_names.pop(item_id)):
+            postings = self._postings.get(trigram)
+            if postings is not None:
+                postings.discard(item_id)
+                if not postings:
+                    del self._postings[trigram]
+        if item.item_type in CONTAINER_ITEM_TYPES:  # and the items in it
+            for child_id in self._children.pop(item_id, set()):
+                self._remove(child_id)
+            self._container_versions.pop(item_id, None)
+
+    def _run_id(self, container_id):
+        """Return the id of the observing run that the container is in, or None if not known."""
+        for _ in range(64):  # guard against cycles
+            if container_id in self._run_containers:
+                return self._run_containers[container_id]
+            parent = self._items.get(container_id)
+            if parent is None:
+                return None
+            container_id = parent.container_id
+        return None
+
+    def search(self, query, limit=DEFAULT_LIMIT, item_types=None):
+        """Return the best ``limit`` matches (``NameMatch`` tuples) for ``query``, best first.
+
+        ``item_types`` optionally restricts the results to items of the given P2 item types
+        (e.g. ``('OB',)``).
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        with self._lock:
+            ranked = self._substring_matches(query, limit, item_types)
+            if len(ranked) < limit:
+                ranked += self._fuzzy_matches(query, limit - len(ranked), item_types)
+            return [NameMatch(item.item_id, item.name, item.item_type, item.container_id,
+                              self._run_id(item.container_id), quality, similarity)
+                    for quality, similarity, item in ranked]
+
+    def _substring_matches(self, query, limit, item_types):
+        """Return the best ``limit`` (quality, similarity, item) of the items whose names contain ``query``."""
+        core_trigrams = {query[i:i + 3] for i in range(len(query) - 2)}
+        if core_trigrams:
+            # every name containing the query has all the trigrams of the query itself
+            postings = sorted((self._postings.get(trigram, set()) for trigram in core_trigrams), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+        else:  # a query of one or two characters: names with a word starting with it
+            candidates = self._postings.get(f' {query}' if len(query) == 2 else f'  {query}', set())
+            if len(query) == 1:
+                candidates = candidates.union(*(ids for trigram, ids in self._postings.items()
+                                                if trigram.startswith(f' {query}')))
+
+        names = self._normalized_names
+        remaining = [item_id for item_id in candidates if query in names[item_id]
+                     and (item_types is None or self._items[item_id].item_type in item_types)]
+
+        # rank by match quality, one quality at a time (until there are enough matches), and then
+        # by closeness (among names containing the query, the shorter the name, the closer the
+        # match) and recency (see _rank_keys)
+        word_query = f' {query}'
+        quality_tests = ((EXACT, lambda name: name == query),
+                         (PREFIX, lambda name: name.startswith(query)),
+                         (WORD_PREFIX, lambda name: word_query in name),
+                         (SUBSTRING, lambda name: True))
+        ranked = []
+        for quality, has_quality in quality_tests:
+            if len(ranked) >= limit or not remaining:
+                break
+            matches, others = [], []
+            for item_id in remaining:
+                (matches if has_quality(names[item_id]) else others).append(item_id)
+            remaining = others
+            ranked += [(quality, len(query) / len(names[item_id]), self._items[item_id])
+                       for item_id in heapq.nsmallest(limit - len(ranked), matches, key=self._rank_keys.__getitem__)]
+        return ranked
+
+    def _fuzzy_matches(self, query, limit, item_types):
+        """Return the best ``limit`` (quality, similarity, item) of the items whose names don't contain
+        ``query``, but are similar to it.
+        """
+        query_trigrams = trigrams(query)
+        postings = sorted((self._postings[trigram] for trigram in query_trigrams if trigram in self._postings),
+                          key=len)
+        if not postings:
+            return []
+        # the items with the rarer trigrams of the query (a typo leaves most of those intact)
+        max_postings = max(len(postings[0]), FUZZY_MAX_POSTINGS_FRACTION * len(self._items))
+        candidates = set().union(*(ids for ids in postings if len(ids) <= max_postings))
+
+        matches = []
+        for item_id in candidates:
+            item = self._items[item_id]
+            name = self._normalized_names[item_id]
+            if query in name or (item_types is not None and item.item_type not in item_types):
+                continue
+            # the Jaccard similarity of the trigram sets of the query and the name
+            shared = len(query_trigrams & trigrams(name))
+            similarity = shared / (len(query_trigrams) + self._trigram_counts[item_id] - shared)
+            if similarity >= MIN_SIMILARITY:
+                matches.append((-similarity, -item.updated_at, -item_id, item))
+        best = heapq.nsmallest(limit, matches, key=lambda match: match[:3])
+        return [(FUZZY, -negative_similarity, item) for negative_similarity, _, _, item in best]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._normalized_names.clear()
+            self._trigram_counts.clear()
+            self._rank_keys.clear()
+            self._postings.clear()
+            self._children.clear()
+            self._container_versions.clear()
+            self._run_containers.clear()
+            self._seeded_containers.clear()
+            self.seeded_from = None
+
+
+_name_indexes = {}  # (environment, username) -> NameIndex
+_name_indexes_lock = threading.Lock()
+
+
+def get_name_index(environment, username):
+    """Return the process-wide ``NameIndex`` of the P2 account."""
+    with _name_indexes_lock:
+        index = _name_indexes.get((environment, username))
+        if index is None:
+            index = _name_indexes[(environment, username)] = NameIndex()
+        return index
+
+
+def clear_name_indexes():
+    """Forget the indexes of all the P2 accounts."""
+    with _name_indexes_lock:
+        _name_indexes.clear()
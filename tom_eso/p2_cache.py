@@ -0,0 +1,91 @@
+"""
+An in-memory, version-aware cache of ESO Phase 2 API responses.
+
+Every p2api call returns a ``(data, version)`` tuple, where the version is the
+HTTP ETag of the resource. ``ESOAPI`` keeps one ``P2ResponseCache`` per set of
+credentials (pooled ``ESOAPI`` instances are per user, see ``tom_eso/connections.py``)
+for the read-only calls that populate the observation form dropdowns.
+
+While an entry is younger than the TTL of its method it is served as it is.
+After that it is revalidated with a conditional request (``If-None-Match: <version>``),
+which costs a round trip but no payload if the resource has not changed.
+
+The TTLs and the LRU size limit are configured with the optional ``p2_cache``
+dictionary in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'p2_cache': {
+            'ttl': {'getRuns': 300, 'getRun': 300, 'getItems': 60},  # seconds
+            'max_entries': 256,  # per user
+        },
+    }
+"""
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTLS = {
+    'getRuns': 5 * 60,  # seconds
+    'getRun': 5 * 60,  # seconds
+    'getItems': 60,  # seconds
+}
+DEFAULT_MAX_ENTRIES = 256
+
+
+class CacheEntry:
+    """A cached p2api response: the data, its version (ETag) and when it was (re)validated."""
+
+    def __init__(self, data, version):
+        self.data = data
+        self.version = version
+        self.validated_at = time.monotonic()
+
+    def age(self):
+        return time.monotonic() - self.validated_at
+
+    def touch(self):
+        """Mark the entry as just revalidated."""
+        self.validated_at = time.monotonic()
+
+
+class P2ResponseCache:
+    """A thread-safe LRU cache of p2api responses keyed by (method_name, *args)."""
+
+    def __init__(self, ttls=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_cacheable(self, method_name):
+        return method_name in self.ttls
+
+    def is_fresh(self, key, entry):
+        return entry.age() < self.ttls[key[0]]
+
+    def get(self, key):
+        """Return the ``CacheEntry`` for ``key`` (fresh or not), or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, data, version):
+        with self._lock:
+            self._entries[key] = CacheEntry(data, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Drop the entry for ``key``, or every entry if no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
@@ -0,0 +1,76 @@
+"""
+One configured ``ESOFacility`` per request, shared by the views, forms and template tags of the request.
+
+Setting up an ESOFacility for a user (``set_user()``) resolves their ESO credentials and borrows an
+ESO API connection from the pool. ``get_request_facility(request)`` does that once per request: the
+first call creates and sets up the facility, and later calls for the same request return it.
+
+With ``ESOFacilityMiddleware`` (see tom_eso/middleware.py) in ``settings.MIDDLEWARE``, the request
+is also available to code that is not handed it. The ``ESOFacility`` instances that other code
+creates for the request's user, such as the one that tom_observations' ``ObservationCreateView``
+creates, then share the configuration of the request's facility instead of setting up their own
+(see ``ESOFacility.set_user()``), and template tags can use it (see ``get_shared_facility()``).
+"""
+import contextvars
+
+REQUEST_ATTRIBUTE = '_tom_eso_facility'
+
+_current_request = contextvars.ContextVar('tom_eso_current_request', default=None)
+
+
+def start_request(request):
+    """Make ``request`` the current request. Return a token for ``end_request()``."""
+    return _current_request.set(request)
+
+
+def end_request(token):
+    """Stop making the request passed to ``start_request()`` the current request."""
+    _current_request.reset(token)
+
+
+def _same_user(user, other_user):
+    return (user is not None and other_user is not None and user.is_authenticated
+            and other_user.is_authenticated and user.pk == other_user.pk)
+
+
+def get_request_facility(request):
+    """Return the ``ESOFacility`` of ``request``, set up for ``request.user`` on first use."""
+    facility = getattr(request, REQUEST_ATTRIBUTE, None)
+    if facility is None:
+        from tom_eso.eso import ESOFacility  # tom_eso.eso imports this module
+
+        facility = ESOFacility()
+        facility.set_user(request.user)
+        setattr(request, REQUEST_ATTRIBUTE, facility)
+    return facility
+
+
+async def aget_request_facility(request):
+    """Async version of ``get_request_facility()``, for the async views."""
+    facility = getattr(request, REQUEST_ATTRIBUTE, None)
+    if facility is None:
+        from tom_eso.eso import ESOFacility  # tom_eso.eso imports this module
+
+        facility = ESOFacility()
+        await facility.aset_user(request.user)
+        setattr(request, REQUEST_ATTRIBUTE, facility)
+    return facility
+
+
+def get_shared_facility(user):
+    """Return the facility already set up for ``user`` in the current request, or None."""
+    request = _current_request.get()
+    facility = getattr(request, REQUEST_ATTRIBUTE, None)
+    if facility is not None and _same_user(facility.user, user):
+        return facility
+    return None
+
+
+def share_facility(facility):
+    """Make ``facility`` (just set up) the facility of the current request, if the request has none
+    yet and the facility is for the request's user.
+    """
+    request = _current_request.get()
+    if (request is not None and getattr(request, REQUEST_ATTRIBUTE, None) is None
+            and _same_user(facility.user, getattr(request, 'user', None))):
+        setattr(request, REQUEST_ATTRIBUTE, facility)
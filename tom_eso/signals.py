@@ -0,0 +1,69 @@
+"""Signal receivers that keep tom_eso's in-memory state consistent with the ``ESOProfile`` table
+(and with the users' sessions and the settings).
+
+These receivers are connected in ``TomEsoConfig.ready()``.
+"""
+import logging
+
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.core.signals import setting_changed
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from tom_eso.connections import get_connection_pool
+from tom_eso.credentials import get_credential_resolver
+from tom_eso.models import ESOProfile
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(pre_save, sender=ESOProfile)
+def remember_previous_p2_credentials(sender, instance, **kwargs):
+    """Remember the (environment, username) that the profile had before this save,
+    so that the connection authenticated with them can be dropped after the save.
+    """
+    instance._previous_p2_credentials = None
+    if instance.pk:
+        instance._previous_p2_credentials = (
+            sender.objects.filter(pk=instance.pk).values_list('p2_environment', 'p2_username').first()
+        )
+
+
+@receiver(post_save, sender=ESOProfile)
+@receiver(post_delete, sender=ESOProfile)
+def invalidate_pooled_connections(sender, instance, **kwargs):
+    """Drop any pooled ESO API connection that was authenticated with this profile's credentials."""
+    pool = get_connection_pool()
+    credentials = {(instance.p2_environment, instance.p2_username)}
+    previous_credentials = getattr(instance, '_previous_p2_credentials', None)
+    if previous_credentials:
+        credentials.add(tuple(previous_credentials))
+
+    for environment, username in credentials:
+        if username:
+            logger.debug(f'Invalidating pooled ESO connections for {environment}:{username}')
+            pool.invalidate(environment=environment, username=username)
+
+
+@receiver(post_save, sender=ESOProfile)
+@receiver(post_delete, sender=ESOProfile)
+def invalidate_resolved_credentials(sender, instance, **kwargs):
+    """Forget the credentials resolved for the profile's user, so that the changed profile is used."""
+    get_credential_resolver().invalidate(instance.user_id)
+
+
+@receiver(user_logged_in)
+@receiver(user_logged_out)
+def invalidate_resolved_credentials_of_user(sender, user, **kwargs):
+    """Forget the credentials resolved for a user who logs in or out: whether their P2 password can be
+    decrypted depends on their session.
+    """
+    if user is not None:
+        get_credential_resolver().invalidate(user.pk)
+
+
+@receiver(setting_changed)
+def clear_resolved_credentials(setting, **kwargs):
+    """Forget all the resolved credentials when the default credentials in ``FACILITIES`` change (in tests)."""
+    if setting == 'FACILITIES':
+        get_credential_resolver().clear()
@@ -0,0 +1,149 @@
+"""
+Status updates for the ESO ObservationRecords, whose observation ids are P2 obIds.
+
+``ObservationStatusUpdater`` implements ``ESOFacility.update_all_observation_statuses()`` (used
+by the ``updatestatus`` management command) for many records at once: the non-terminal records
+are read in batches, grouped by the P2 account their users' credentials resolve to, and the
+observation blocks of each batch are fetched concurrently over the pooled connections (each obId
+once per account). The changed records of a batch are then written with a single ``bulk_update()``,
+and, as ``ObservationRecord.save()`` would, the ``observation_change_state`` hook is run for each
+record whose status changed.
+
+The batch size and the number of concurrent requests are configured in ``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'status_batch_size': 500,
+        'status_max_workers': 8,  # default: 'max_workers'
+    }
+"""
+import logging
+
+from django.contrib.auth.models import User
+from tom_common.hooks import run_hook
+from tom_observations.models import ObservationRecord
+
+from tom_eso.concurrency import map_concurrently
+from tom_eso.conf import get_eso_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+# ObservationRecord.status for the P2 obStatus codes. Other codes are stored as they are.
+OB_STATUSES = {
+    'P': 'PARTIALLY_DEFINED',
+    'D': 'DEFINED',
+    'A': 'ACCEPTED',
+    'S': 'STARTED',
+    'M': 'MUST_REPEAT',
+    'C': 'COMPLETED',
+    'K': 'CANCELLED',
+}
+TERMINAL_OB_STATUSES = ['COMPLETED', 'CANCELLED']
+
+
+def observation_status(observation_block):
+    """Return the status dict (as expected from ``get_observation_status()``) of a P2 observation block."""
+    ob_status = observation_block.get('obStatus')
+    return {
+        'state': OB_STATUSES.get(ob_status, ob_status),
+        'scheduled_start': None,  # P2 doesn't schedule observation blocks in advance
+        'scheduled_end': None,
+    }
+
+
+class ObservationStatusUpdater:
+    """Update the status of the non-terminal ObservationRecords of an ``ESOFacility``.
+
+    Records without a user are fetched with the facility's own credentials; the records of
+    other users with a fresh facility instance set up for that user (so with their ESOProfile
+    credentials, or the settings defaults).
+    """
+
+    def __init__(self, facility, batch_size=None, max_workers=None):
+        self.facility = facility
+        self.batch_size = batch_size or get_eso_setting('status_batch_size', DEFAULT_BATCH_SIZE)
+        self.max_workers = max_workers or get_eso_setting('status_max_workers')
+        self._eso_apis = {}  # user id -> ESOAPI (or None, if the user has no usable credentials)
+
+    def get_records(self, target=None):
+        records = ObservationRecord.objects.filter(facility=self.facility.name)
+        if target:
+            records = records.filter(target=target)
+        return records.exclude(status__in=self.facility.get_terminal_observing_states()).order_by('pk')
+
+    def update(self, target=None):
+        """Update the status of every non-terminal record (of the ``target``, if given).
+
+        Return a list of the (observation_id, error message) of the records that could not be updated.
+        """
+        failed_records = []
+        batch = []
+        for record in self.get_records(target).iterator(chunk_size=self.batch_size):
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                failed_records.extend(self.update_batch(batch))
+                batch = []
+        if batch:
+            failed_records.extend(self.update_batch(batch))
+        return failed_records
+
+    def update_batch(self, records):
+        """Fetch the observation blocks of the ``records`` concurrently and save the changed records."""
+        self._set_up_users({record.user_id for record in records} - set(self._eso_apis))
+
+        failed_records = []
+        # (P2 account, obId) -> [ESOAPI, [records]]
+        observation_blocks = {}
+        for record in records:
+            eso_api = self._eso_apis.get(record.user_id) if record.user_id else self.facility.eso_api
+            if eso_api is None:
+                failed_records.append((record.observation_id, 'No ESO credentials configured'))
+                continue
+            key = (eso_api.environment, eso_api.username, record.observation_id)
+            observation_blocks.setdefault(key, [eso_api, []])[1].append(record)
+
+        def fetch_status(eso_api_and_records):
+            eso_api, ob_records = eso_api_and_records
+            return observation_status(eso_api.getOB(int(ob_records[0].observation_id)))
+
+        statuses = map_concurrently(fetch_status, list(observation_blocks.values()),
+                                    max_workers=self.max_workers, return_exceptions=True)
+
+        changed_records = []
+        previous_statuses = {}  # record -> its status before the update, for the records whose status changed
+        for (_, ob_records), status in zip(observation_blocks.values(), statuses):
+            if isinstance(status, Exception):
+                logger.error(f'Error getting the status of observation block {ob_records[0].observation_id}: '
+                             f'{status}')
+                failed_records.extend((record.observation_id, str(status)) for record in ob_records)
+                continue
+            for record in ob_records:
+                if (record.status, record.scheduled_start, record.scheduled_end) != (
+                        status['state'], status['scheduled_start'], status['scheduled_end']):
+                    if record.status != status['state']:
+                        previous_statuses[record] = record.status
+                    record.status = status['state']
+                    record.scheduled_start = status['scheduled_start']
+                    record.scheduled_end = status['scheduled_end']
+                    changed_records.append(record)
+
+        if changed_records:
+            ObservationRecord.objects.bulk_update(changed_records, ['status', 'scheduled_start', 'scheduled_end'])
+        # (bulk_update() doesn't call save(), which runs the hook)
+        for record, previous_status in previous_statuses.items():
+            run_hook('observation_change_state', record, previous_status)
+        logger.info(f'Updated the status of {len(changed_records)} of {len(records)} ESO observation records')
+        return failed_records
+
+    def _set_up_users(self, user_ids):
+        """Find the (pooled) ESO API connection of each of the users."""
+        user_ids.discard(None)
+        for user_id, user in User.objects.in_bulk(user_ids).items():
+            facility = type(self.facility)()
+            try:
+                facility.set_user(user)
+            except Exception as ex:
+                logger.error(f'Error setting up the ESO credentials of {user}: {ex}')
+            self._eso_apis[user_id] = facility.eso_api
@@ -5,6 +5,7 @@ from django import template
 from tom_common.session_utils import get_encrypted_field
 
 from tom_eso.models import ESOProfile
+from tom_eso.request_facility import get_shared_facility
 # Import the form to consistently get the label for the password field.
 from tom_eso.forms import ESOProfileForm
 
@@ -48,8 +49,13 @@ def eso_profile_data(user) -> dict:
             'value': value,
         })
 
-    # Handle the special case of the encrypted password field.
-    decrypted_password = get_encrypted_field(user, profile, 'p2_password')
+    # Handle the special case of the encrypted password field. If an ESOFacility was already set up
+    # for the user in this request, it has decrypted the password (see tom_eso/request_facility.py).
+    facility = get_shared_facility(user)
+    if facility is not None and facility.facility_settings.profile_credentials.get('p2_password'):
+        decrypted_password = facility.facility_settings.profile_credentials['p2_password']
+    else:
+        decrypted_password = get_encrypted_field(user, profile, 'p2_password')
     password_label = ESOProfileForm.base_fields['p2_password'].label or 'P2 Password'
 
     password_value = decrypted_password
@@ -0,0 +1,519 @@
+"""
+Benchmarks for tom_eso.
+
+These are not unit tests: they time tom_eso code paths against fake ESO API connections
+(with configurable latency) so that the cost of changes can be compared.
+Run them with::
+
+    $ python tom_eso/tests/run_benchmarks.py [benchmark_name ...] [--output results.json] [--compare baseline.json]
+
+Each benchmark is a function decorated with ``@benchmark`` that returns a dictionary of results.
+
+The benchmarks that take a ``fake_p2_options`` argument run the real p2api client against a local
+fake P2 API server (see fake_p2_server.py), whose latency, error rate and account size (observing
+runs x folders x observation blocks) are set on the command line (see ``--help``). They measure
+the cold (nothing cached, no pooled connection) and warm latency of the tom_eso views, of the
+construction of the ESO observation form, and of bulk observation block creation.
+
+With ``--output``, the results are also written to a JSON file. With ``--compare``, the timings
+(``*_ms`` and ``*_seconds``) are compared with those of an earlier ``--output`` file, and the
+timings that got slower by more than ``--threshold`` are reported (with exit status 1).
+"""
+import argparse
+import inspect
+import json
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from importlib import metadata
+from unittest import mock
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import Angle
+from django.contrib.auth.models import User
+from crispy_forms.templatetags.crispy_forms_filters import as_crispy_field
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, RequestFactory, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from tom_targets.models import Target, TargetList
+
+from tom_eso import circuit_breaker
+from tom_eso.connections import get_connection_pool
+from tom_eso.coordinates import dec_to_sexagesimal, ra_to_sexagesimal
+from tom_eso.eso import ESOFacility, ESOObservationForm
+from tom_eso.eso_api import ESOAPI
+from tom_eso.name_index import NameIndex
+from tom_eso.visibility import NightGrid, target_visibility as compute_target_visibility
+from tom_eso import views
+from tom_eso.tests.fake_p2_server import run_fake_p2_server
+
+BENCHMARKS = {}
+
+BENCHMARK_FACILITIES = {
+    'ESO': {
+        'p2_environment': 'demo',
+        'p2_username': '52052',
+        'p2_password': 'tutorial',
+    },
+}
+
+# against the fake P2 server, measure tom_eso rather than the rate limiter, and retry quickly
+FAKE_P2_FACILITIES = {
+    'ESO': {
+        **BENCHMARK_FACILITIES['ESO'],
+        'rate_limit': {'rate': None},
+        'retries': {'base_delay': 0.01, 'max_delay': 0.1},
+    },
+}
+
+# the defaults of the fake P2 server options (see the command line options in main())
+DEFAULT_FAKE_P2_OPTIONS = {'latency': 0.02, 'error_rate': 0.0, 'n_runs': 3, 'n_folders': 10, 'n_obs': 20}
+
+
+def benchmark(func):
+    """Register a benchmark function under its name."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+class FakeApiConnection:
+    """Stand-in for a p1api/p2api ``ApiConnection`` that sleeps instead of talking to ESO."""
+    login_latency = 0.05  # seconds
+    call_latency = 0.01  # seconds
+    logins = 0
+
+    def __init__(self, environment, username, password):
+        time.sleep(self.login_latency)
+        type(self).logins += 1
+
+    def _call(self, data):
+        time.sleep(self.call_latency)
+        return data, '"version"'
+
+    def getUser(self):
+        return self._call({'username': '52052'})
+
+    def getRuns(self):
+        return self._call([{'runId': 1, 'progId': '60.A-9252(M)', 'telescope': 'UT2', 'instrument': 'UVES'}])
+
+    def getRun(self, run_id):
+        return self._call({'runId': run_id, 'containerId': 10})
+
+    def getItems(self, container_id):
+        return self._call([{'containerId': 11, 'name': 'folder', 'itemType': 'Folder'},
+                           {'obId': 12, 'name': 'OB', 'itemType': 'OB'}])
+
+
+class FakeP1Connection(FakeApiConnection):
+    logins = 0
+
+
+class FakeP2Connection(FakeApiConnection):
+    logins = 0
+
+
+class EagerESOAPI(ESOAPI):
+    """ESOAPI as it was before connections were made lazily: log in to Phase 1 and 2 on construction."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.api1
+        self.api2
+
+
+def _time_requests(view, request_factory_args, user, n_requests, use_pool, esoapi_class):
+    """Call ``view`` ``n_requests`` times; return per-request wall times and the login counts."""
+    FakeP1Connection.logins = FakeP2Connection.logins = 0
+    get_connection_pool().clear()
+    cache.clear()
+    timings = []
+    with mock.patch('tom_eso.eso_api.p1api.ApiConnection', FakeP1Connection), \
+         mock.patch('tom_eso.eso_api.p2api.ApiConnection', FakeP2Connection), \
+         mock.patch('tom_eso.connections.ESOAPI', esoapi_class):
+        for _ in range(n_requests):
+            if not use_pool:
+                get_connection_pool().clear()
+            request = RequestFactory().get(*request_factory_args)
+            request.user = user
+            start = time.perf_counter()
+            view(request)
+            timings.append(time.perf_counter() - start)
+    get_connection_pool().clear()
+    return {
+        'phase1_logins': FakeP1Connection.logins,
+        'phase2_logins': FakeP2Connection.logins,
+        'logins_per_request': (FakeP1Connection.logins + FakeP2Connection.logins) / n_requests,
+        'mean_ms': 1000 * statistics.mean(timings),
+        'median_ms': 1000 * statistics.median(timings),
+    }
+
+
+@benchmark
+@override_settings(FACILITIES=BENCHMARK_FACILITIES)
+def htmx_request_logins(n_requests=20):
+    """Login count and wall time per HTMX folder-dropdown request, for eager vs. lazy (and pooled) logins."""
+    user, _ = User.objects.get_or_create(username='benchmark_user')
+    request_args = ('/eso/observing-run-folders/', {'p2_observing_run': 1})
+    scenarios = {
+        'eager_connections': dict(use_pool=False, esoapi_class=EagerESOAPI),
+        'lazy_connections': dict(use_pool=False, esoapi_class=ESOAPI),
+        'lazy_pooled_connections': dict(use_pool=True, esoapi_class=ESOAPI),
+    }
+    return {name: _time_requests(views.folders_for_observing_run, request_args, user, n_requests, **kwargs)
+            for name, kwargs in scenarios.items()}
+
+
+@benchmark
+def coordinate_formatting(n_coordinates=100_000, n_astropy=2_000):
+    """Seconds to format RA/Dec for OB target blocks: per-target astropy Angles vs. the vectorized formatters.
+
+    The per-target astropy time is measured on ``n_astropy`` coordinates and scaled up to ``n_coordinates``.
+    """
+    rng = np.random.default_rng(0)
+    ras = rng.uniform(0.0, 360.0, n_coordinates)
+    decs = rng.uniform(-90.0, 90.0, n_coordinates)
+
+    start = time.perf_counter()
+    for ra, dec in zip(ras[:n_astropy], decs[:n_astropy]):
+        Angle(ra, unit=u.deg).to_string(unit=u.hourangle, sep=':', precision=3)
+        Angle(dec, unit=u.deg).to_string(unit=u.deg, sep=':', precision=3, alwayssign=True)
+    astropy_seconds = (time.perf_counter() - start) * n_coordinates / n_astropy
+
+    start = time.perf_counter()
+    ra_to_sexagesimal(ras)
+    dec_to_sexagesimal(decs)
+    vectorized_seconds = time.perf_counter() - start
+
+    return {
+        'n_coordinates': n_coordinates,
+        'astropy_angles_seconds': astropy_seconds,
+        'vectorized_seconds': vectorized_seconds,
+        'speedup': astropy_seconds / vectorized_seconds,
+    }
+
+
+@benchmark
+def name_index(n_runs=20, n_folders=50, n_obs=50, n_lookups=200):
+    """Milliseconds to index and to look up the names of a P2 account of
+    ``n_runs`` x ``n_folders`` x ``n_obs`` observation blocks (see tom_eso/name_index.py).
+    """
+    rng = np.random.default_rng(0)
+    index = NameIndex()
+    containers = []
+    for run in range(n_runs):
+        run_container_id = 1_000_000 + run
+        index.add_observing_runs([{'runId': 60_900_000 + run, 'containerId': run_container_id}])
+        containers.append((run_container_id, [{'containerId': 2_000_000 + run * n_folders + folder,
+                                               'name': f'Run {run} folder {folder}', 'itemType': 'Folder'}
+                                              for folder in range(n_folders)]))
+        for folder in range(n_folders):
+            containers.append((2_000_000 + run * n_folders + folder, [
+                {'obId': 10_000_000 + (run * n_folders + folder) * n_obs + ob,
+                 'name': f'SN{rng.integers(2000, 2030)}{"".join(rng.choice(list("abcdefghij"), 3))} '
+                         f'epoch {ob}', 'itemType': 'OB'}
+                for ob in range(n_obs)]))
+
+    start = time.perf_counter()
+    for container_id, items in containers:
+        index.update_container(container_id, items)
+    index_seconds = time.perf_counter() - start
+
+    queries = {
+        'narrow': [f'sn20{rng.integers(0, 30):02d}{"".join(rng.choice(list("abcdefghij"), 2))}'
+                   for _ in range(n_lookups)],
+        'broad': ['epoch 1'] * n_lookups,
+        'fuzzy': [f'sn20{rng.integers(0, 30):02d} epohc' for _ in range(n_lookups)],
+    }
+    results = {'n_items': len(index), 'index_seconds': index_seconds}
+    for kind, kind_queries in queries.items():
+        timings = []
+        for query in kind_queries:
+            start = time.perf_counter()
+            index.search(query)
+            timings.append(time.perf_counter() - start)
+        results[f'{kind}_lookup_median_ms'] = 1000 * statistics.median(timings)
+        results[f'{kind}_lookup_max_ms'] = 1000 * max(timings)
+    return results
+
+
+@benchmark
+def target_visibility(n_targets=500, n_single=20, period=114):
+    """Seconds to compute the visibility of ``n_targets`` targets from Paranal over an ESO period
+    (see tom_eso/visibility.py): target by target (each with its own Sun, Moon and sidereal time
+    grid) vs. all the targets at once against one shared grid, and then again from the cache.
+
+    The target-by-target time is measured on ``n_single`` targets and scaled up to ``n_targets``.
+    """
+    rng = np.random.default_rng(0)
+    ras = rng.uniform(0.0, 360.0, n_targets)
+    decs = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, n_targets)))
+    site = ESOFacility().get_observing_sites()['PARANAL']
+
+    start = time.perf_counter()
+    for ra, dec in zip(ras[:n_single], decs[:n_single]):
+        NightGrid(site, period).visibility([ra], [dec])
+    per_target_seconds = (time.perf_counter() - start) * n_targets / n_single
+
+    cache.clear()
+    with override_settings(FACILITIES=BENCHMARK_FACILITIES):
+        start = time.perf_counter()
+        grid, _ = compute_target_visibility(ras, decs, site, period)
+        vectorized_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        compute_target_visibility(ras, decs, site, period)
+        cached_seconds = time.perf_counter() - start
+
+    return {
+        'n_targets': n_targets,
+        'n_night_steps': len(grid.jd),
+        'per_target_seconds': per_target_seconds,
+        'vectorized_seconds': vectorized_seconds,
+        'cached_seconds': cached_seconds,
+        'speedup': per_target_seconds / vectorized_seconds,
+    }
+
+
+def _reset_eso_state():
+    """Forget everything that tom_eso caches between requests, for a cold start."""
+    cache.clear()
+    get_connection_pool().clear()
+    circuit_breaker._circuit_breakers.clear()
+
+
+def _p2_requests(server):
+    return sum(server.request_counts.values())
+
+
+def _timing_summary(timings, p2_requests):
+    return {
+        'mean_ms': 1000 * statistics.mean(timings),
+        'median_ms': 1000 * statistics.median(timings),
+        'max_ms': 1000 * max(timings),
+        'p2_requests_per_call': p2_requests / len(timings),
+    }
+
+
+def _time_cold_and_warm(server, call, n_calls):
+    """Time ``call()`` ``n_calls`` times from a cold start each, then ``n_calls`` times warm (after one more call)."""
+    results = {}
+    for scenario in ('cold', 'warm'):
+        if scenario == 'warm':
+            call()
+        timings = []
+        p2_requests = _p2_requests(server)
+        for _ in range(n_calls):
+            if scenario == 'cold':
+                _reset_eso_state()
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+        results[scenario] = _timing_summary(timings, _p2_requests(server) - p2_requests)
+    _reset_eso_state()
+    return results
+
+
+def _first_folder_and_observation_block(server):
+    """Return the ids of an observing run of the fake account, its first folder, and an observation block in it."""
+    account = server.account
+    run_id, run = next(iter(account.runs.items()))
+    folder_id = account.containers[run['containerId']][0]['containerId']
+    ob_ids = [item['obId'] for item in account.containers[folder_id] if 'obId' in item]
+    return run_id, folder_id, ob_ids[0] if ob_ids else 0
+
+
+def _benchmark_targets(n_targets):
+    targets = []
+    for i in range(n_targets):
+        target, _ = Target.objects.get_or_create(name=f'benchmark-target-{i}', defaults={
+            'type': Target.SIDEREAL, 'ra': (7.3 * i) % 360.0, 'dec': (11.1 * i) % 180.0 - 90.0})
+        targets.append(target)
+    return targets
+
+
+@benchmark
+@override_settings(FACILITIES=FAKE_P2_FACILITIES)
+def view_latency(fake_p2_options, n_requests=5, n_targets=20):
+    """Cold and warm latency of each tom_eso view that talks to ESO P2, through the full middleware stack."""
+    user, _ = User.objects.get_or_create(username='benchmark_user', defaults={'is_superuser': True})
+    target_list, _ = TargetList.objects.get_or_create(name='Benchmark targets')
+    target_list.targets.add(*_benchmark_targets(n_targets))
+    client = Client()
+    client.force_login(user)
+
+    with run_fake_p2_server(**fake_p2_options) as server:
+        run_id, folder_id, ob_id = _first_folder_and_observation_block(server)
+        requests = {
+            'observing-run-folders': {'p2_observing_run': run_id},
+            'folder-observation-blocks': {'p2_folder_name': folder_id},
+            'show-observation-block': {'observation_blocks': ob_id},
+            'observing-run-tree': {'p2_observing_run': run_id},
+            'observing-run-folders-async': {'p2_observing_run': run_id},
+            'folder-observation-blocks-async': {'p2_folder_name': folder_id},
+            'show-observation-block-async': {'observation_blocks': ob_id},
+        }
+        urls = {name: (reverse(f'tom_eso:{name}'), params) for name, params in requests.items()}
+        urls['targetlist-observation-blocks'] = (
+            reverse('tom_eso:targetlist-observation-blocks', kwargs={'pk': target_list.pk}), {})
+
+        results = {}
+        for name, (url, params) in urls.items():
+            status_codes = set()
+
+            def request():
+                status_codes.add(client.get(url, params).status_code)
+            results[name] = _time_cold_and_warm(server, request, n_requests)
+            results[name]['status_codes'] = sorted(status_codes)
+    return results
+
+
+@benchmark
+@override_settings(FACILITIES=FAKE_P2_FACILITIES)
+def observation_form(fake_p2_options, n_forms=5):
+    """Cold and warm latency of constructing the ESO observation form, and of rendering its observing run dropdown
+    (which is when the lazy choices are fetched from P2).
+    """
+    user, _ = User.objects.get_or_create(username='benchmark_user', defaults={'is_superuser': True})
+
+    with run_fake_p2_server(**fake_p2_options) as server:
+        forms = []
+
+        def construct():
+            facility = ESOFacility()
+            facility.set_user(user)
+            forms.append(ESOObservationForm(facility=facility))
+
+        def construct_and_render():
+            construct()
+            as_crispy_field(forms[-1]['p2_observing_run'])
+
+        return {
+            'construction': _time_cold_and_warm(server, construct, n_forms),
+            'construction_and_render': _time_cold_and_warm(server, construct_and_render, n_forms),
+        }
+
+
+@benchmark
+@override_settings(FACILITIES=FAKE_P2_FACILITIES)
+def bulk_ob_creation(fake_p2_options, n_targets=50):
+    """Wall time of creating an observation block for each of ``n_targets`` targets, with a cold and a warm start."""
+    user, _ = User.objects.get_or_create(username='benchmark_user', defaults={'is_superuser': True})
+    targets = _benchmark_targets(n_targets)
+
+    with run_fake_p2_server(**fake_p2_options) as server:
+        _, folder_id, _ = _first_folder_and_observation_block(server)
+        _reset_eso_state()
+        results = {}
+        for scenario in ('cold', 'warm'):  # the warm run reuses the pooled connection of the cold one
+            p2_requests = _p2_requests(server)
+            facility = ESOFacility()
+            facility.set_user(user)
+            start = time.perf_counter()
+            bulk_result = facility.submit_observation_blocks_for_targets(folder_id, targets)
+            wall_time = time.perf_counter() - start
+            results[scenario] = {
+                'wall_ms': 1000 * wall_time,
+                'per_ob_ms': 1000 * wall_time / n_targets,
+                'created': bulk_result['created'],
+                'failed': bulk_result['failed'],
+                'p2_requests': _p2_requests(server) - p2_requests,
+            }
+        _reset_eso_state()
+    return results
+
+
+def compare_results(baseline, results, threshold):
+    """Return a list of (benchmark result path, baseline, new value) for the timings (``*_ms`` and ``*_seconds``)
+    of ``results`` that are more than ``threshold`` times their value in ``baseline``.
+    """
+    regressions = []
+
+    def compare(baseline_value, value, path):
+        if isinstance(value, dict) and isinstance(baseline_value, dict):
+            for key in value:
+                if key in baseline_value:
+                    compare(baseline_value[key], value[key], path + [key])
+        elif (path and path[-1].endswith(('_ms', '_seconds')) and isinstance(value, (int, float))
+              and isinstance(baseline_value, (int, float)) and value > threshold * baseline_value):
+            regressions.append(('.'.join(path), baseline_value, value))
+    compare(baseline, results, [])
+    return regressions
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(description='Run the tom_eso benchmarks.')
+    parser.add_argument('names', nargs='*', metavar='benchmark_name', help=f'default: all of {", ".join(BENCHMARKS)}')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare the timings with this earlier --output file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='report the timings more than this many times slower than the baseline (default 1.25)')
+    parser.add_argument('--latency', type=float, default=DEFAULT_FAKE_P2_OPTIONS['latency'],
+                        help='seconds that each request to the fake P2 server takes')
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_FAKE_P2_OPTIONS['error_rate'],
+                        help='fraction of the fake P2 API requests that fail with a 503')
+    parser.add_argument('--runs', type=int, default=DEFAULT_FAKE_P2_OPTIONS['n_runs'],
+                        help='observing runs in the fake P2 account')
+    parser.add_argument('--folders', type=int, default=DEFAULT_FAKE_P2_OPTIONS['n_folders'],
+                        help='folders in each observing run')
+    parser.add_argument('--obs', type=int, default=DEFAULT_FAKE_P2_OPTIONS['n_obs'],
+                        help='observation blocks in each folder')
+    options = parser.parse_args(args)
+    unknown_names = set(options.names) - set(BENCHMARKS)
+    if unknown_names:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown_names))}')
+    return options
+
+
+def main(args=None):
+    """Run the named benchmarks (or all of them) against a throw-away test database and print the results.
+
+    ``args`` are the command line arguments (see ``--help``).
+    """
+    options = _parse_args(args or [])
+    fake_p2_options = {'latency': options.latency, 'error_rate': options.error_rate,
+                       'n_runs': options.runs, 'n_folders': options.folders, 'n_obs': options.obs}
+
+    setup_test_environment()
+    old_database_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        results = {}
+        for name in options.names or BENCHMARKS:
+            benchmark_function = BENCHMARKS[name]
+            kwargs = {}
+            if 'fake_p2_options' in inspect.signature(benchmark_function).parameters:
+                kwargs['fake_p2_options'] = fake_p2_options
+            results[name] = benchmark_function(**kwargs)
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+        teardown_test_environment()
+
+    print(json.dumps(results, indent=2))
+    if options.output:
+        try:
+            version = metadata.version('tom-eso')
+        except metadata.PackageNotFoundError:
+            version = 'unknown'
+        with open(options.output, 'w') as output_file:
+            json.dump({
+                'tom_eso_version': version,
+                'python_version': platform.python_version(),
+                'created': datetime.now(timezone.utc).isoformat(),
+                'fake_p2_options': fake_p2_options,
+                'benchmarks': results,
+            }, output_file, indent=2)
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_results(baseline.get('benchmarks', baseline), results, options.threshold)
+        for path, baseline_value, value in regressions:
+            print(f'REGRESSION {path}: {baseline_value:.3f} -> {value:.3f} ({value / baseline_value:.2f}x)',
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+    return results
@@ -38,6 +38,7 @@ def boot_django():
             'django_comments',
             'bootstrap4',
             'crispy_forms',
+            'crispy_bootstrap4',
             'rest_framework',
             'rest_framework.authtoken',
             'django_filters',
@@ -89,12 +90,14 @@ def boot_django():
             'guardian.backends.ObjectPermissionBackend',
         ),
         AUTH_STRATEGY='READ_ONLY',
+        TARGET_PERMISSIONS_ONLY=True,
+        CRISPY_TEMPLATE_PACK='bootstrap4',
         STATIC_URL='/static/',
         STATIC_ROOT=os.path.join(BASE_DIR, '_static'),
         STATICFILES_DIRS=[os.path.join(BASE_DIR, 'static')],
         MEDIA_ROOT=os.path.join(BASE_DIR, 'data'),
         MEDIA_URL='/data/',
-        # ROOT_URLCONF='tom_tns.tests.urls.test_urls',
+        ROOT_URLCONF='tom_common.urls',
         TOM_REGISTRATION={
             'REGISTRATION_AUTHENTICATION_BACKEND': 'django.contrib.auth.backends.ModelBackend',
             'REGISTRATION_REDIRECT_PATTERN': 'home',
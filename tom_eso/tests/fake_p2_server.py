@@ -0,0 +1,271 @@
+"""
+A local fake of the ESO P2 API, so that tom_eso can be benchmarked (and tested) offline, through
+the real ``p2api.ApiConnection`` and its HTTP requests.
+
+The fake serves a synthetic account of ``n_runs`` observing runs, each with ``n_folders`` folders
+of ``n_obs`` observation blocks, and implements the P2 endpoints that tom_eso uses (login,
+``getUser``, ``getRuns``, ``getRun``, ``getItems``, ``getOB``, ``createOB`` and ``saveOB``), with
+ETags and conditional requests. Every request takes ``latency`` seconds, and a fraction
+``error_rate`` of the API requests fail with a 503, like ESO does when P2 is overloaded::
+
+    with run_fake_p2_server(latency=0.05, n_runs=3, n_folders=10, n_obs=20) as server:
+        api2 = p2api.ApiConnection('demo', '52052', 'tutorial')  # logs in to the fake server
+        runs, _ = api2.getRuns()
+        server.request_counts  # {'login': 1, 'getRuns': 1}
+
+``run_fake_p2_server()`` points p2api's URLs for the ``demo`` environment at the fake server
+for the duration of the ``with`` block.
+"""
+import json
+import random
+import re
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs
+
+import p2api.p2api
+
+ACCESS_TOKEN = 'fake-p2-access-token'
+FIRST_RUN_ID = 60900001
+TELESCOPES_AND_INSTRUMENTS = [('UT1', 'FORS2'), ('UT2', 'UVES'), ('UT3', 'SPHERE'), ('UT4', 'MUSE')]
+
+# the routes of the fake API: (method, path pattern, p2api method, FakeP2RequestHandler method)
+ROUTES = [
+    ('GET', r'/authenticatedUser', 'getUser', 'get_user'),
+    ('GET', r'/obsRuns', 'getRuns', 'get_runs'),
+    ('GET', r'/obsRuns/(\d+)', 'getRun', 'get_run'),
+    ('GET', r'/containers/(\d+)/items', 'getItems', 'get_items'),
+    ('POST', r'/containers/(\d+)/items', 'createOB', 'create_item'),
+    ('GET', r'/obsBlocks/(\d+)', 'getOB', 'get_ob'),
+    ('PUT', r'/obsBlocks/(\d+)', 'saveOB', 'save_ob'),
+]
+
+
+class FakeP2Account:
+    """The synthetic observing runs, folders and observation blocks of the fake P2 account."""
+
+    def __init__(self, n_runs=2, n_folders=5, n_obs=10):
+        self.runs = {}
+        self.containers = {}  # containerId -> list of items
+        self.observation_blocks = {}  # obId -> observation block
+        self.versions = {}  # resource path -> version, for the ETags
+        self._next_id = 1000
+        self._lock = threading.Lock()
+
+        for run_index in range(n_runs):
+            run_id = FIRST_RUN_ID + run_index
+            telescope, instrument = TELESCOPES_AND_INSTRUMENTS[run_index % len(TELESCOPES_AND_INSTRUMENTS)]
+            container_id = self._new_id()
+            self.runs[run_id] = {'runId': run_id, 'containerId': container_id, 'progId': f'60.A-{9000 + run_index}(A)',
+                                 'telescope': telescope, 'instrument': instrument, 'mode': 'SM'}
+            self.containers[container_id] = []
+            for folder_index in range(n_folders):
+                folder_id = self._new_id()
+                self.containers[container_id].append(
+                    {'containerId': folder_id, 'name': f'Folder {folder_index + 1}', 'itemType': 'Folder'})
+                self.containers[folder_id] = []
+                for ob_index in range(n_obs):
+                    self.create_ob(folder_id, f'OB {folder_index + 1}.{ob_index + 1}')
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def version(self, path):
+        return f'"{self.versions.get(path, 0)}"'
+
+    def changed(self, path):
+        self.versions[path] = self.versions.get(path, 0) + 1
+
+    def create_ob(self, container_id, name):
+        with self._lock:
+            ob_id = self._new_id()
+            observation_block = {
+                'obId': ob_id, 'name': name, 'itemType': 'OB', 'obStatus': 'P', 'ipVersion': 104.09,
+                'target': {'name': '', 'ra': '00:00:00.000', 'dec': '00:00:00.000', 'epoch': 2000.0},
+                'constraints': {'name': 'No Name', 'airmass': 5.0, 'skyTransparency': 'Variable, thick cirrus'},
+            }
+            self.observation_blocks[ob_id] = observation_block
+            self.containers[container_id].append({'obId': ob_id, 'name': name, 'itemType': 'OB', 'obStatus': 'P'})
+            self.changed(f'/containers/{container_id}/items')
+            return observation_block
+
+    def save_ob(self, ob_id, observation_block):
+        with self._lock:
+            self.observation_blocks[ob_id] = observation_block
+            self.changed(f'/obsBlocks/{ob_id}')
+            return observation_block
+
+
+class FakeP2RequestHandler(BaseHTTPRequestHandler):
+    """Handle the requests to a ``FakeP2Server``."""
+    server_version = 'FakeP2/1.0'
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass  # the benchmarks make thousands of requests
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_PUT(self):
+        self.handle_request()
+
+    def handle_request(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        if server.latency:
+            time.sleep(server.latency)
+
+        if self.path == '/login':
+            server.count_request('login')
+            credentials = parse_qs(body.decode())
+            if self.command != 'POST' or not credentials.get('username') or not credentials.get('password'):
+                return self.send_json(401, {'error': 'cannot login'})
+            return self.send_json(200, {'access_token': ACCESS_TOKEN})
+
+        if not self.path.startswith('/api/v1/'):
+            return self.send_json(404, {'error': f'Not found: {self.path}'})
+        path = self.path[len('/api/v1'):]
+        for method, pattern, p2api_method, handler_name in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if method == self.command and match:
+                break
+        else:
+            return self.send_json(404, {'error': f'Not found: {self.command} {path}'})
+
+        server.count_request(p2api_method)
+        if self.headers.get('Authorization') != f'Bearer {ACCESS_TOKEN}':
+            return self.send_json(401, {'error': 'Unauthorized'})
+        if server.should_fail():
+            return self.send_json(503, {'error': 'Service Unavailable'})
+        data = json.loads(body) if body else None
+        getattr(self, handler_name)(path, data, *(int(group) for group in match.groups()))
+
+    def send_json(self, status, data, version=None):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if version:
+            self.send_header('ETag', version)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_resource(self, path, data):
+        """Send ``data`` with the version of ``path`` as its ETag, or a 304 if the client has that version."""
+        version = self.server.account.version(path)
+        if self.headers.get('If-None-Match') == version:
+            self.send_response(304)
+            self.send_header('ETag', version)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_json(200, data, version)
+
+    def get_user(self, path, data):
+        self.send_json(200, {'userId': 52052, 'username': '52052', 'firstName': 'Fake', 'lastName': 'P2'})
+
+    def get_runs(self, path, data):
+        self.send_resource(path, list(self.server.account.runs.values()))
+
+    def get_run(self, path, data, run_id):
+        if run_id not in self.server.account.runs:
+            return self.send_json(404, {'error': f'Observing run {run_id} not found'})
+        self.send_resource(path, self.server.account.runs[run_id])
+
+    def get_items(self, path, data, container_id):
+        if container_id not in self.server.account.containers:
+            return self.send_json(404, {'error': f'Container {container_id} not found'})
+        self.send_resource(path, list(self.server.account.containers[container_id]))
+
+    def create_item(self, path, data, container_id):
+        account = self.server.account
+        if container_id not in account.containers:
+            return self.send_json(404, {'error': f'Container {container_id} not found'})
+        if not data or data.get('itemType') != 'OB':
+            return self.send_json(400, {'error': 'The fake P2 API can only create OBs'})
+        observation_block = account.create_ob(container_id, data['name'])
+        self.send_json(201, observation_block, account.version(f'/obsBlocks/{observation_block["obId"]}'))
+
+    def get_ob(self, path, data, ob_id):
+        if ob_id not in self.server.account.observation_blocks:
+            return self.send_json(404, {'error': f'Observation block {ob_id} not found'})
+        self.send_resource(path, self.server.account.observation_blocks[ob_id])
+
+    def save_ob(self, path, data, ob_id):
+        account = self.server.account
+        if ob_id not in account.observation_blocks:
+            return self.send_json(404, {'error': f'Observation block {ob_id} not found'})
+        if self.headers.get('If-Match') != account.version(path):
+            return self.send_json(412, {'error': 'The observation block was modified by someone else'})
+        observation_block = account.save_ob(ob_id, data)
+        self.send_json(200, observation_block, account.version(path))
+
+
+class FakeP2Server(ThreadingHTTPServer):
+    """A fake ESO P2 API server on a free local port, serving a ``FakeP2Account``.
+
+    ``latency`` is the time (in seconds) that every request takes, and ``error_rate`` is the
+    fraction of the API requests (not logins) that fail with a 503 Service Unavailable.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, n_runs=2, n_folders=5, n_obs=10, seed=0):
+        super().__init__(('127.0.0.1', 0), FakeP2RequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.account = FakeP2Account(n_runs=n_runs, n_folders=n_folders, n_obs=n_obs)
+        self.request_counts = {}  # p2api method (or 'login') -> number of requests
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    @property
+    def api_url(self):
+        return f'{self.base_url}/api/v1'
+
+    @property
+    def login_url(self):
+        return f'{self.base_url}/login'
+
+    def count_request(self, name):
+        with self._lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+@contextmanager
+def run_fake_p2_server(environment='demo', **options):
+    """Run a ``FakeP2Server`` (with the given options), with p2api's ``environment`` pointed at it."""
+    server = FakeP2Server(**options)
+    server.start()
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(mock.patch.dict(p2api.p2api.API_URL, {environment: server.api_url}))
+            stack.enter_context(mock.patch.dict(p2api.p2api.LOGIN_URL, {environment: server.login_url}))
+            yield server
+    finally:
+        server.stop()
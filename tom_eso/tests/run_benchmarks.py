@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# run_benchmarks.py
+
+import sys
+
+from boot_django import boot_django
+
+boot_django()
+
+from tom_eso.tests.benchmarks import main  # noqa: E402 (Django must be booted first)
+
+main(sys.argv[1:])
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+
+from tom_eso import views
+from tom_eso.connections import get_connection_pool
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+P2_LATENCY = 0.1  # seconds per fake P2 call
+
+
+def slow_p2_connection():
+    """Return a mock p2api.ApiConnection that takes P2_LATENCY seconds to answer each call."""
+    api2 = mock.MagicMock()
+
+    def get_run(run_id):
+        time.sleep(P2_LATENCY)
+        return {'runId': run_id, 'containerId': 1000 + run_id}, '"run"'
+
+    def get_items(container_id):
+        time.sleep(P2_LATENCY)
+        return [], '"items"'
+
+    api2.getRun.side_effect = get_run
+    api2.getItems.side_effect = get_items
+    return api2
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestAsyncViews(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        self.user = User.objects.create(username='eso_user')
+        self.addCleanup(get_connection_pool().clear)
+
+    def patch_p2(self, api2):
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=api2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return request
+
+    async def test_folders_for_observing_run_async(self):
+        self.patch_p2(fake_p2_connection())
+        response = await views.folders_for_observing_run_async(self.request({'p2_observing_run': 1}))
+        self.assertContains(response, 'Folder 1')
+
+    async def test_observation_blocks_for_folder_async(self):
+        self.patch_p2(fake_p2_connection())
+        response = await views.observation_blocks_for_folder_async(self.request({'p2_folder_name': 11}))
+        self.assertContains(response, 'OB 1')
+
+    async def test_mirror_is_not_read_in_the_executor(self):
+        self.patch_p2(fake_p2_connection())
+        mirror_threads = []
+
+        def mirror_choices(method_name, choices):
+            def read(mirror, *args):
+                mirror_threads.append((method_name, threading.current_thread().name))
+                return choices
+            return mock.patch(f'tom_eso.mirror.P2Mirror.{method_name}', autospec=True, side_effect=read)
+
+        with (mirror_choices('folder_name_choices', [(11, 'Mirrored folder')]),
+              mirror_choices('observation_block_choices', [(12, 'Mirrored OB')])):
+            folders = await views.folders_for_observing_run_async(self.request({'p2_observing_run': 1}))
+            obs = await views.observation_blocks_for_folder_async(self.request({'p2_folder_name': 11}))
+
+        self.assertContains(folders, 'Mirrored folder')
+        self.assertContains(obs, 'Mirrored OB')
+        self.assertEqual([method_name for method_name, _ in mirror_threads],
+                         ['folder_name_choices', 'observation_block_choices'])  # read once each
+        self.assertFalse([thread for _, thread in mirror_threads if thread.startswith('tom_eso_async')])
+
+    async def test_show_observation_block_async_without_parameter(self):
+        response = await views.show_observation_block_async(self.request({}))
+        self.assertContains(response, 'about:blank')
+
+    async def test_slow_p2_calls_are_served_concurrently(self):
+        """N requests, each waiting on two slow P2 calls, take about as long as one request, not N."""
+        self.patch_p2(slow_p2_connection())
+        n_requests = 8
+        requests = [self.request({'p2_observing_run': run_id}) for run_id in range(1, n_requests + 1)]
+
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[views.folders_for_observing_run_async(r) for r in requests])
+        elapsed = time.perf_counter() - start
+
+        serial_time = n_requests * 2 * P2_LATENCY  # getRun + getItems per request
+        throughput = n_requests / elapsed
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        self.assertLess(elapsed, serial_time / 2,
+                        f'{n_requests} requests took {elapsed:.2f}s ({throughput:.1f} requests/s); '
+                        f'serially they would take {serial_time:.2f}s')
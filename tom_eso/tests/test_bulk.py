@@ -0,0 +1,134 @@
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from tom_targets.models import Target, TargetList
+
+from tom_eso import views
+from tom_eso.connections import get_connection_pool
+from tom_eso.eso import ESOFacility
+from tom_eso.forms import ESOBulkObservationBlockForm
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestBulkObservationBlocks(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        self.user = User.objects.create(username='eso_user')
+        self.targets = [
+            Target.objects.create(name=name, type=Target.SIDEREAL, ra=10.0 * i, dec=-5.0 * i)
+            for i, name in enumerate(['M31', 'M33', 'M51'], start=1)
+        ]
+        self.api2 = fake_p2_connection()
+        self.api2.createOB.side_effect = self.create_ob
+        self.api2.saveOB.side_effect = lambda ob, version: (ob, '"saved"')
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=self.api2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_connection_pool().clear)
+
+        self.facility = ESOFacility()
+        self.facility.set_user(self.user)
+
+    def create_ob(self, folder_id, ob_name):
+        if ob_name.startswith('M33'):
+            raise Exception('createOB failed')
+        return {'obId': 100 + len(ob_name), 'name': ob_name, 'target': {}}, '"new"'
+
+    def test_each_target_gets_a_result(self):
+        bulk_result = self.facility.submit_observation_blocks_for_targets(
+            11, self.targets, ob_name_template='{target_name} imaging')
+
+        self.assertEqual(bulk_result['created'], 2)
+        self.assertEqual(bulk_result['failed'], 1)
+        self.assertGreaterEqual(bulk_result['wall_time'], 0)
+        results = bulk_result['results']
+        self.assertEqual([result['target_name'] for result in results], ['M31', 'M33', 'M51'])
+        self.assertEqual(results[0]['ob_name'], 'M31 imaging')
+        self.assertIn('ob_id', results[0])
+        self.assertEqual(results[1]['error'], 'createOB failed')
+        self.assertNotIn('ob_id', results[1])
+
+        saved_targets = sorted(call.args[0]['target']['name'] for call in self.api2.saveOB.call_args_list)
+        self.assertEqual(saved_targets, ['M31', 'M51'])
+
+    def test_target_ids_are_loaded_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            bulk_result = self.facility.submit_observation_blocks_for_targets(
+                11, [target.id for target in self.targets])
+        self.assertEqual(len(bulk_result['results']), 3)
+        target_queries = [query for query in queries if Target._meta.db_table in query['sql']]
+        self.assertEqual(len(target_queries), 1)
+
+    def test_target_list(self):
+        target_list = TargetList.objects.create(name='Galaxies')
+        target_list.targets.add(self.targets[0], self.targets[2])
+
+        bulk_result = self.facility.submit_observation_blocks_for_targets(11, target_list)
+        self.assertEqual(bulk_result['created'], 2)
+
+    def test_observation_blocks_are_created_concurrently(self):
+        in_flight = []
+        max_in_flight = []
+        lock = threading.Lock()
+
+        def slow_create_ob(folder_id, ob_name):
+            with lock:
+                in_flight.append(ob_name)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(ob_name)
+            return {'obId': 1, 'name': ob_name, 'target': {}}, '"new"'
+
+        self.api2.createOB.side_effect = slow_create_ob
+        self.facility.submit_observation_blocks_for_targets(11, self.targets, max_workers=3)
+        self.assertGreater(max(max_in_flight), 1)
+
+    def test_requires_credentials(self):
+        with mock.patch('tom_eso.eso.get_connection_pool') as get_pool:
+            get_pool.return_value.acquire.side_effect = Exception('bad credentials')
+            facility = ESOFacility()
+            facility.set_user(self.user)
+
+        with self.assertRaises(ValueError):
+            facility.submit_observation_blocks_for_targets(11, self.targets)
+
+    def ob_name_template_errors(self, ob_name_template):
+        form = ESOBulkObservationBlockForm(
+            data={'ob_name_template': ob_name_template}, facility=self.facility,
+            targets=Target.objects.filter(pk__in=[target.pk for target in self.targets]))
+        form.is_valid()
+        return form.errors.get('ob_name_template')
+
+    def test_ob_name_template_fields(self):
+        self.assertIsNone(self.ob_name_template_errors('{target_name} ({target_id}) imaging'))
+        for ob_name_template in ['{target_name.__class__}', '{target_name[0]}', '{target_id!r}',
+                                 '{target_id:>10}', '{ra}', '{}', '{target_name']:
+            with self.subTest(ob_name_template=ob_name_template):
+                self.assertIsNotNone(self.ob_name_template_errors(ob_name_template))
+
+    def test_view_lists_the_targets_the_user_can_view(self):
+        target_list = TargetList.objects.create(name='Galaxies')
+        target_list.targets.add(*self.targets)
+        request = RequestFactory().get('/')
+        request.user = self.user
+
+        with override_settings(TARGET_PERMISSIONS_ONLY=False):
+            response = views.TargetListObservationBlocksView.as_view()(request, pk=target_list.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context_data['form'].fields['targets'].queryset), [])
+
+        self.user.is_superuser = True
+        self.user.save()
+        response = views.TargetListObservationBlocksView.as_view()(request, pk=target_list.pk)
+        self.assertEqual(set(response.context_data['form'].fields['targets'].queryset), set(self.targets))
+        response.render()
+        self.assertContains(response, 'div_id_p2_folder_name')
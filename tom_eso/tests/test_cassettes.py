@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+
+import p2api
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from tom_eso import circuit_breaker
+from tom_eso.cassettes import Cassette, CassetteMissError, RECORD, REPLAY, scrub, use_cassette
+from tom_eso.eso_api import ESOAPI, NOT_MODIFIED
+from tom_eso.tests.fake_p2_server import run_fake_p2_server
+from tom_eso.tests.test_views import TEST_FACILITIES
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestCassettes(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(circuit_breaker._circuit_breakers.clear)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'p2.jsonl')
+
+    def record_session(self):
+        """Record a session against the fake P2 server. Return the folder choices it got."""
+        with run_fake_p2_server(n_runs=1, n_folders=2, n_obs=3, latency=0.01) as server:
+            run_id = next(iter(server.account.runs))
+            with use_cassette(self.path, mode=RECORD):
+                eso_api = ESOAPI('demo', '52052', 'tutorial')
+                folder_choices = eso_api.folder_name_choices(run_id)  # getItems of the run and its 2 folders
+                eso_api.folder_ob_choices(folder_choices[0][0])  # from the response cache
+                try:
+                    eso_api.getOB(1)  # no such OB: a 404
+                except p2api.P2Error:
+                    pass
+        return run_id, folder_choices
+
+    def test_recording_is_scrubbed_of_credentials(self):
+        self.record_session()
+
+        with open(self.path) as cassette_file:
+            recording = cassette_file.read()
+        interactions = [json.loads(line) for line in recording.splitlines()]
+        self.assertEqual([interaction['method'] for interaction in interactions],
+                         ['login', 'getRun', 'getItems', 'getItems', 'getItems', 'getOB'])
+        self.assertNotIn('tutorial', recording)
+        self.assertNotIn('52052', recording)
+        self.assertEqual(interactions[-1]['error']['args'][0], 404)
+
+    def test_replay_without_network(self):
+        run_id, folder_choices = self.record_session()  # the fake server is stopped after this
+
+        with use_cassette(self.path, mode=REPLAY, timing_scale=0) as cassette:
+            eso_api = ESOAPI('demo', '52052', 'tutorial')
+            self.assertEqual(eso_api.folder_name_choices(run_id), folder_choices)
+            self.assertEqual(len(eso_api.folder_ob_choices(folder_choices[0][0])), 3)
+            with self.assertRaises(p2api.P2Error):
+                eso_api.getOB(1)
+
+        report = cassette.report()
+        self.assertEqual(report['misses'], 0)
+        self.assertEqual(report['methods']['Phase 2 getItems']['recorded_calls'], 3)
+        self.assertEqual(report['methods']['Phase 2 getItems']['replayed_calls'], 3)
+        self.assertGreater(report['methods']['Phase 2 getItems']['recorded_seconds'], 0)
+        self.assertEqual(report['methods']['Phase 2 getItems']['replayed_seconds'], 0)
+
+    def test_unrecorded_methods_miss(self):
+        self.record_session()
+
+        with use_cassette(self.path, mode=REPLAY, timing_scale=0) as cassette:
+            with self.assertRaises(CassetteMissError):
+                ESOAPI('demo', '52052', 'tutorial').api2.createOB(10, 'New OB')
+        self.assertEqual(cassette.report()['misses'], 1)
+
+    def test_conditional_requests_are_recorded(self):
+        with run_fake_p2_server(), use_cassette(self.path, mode=RECORD):
+            eso_api = ESOAPI('demo', '52052', 'tutorial')
+            _, version = eso_api.api2.getRuns()
+            eso_api._revalidate('/obsRuns', version)
+
+        with use_cassette(self.path, mode=REPLAY, timing_scale=0):
+            eso_api = ESOAPI('demo', '52052', 'tutorial')
+            self.assertIs(eso_api._revalidate('/obsRuns', version), NOT_MODIFIED)
+
+
+class TestReplayTiming(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'p2.jsonl')
+        interactions = [
+            {'phase': 'Phase 2', 'account': 'a', 'method': 'getItems', 'args': [10], 'duration': 0.5,
+             'result': [[{'obId': 1}], '"1"'], 'tuple': True},
+            {'phase': 'Phase 2', 'account': 'a', 'method': 'getItems', 'args': [10], 'duration': 0.25,
+             'result': [[{'obId': 1}, {'obId': 2}], '"2"'], 'tuple': True},
+        ]
+        with open(self.path, 'w') as cassette_file:
+            cassette_file.writelines(json.dumps(interaction) + '\n' for interaction in interactions)
+
+    def test_scaled_timing_and_order(self):
+        sleeps = []
+        cassette = Cassette(self.path, mode=REPLAY, timing_scale=2, sleep=sleeps.append)
+
+        first = cassette.replay('Phase 2', 'a', 'getItems', [10])
+        second = cassette.replay('Phase 2', 'a', 'getItems', [10])
+        third = cassette.replay('Phase 2', 'b', 'getItems', [10])  # another account: the last recording again
+
+        self.assertEqual(first, ([{'obId': 1}], '"1"'))
+        self.assertEqual(second[1], '"2"')
+        self.assertEqual(third, second)
+        self.assertEqual(sleeps, [1.0, 0.5, 0.5])
+
+    def test_scrub(self):
+        self.assertEqual(scrub({'username': 'me', 'Password': 'secret', 'nested': [{'access_token': 'abc'}]}),
+                         {'username': 'me', 'Password': '<scrubbed>', 'nested': [{'access_token': '<scrubbed>'}]})
@@ -0,0 +1,64 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from tom_observations.facility import CredentialStatus
+
+from tom_eso.choice_cache import credential_key, get_choice_cache
+from tom_eso.eso import ESOFacility
+
+
+def make_facility(eso_api):
+    facility = ESOFacility()
+    facility.eso_api = eso_api
+    facility.credential_status = CredentialStatus.USING_USER_CREDS
+    return facility
+
+
+class TestChoiceCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.eso_api = mock.Mock(environment='demo', username='52052', password='tutorial')
+        self.eso_api.folder_ob_choices.return_value = [(1, 'OB 1 : OB'), (2, 'OB 2 : OB')]
+
+    def test_choices_are_shared_between_facilities(self):
+        first = make_facility(self.eso_api).get_observation_block_choices(10)
+        # e.g. another request, served by another worker using the same cache backend
+        second = make_facility(self.eso_api).get_observation_block_choices(10)
+
+        self.assertEqual(first, second)
+        self.assertEqual(second, [(1, 'OB 1 : OB'), (2, 'OB 2 : OB')])
+        self.eso_api.folder_ob_choices.assert_called_once_with(10)
+
+    def test_cache_keys_do_not_contain_credentials(self):
+        make_facility(self.eso_api).get_observation_block_choices(10)
+        key = get_choice_cache().make_key(credential_key('demo', '52052', 'tutorial'), 'observation_blocks', 10)
+
+        self.assertIsNotNone(cache.get(key))
+        self.assertNotIn('tutorial', key)
+        self.assertNotIn('52052', key)
+
+    def test_error_choices_are_not_cached(self):
+        self.eso_api.folder_ob_choices.return_value = [(0, 'Are there any items in this folder?')]
+        make_facility(self.eso_api).get_observation_block_choices(10)
+        make_facility(self.eso_api).get_observation_block_choices(10)
+
+        self.assertEqual(self.eso_api.folder_ob_choices.call_count, 2)
+
+    def test_choices_are_keyed_per_credential_set(self):
+        other_eso_api = mock.Mock(environment='demo', username='someone_else', password='tutorial')
+        other_eso_api.folder_ob_choices.return_value = [(3, 'OB 3 : OB')]
+        make_facility(self.eso_api).get_observation_block_choices(10)
+
+        self.assertEqual(make_facility(other_eso_api).get_observation_block_choices(10), [(3, 'OB 3 : OB')])
+
+    def test_a_wrong_password_is_not_served_cached_choices(self):
+        wrong_password_eso_api = mock.Mock(environment='demo', username='52052', password='wrong')
+        wrong_password_eso_api.folder_ob_choices.side_effect = Exception('401 Unauthorized')
+        make_facility(self.eso_api).get_observation_block_choices(10)
+
+        choices = make_facility(wrong_password_eso_api).get_observation_block_choices(10)
+
+        self.assertNotIn((1, 'OB 1 : OB'), choices)
+        wrong_password_eso_api.folder_ob_choices.assert_called_once_with(10)
@@ -0,0 +1,193 @@
+from unittest import mock
+
+import requests
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from p2api.p2api import P2Error
+
+from tom_eso import circuit_breaker
+from tom_eso.choice_cache import credential_key, get_choice_cache
+from tom_eso.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from tom_eso.connections import get_connection_pool
+from tom_eso.eso import CredentialStatus, ESOFacility
+from tom_eso.eso_api import ESOAPI
+from tom_eso.models import ESOProfile
+from tom_eso.tests.test_throttling import FakeClock
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+OUTAGE_FACILITIES = {
+    'ESO': {
+        **TEST_FACILITIES['ESO'],
+        'retries': {'max_retries': 0},
+        'circuit_breaker': {'failure_threshold': 2, 'reset_timeout': 30},
+    },
+}
+
+
+def fail():
+    raise requests.ConnectionError('ESO is down')
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker('demo', failure_threshold=3, reset_timeout=30, clock=self.clock)
+
+    def fail_times(self, count):
+        for _ in range(count):
+            with self.assertRaises(requests.ConnectionError):
+                self.breaker.call(fail)
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail_times(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.fail_times(1)
+        self.assertEqual(self.breaker.state, OPEN)
+
+        func = mock.Mock()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(func)
+        func.assert_not_called()
+
+    def test_success_resets_the_failure_count(self):
+        self.fail_times(2)
+        self.breaker.call(lambda: None)
+        self.fail_times(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_other_errors_do_not_count(self):
+        def not_found():
+            raise P2Error(404, 'GET', '/obsRuns/1', 'not found')
+        for _ in range(5):
+            with self.assertRaises(P2Error):
+                self.breaker.call(not_found)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_probe_closes_the_circuit(self):
+        self.fail_times(3)
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+        self.assertEqual(self.breaker.call(lambda: 'runs'), 'runs')
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_failed_probe_reopens_the_circuit(self):
+        self.fail_times(3)
+        self.clock.now += 30
+        self.fail_times(1)
+
+        self.assertEqual(self.breaker.state, OPEN)
+        self.clock.now += 29
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_only_one_probe_at_a_time(self):
+        self.fail_times(3)
+        self.clock.now += 30
+
+        def probe():
+            # another call, made while the probe is in flight, fails fast
+            with self.assertRaises(CircuitOpenError):
+                self.breaker.call(lambda: None)
+            return 'runs'
+        self.assertEqual(self.breaker.call(probe), 'runs')
+
+
+@override_settings(FACILITIES=OUTAGE_FACILITIES)
+class TestStaleChoicesDuringOutage(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        self.addCleanup(get_connection_pool().clear)
+        self.addCleanup(circuit_breaker._circuit_breakers.clear)
+        self.user = User.objects.create(username='eso_user')
+        self.api2 = fake_p2_connection()
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=self.api2)
+        self.api_connection = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def facility(self):
+        facility = ESOFacility()
+        facility.set_user(self.user)
+        return facility
+
+    def test_last_known_choices_are_served_while_eso_is_down(self):
+        self.facility().get_observing_run_choices()
+        # the fresh cache entries expire
+        get_choice_cache().delete(credential_key('demo', '52052', 'tutorial'), 'observing_runs')
+        get_connection_pool().clear()
+        self.api2.getRuns.side_effect = requests.ConnectionError('ESO is down')
+
+        facility = self.facility()
+        choices = facility.get_observing_run_choices()
+
+        self.assertEqual(choices[0][0], '')
+        self.assertIn('ESO P2 is unavailable', choices[0][1])
+        self.assertEqual(choices[1:], [(1, '60.A-9252(M) - UT2 - UVES')])
+        self.assertIn('observing_runs', facility.stale_choices)
+
+    def expire_pooled_connections(self):
+        patcher = mock.patch.object(get_connection_pool(), 'idle_ttl', -1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_last_known_choices_are_served_without_a_pooled_connection(self):
+        self.facility().get_observing_run_choices()
+        get_choice_cache().delete(credential_key('demo', '52052', 'tutorial'), 'observing_runs')
+        self.expire_pooled_connections()
+        self.api_connection.side_effect = requests.ConnectionError('ESO is down')  # logins fail
+        for _ in range(2):
+            self.facility()
+        self.assertEqual(circuit_breaker.get_circuit_breaker('demo').state, OPEN)
+
+        facility = self.facility()
+        choices = facility.get_observing_run_choices()
+
+        self.assertEqual(self.api_connection.call_count, 3)  # no login attempted while the circuit is open
+        self.assertEqual(facility.credential_status, CredentialStatus.USING_DEFAULTS)  # not an auth failure
+        self.assertIn('ESO P2 is unavailable', choices[0][1])
+        self.assertEqual(choices[1:], [(1, '60.A-9252(M) - UT2 - UVES')])
+
+    @mock.patch('tom_eso.eso.get_encrypted_field', return_value='wrong password')
+    def test_unverified_credentials_get_nothing_while_eso_is_down(self, get_encrypted_field):
+        # another user of the same P2 account, with a password that has never logged in
+        other_user = User.objects.create(username='other_user')
+        ESOProfile.objects.create(user=other_user, p2_environment='demo', p2_username='52052')
+        self.facility().get_observing_run_choices()
+        get_choice_cache().delete(credential_key('demo', '52052', 'tutorial'), 'observing_runs')
+        self.expire_pooled_connections()
+        self.api_connection.side_effect = requests.ConnectionError('ESO is down')  # logins fail
+
+        facility = ESOFacility()
+        facility.set_user(other_user)
+
+        self.assertEqual(facility.credential_status, CredentialStatus.VALIDATION_FAILED_NETWORK)
+        self.assertIsNone(facility.eso_api)
+        choices = facility.get_observing_run_choices()
+        self.assertNotIn((1, '60.A-9252(M) - UT2 - UVES'), choices)
+        self.assertEqual(facility.search_p2_names('UVES'), [])
+        # the credentials that logged in before are still served the last known choices
+        choices = self.facility().get_observing_run_choices()
+        self.assertEqual(choices[1:], [(1, '60.A-9252(M) - UT2 - UVES')])
+
+    def test_calls_fail_fast_while_the_circuit_is_open(self):
+        self.api2.getRuns.side_effect = requests.ConnectionError('ESO is down')
+        for _ in range(2):
+            self.facility().get_observing_run_choices()
+        self.assertEqual(self.api2.getRuns.call_count, 2)
+
+        choices = self.facility().get_observing_run_choices()
+
+        self.assertEqual(self.api2.getRuns.call_count, 2)  # not called again
+        self.assertEqual(choices[0][0], 0)
+        self.assertIn('unavailable', choices[0][1])
+
+    def test_eso_api_raises_circuit_open_error(self):
+        self.api2.getItems.side_effect = P2Error(503, 'GET', '/containers/10/items', 'unavailable')
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+        for _ in range(2):
+            with self.assertRaises(P2Error):
+                eso_api.folder_ob_choices(10)
+
+        with self.assertRaises(CircuitOpenError):
+            eso_api.folder_ob_choices(10)
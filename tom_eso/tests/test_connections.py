@@ -0,0 +1,175 @@
+import threading
+import time
+from unittest import mock
+
+import requests
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from tom_eso import circuit_breaker
+from tom_eso.connections import ESOConnectionPool, get_connection_pool
+from tom_eso.models import ESOProfile
+
+
+@mock.patch('tom_eso.connections.ESOAPI')
+class TestESOConnectionPool(TestCase):
+    def setUp(self):
+        self.addCleanup(circuit_breaker._circuit_breakers.clear)
+
+    def test_connection_is_reused(self, mock_esoapi):
+        pool = ESOConnectionPool()
+        first = pool.acquire('demo', '52052', 'tutorial')
+        second = pool.acquire('demo', '52052', 'tutorial')
+
+        self.assertIs(first, second)
+        mock_esoapi.assert_called_once_with('demo', '52052', 'tutorial')
+
+    def test_connections_are_keyed_by_environment_and_username(self, mock_esoapi):
+        pool = ESOConnectionPool()
+        pool.acquire('demo', '52052', 'tutorial')
+        pool.acquire('production', '52052', 'tutorial')
+        pool.acquire('demo', 'someone_else', 'tutorial')
+
+        self.assertEqual(mock_esoapi.call_count, 3)
+        self.assertEqual(len(pool), 3)
+
+    def test_different_password_logs_in_again(self, mock_esoapi):
+        pool = ESOConnectionPool()
+        pool.acquire('demo', '52052', 'tutorial')
+        pool.acquire('demo', '52052', 'not the password')
+
+        self.assertEqual(mock_esoapi.call_count, 2)
+
+    def test_idle_connection_expires(self, mock_esoapi):
+        pool = ESOConnectionPool(idle_ttl=10)
+        with mock.patch('tom_eso.connections.time.monotonic', return_value=1000.0):
+            pool.acquire('demo', '52052', 'tutorial')
+        with mock.patch('tom_eso.connections.time.monotonic', return_value=1011.0):
+            pool.acquire('demo', '52052', 'tutorial')
+
+        self.assertEqual(mock_esoapi.call_count, 2)
+
+    def test_token_is_refreshed_before_expiry(self, mock_esoapi):
+        pool = ESOConnectionPool(token_lifetime=100, refresh_margin=20, idle_ttl=1000, health_check_interval=1000)
+        with mock.patch('tom_eso.connections.time.monotonic', return_value=0.0):
+            pool.acquire('demo', '52052', 'tutorial')
+        with mock.patch('tom_eso.connections.time.monotonic', return_value=70.0):
+            pool.acquire('demo', '52052', 'tutorial')
+        self.assertEqual(mock_esoapi.call_count, 1)
+
+        with mock.patch('tom_eso.connections.time.monotonic', return_value=81.0):
+            pool.acquire('demo', '52052', 'tutorial')
+        self.assertEqual(mock_esoapi.call_count, 2)
+
+    def test_failed_health_check_logs_in_again(self, mock_esoapi):
+        pool = ESOConnectionPool(health_check_interval=10, idle_ttl=1000)
+        with mock.patch('tom_eso.connections.time.monotonic', return_value=0.0):
+            eso_api = pool.acquire('demo', '52052', 'tutorial')
+        eso_api.api2.getUser.side_effect = Exception('401 Unauthorized')
+        with mock.patch('tom_eso.connections.time.monotonic', return_value=11.0):
+            pool.acquire('demo', '52052', 'tutorial')
+
+        eso_api.api2.getUser.assert_called_once()
+        self.assertEqual(mock_esoapi.call_count, 2)
+
+    def test_failed_login_is_not_pooled(self, mock_esoapi):
+        mock_esoapi.side_effect = Exception('cannot login')
+        pool = ESOConnectionPool()
+        with self.assertRaises(Exception):
+            pool.acquire('demo', '52052', 'wrong')
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool._key_locks, {})
+
+    def test_wrong_password_does_not_evict_the_pooled_connection(self, mock_esoapi):
+        pool = ESOConnectionPool()
+        eso_api = pool.acquire('demo', '52052', 'tutorial')
+        mock_esoapi.return_value.connect.side_effect = Exception('401 Unauthorized')
+
+        with self.assertRaises(Exception):
+            pool.acquire('demo', '52052', 'wrong')
+
+        mock_esoapi.return_value.connect.side_effect = None
+        self.assertIs(pool.acquire('demo', '52052', 'tutorial'), eso_api)
+        self.assertEqual(mock_esoapi.call_count, 2)
+
+    def test_health_check_during_an_outage_keeps_the_connection(self, mock_esoapi):
+        pool = ESOConnectionPool(health_check_interval=10, idle_ttl=1000)
+        with mock.patch('tom_eso.connections.time.monotonic', return_value=0.0):
+            eso_api = pool.acquire('demo', '52052', 'tutorial')
+        eso_api.api2.getUser.side_effect = requests.ConnectionError('ESO is down')
+        with mock.patch('tom_eso.connections.time.monotonic', return_value=11.0):
+            self.assertIs(pool.acquire('demo', '52052', 'tutorial'), eso_api)
+
+        self.assertEqual(mock_esoapi.call_count, 1)
+
+    def test_only_credentials_that_logged_in_are_verified(self, mock_esoapi):
+        pool = ESOConnectionPool(max_size=1)
+        pool.acquire('demo', '52052', 'tutorial')
+        pool.acquire('demo', 'someone_else', 'tutorial')  # evicts the connection, not its verification
+        mock_esoapi.return_value.connect.side_effect = requests.ConnectionError('ESO is down')
+        with self.assertRaises(requests.ConnectionError):
+            pool.acquire('demo', '52052', 'wrong')
+
+        self.assertTrue(pool.is_verified('demo', '52052', 'tutorial'))
+        self.assertFalse(pool.is_verified('demo', '52052', 'wrong'))
+        self.assertFalse(pool.is_verified('production', '52052', 'tutorial'))
+
+        # a password rejected by ESO isn't verified anymore
+        mock_esoapi.return_value.connect.side_effect = Exception('401 Unauthorized')
+        with self.assertRaises(Exception):
+            pool.acquire('demo', '52052', 'tutorial')
+        self.assertFalse(pool.is_verified('demo', '52052', 'tutorial'))
+
+    def test_key_locks_are_dropped_once_unused(self, mock_esoapi):
+        pool = ESOConnectionPool(max_size=2)
+        for username in ['1', '2', '3']:
+            pool.acquire('demo', username, 'tutorial')
+
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool._key_locks, {})
+
+    def test_eviction_during_a_login_does_not_allow_a_concurrent_login(self, mock_esoapi):
+        login_started = threading.Event()
+        finish_login = threading.Event()
+        logins = []
+
+        def connect(username, password):
+            logins.append((username, password))
+            if password == 'new password':
+                login_started.set()
+                finish_login.wait(5)
+
+        def make_eso_api(environment, username, password):
+            eso_api = mock.Mock()
+            eso_api.connect.side_effect = lambda: connect(username, password)
+            return eso_api
+
+        mock_esoapi.side_effect = make_eso_api
+        pool = ESOConnectionPool(max_size=1)
+        pool.acquire('demo', '1', 'tutorial')
+
+        first = threading.Thread(target=pool.acquire, args=('demo', '1', 'new password'))
+        first.start()
+        self.assertTrue(login_started.wait(5))
+        pool.acquire('demo', '2', 'tutorial')  # evicts the connection being replaced by the first thread
+        second = threading.Thread(target=pool.acquire, args=('demo', '1', 'new password'))
+        second.start()
+        time.sleep(0.1)  # the second thread waits for the login of the first
+        finish_login.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual(logins.count(('1', 'new password')), 1)
+        self.assertEqual(pool._key_locks, {})
+
+    def test_saving_profile_invalidates_connection(self, mock_esoapi):
+        pool = get_connection_pool()
+        pool.clear()
+        user = User.objects.create(username='eso_user')
+        profile = ESOProfile.objects.create(user=user, p2_environment='demo', p2_username='52052')
+        pool.acquire('demo', '52052', 'tutorial')
+        self.assertEqual(len(pool), 1)
+
+        profile.p2_username = '52053'
+        profile.save()
+        self.assertEqual(len(pool), 0)
@@ -0,0 +1,60 @@
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import Angle
+from django.test import SimpleTestCase
+
+from tom_eso.coordinates import dec_to_sexagesimal, ra_to_sexagesimal
+
+
+def astropy_ra(ra):
+    return Angle(ra, unit=u.deg).to_string(unit=u.hourangle, sep=':', precision=3)
+
+
+def astropy_dec(dec):
+    return Angle(dec, unit=u.deg).to_string(unit=u.deg, sep=':', precision=3, alwayssign=True)
+
+
+class TestSexagesimalFormatting(SimpleTestCase):
+    """The vectorized formatters must reproduce astropy's ``Angle.to_string`` output exactly."""
+
+    def assertMatchesAstropy(self, ras, decs):
+        for ra, formatted in zip(ras, ra_to_sexagesimal(ras)):
+            self.assertEqual(formatted, astropy_ra(ra), f'RA {ra!r}')
+        for dec, formatted in zip(decs, dec_to_sexagesimal(decs)):
+            self.assertEqual(formatted, astropy_dec(dec), f'Dec {dec!r}')
+
+    def test_random_coordinates(self):
+        # a property test: random coordinates at full precision, and at the precisions catalogs use
+        rng = np.random.default_rng(20240517)
+        for decimals in [None, 8, 6, 5, 4]:
+            ras = rng.uniform(0.0, 360.0, 2000)
+            decs = rng.uniform(-90.0, 90.0, 2000)
+            if decimals is not None:
+                ras, decs = np.round(ras, decimals), np.round(decs, decimals)
+            with self.subTest(decimals=decimals):
+                self.assertMatchesAstropy(ras, decs)
+
+    def test_rounding_and_carry(self):
+        # seconds just below and above the point where they round up into the next minute (and hour/degree),
+        # and exact half-milliseconds
+        seconds = [0.0, 0.0005, 0.0015, 1.0005, 30.0015, 59.9989999, 59.99899999999, 59.999, 59.99949, 59.9995,
+                   59.9999999]
+        offsets = np.array([(whole + (minute + second / 60.0) / 60.0)
+                            for whole in [0, 1, 23] for minute in [0, 59] for second in seconds])
+        self.assertMatchesAstropy(offsets * 15.0, np.concatenate([offsets, -offsets]))
+
+    def test_signs(self):
+        self.assertEqual(dec_to_sexagesimal(0.0), '+0:00:00.000')
+        self.assertEqual(dec_to_sexagesimal(-0.5), '-0:30:00.000')
+        self.assertMatchesAstropy([0.0, 360.0], [-0.0, -1e-12, 90.0, -90.0])
+
+    def test_not_finite(self):
+        self.assertMatchesAstropy([np.nan], [np.nan])
+
+    def test_scalars_and_arrays(self):
+        self.assertEqual(ra_to_sexagesimal(10.68470833), '0:42:44.330')
+        self.assertEqual(dec_to_sexagesimal(41.26875), '+41:16:07.500')
+
+        formatted = ra_to_sexagesimal(np.zeros((2, 3)))
+        self.assertEqual(formatted.shape, (2, 3))
+        self.assertEqual(ra_to_sexagesimal([]).shape, (0,))
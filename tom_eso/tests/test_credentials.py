@@ -0,0 +1,110 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from tom_eso.connections import get_connection_pool
+from tom_eso.credentials import CredentialResolver, get_credential_resolver
+from tom_eso.eso import CredentialStatus, ESOFacility
+from tom_eso.models import ESOProfile
+from tom_eso.tests.test_throttling import FakeClock
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+
+class TestCredentialResolver(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.user = User(pk=1, username='eso_user')
+        self.resolve = mock.Mock(side_effect=lambda user: ('demo', '52052', 'tutorial'))
+
+    def test_credentials_are_resolved_once_per_timeout(self):
+        resolver = CredentialResolver(timeout=60, clock=self.clock)
+
+        resolver.resolve(self.user, self.resolve)
+        self.clock.sleep(59)
+        resolver.resolve(self.user, self.resolve)
+        self.assertEqual(self.resolve.call_count, 1)
+
+        self.clock.sleep(1)
+        resolver.resolve(self.user, self.resolve)
+        self.assertEqual(self.resolve.call_count, 2)
+
+    def test_invalidate(self):
+        resolver = CredentialResolver(timeout=60, clock=self.clock)
+        resolver.resolve(self.user, self.resolve)
+
+        resolver.invalidate(self.user.pk)
+        resolver.resolve(self.user, self.resolve)
+
+        self.assertEqual(self.resolve.call_count, 2)
+
+    def test_errors_are_not_cached(self):
+        resolver = CredentialResolver(timeout=60, clock=self.clock)
+        self.resolve.side_effect = [Exception('database unavailable'), ('demo', '52052', 'tutorial')]
+
+        with self.assertRaises(Exception):
+            resolver.resolve(self.user, self.resolve)
+        self.assertEqual(resolver.resolve(self.user, self.resolve), ('demo', '52052', 'tutorial'))
+
+    @override_settings(FACILITIES={'ESO': {'credential_cache': {'timeout': 0}}})
+    def test_caching_can_be_disabled(self):
+        resolver = CredentialResolver(clock=self.clock)
+
+        resolver.resolve(self.user, self.resolve)
+        resolver.resolve(self.user, self.resolve)
+
+        self.assertEqual(self.resolve.call_count, 2)
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+@mock.patch('tom_eso.eso.get_encrypted_field', return_value='secret')
+class TestESOFacilityCredentials(TestCase):
+    def setUp(self):
+        get_credential_resolver().clear()
+        get_connection_pool().clear()
+        self.addCleanup(get_connection_pool().clear)
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=fake_p2_connection())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username='eso_user')
+        self.profile = ESOProfile.objects.create(user=self.user, p2_environment='production', p2_username='12345')
+
+    def profile_queries(self, queries):
+        return [query for query in queries if ESOProfile._meta.db_table in query['sql']]
+
+    def test_profile_is_queried_and_decrypted_once(self, mock_decrypt):
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(3):  # e.g. three HTMX requests
+                facility = ESOFacility()
+                facility.set_user(self.user)
+                facility.get_p2_tool_url()
+
+        self.assertEqual(facility.credential_status, CredentialStatus.USING_USER_CREDS)
+        self.assertEqual(facility.get_p2_tool_url(observation_block_id=1), 'https://www.eso.org/p2/home/ob/1')
+        self.assertEqual(len(self.profile_queries(queries)), 1)
+        mock_decrypt.assert_called_once()
+
+    def test_saving_the_profile_invalidates_its_credentials(self, mock_decrypt):
+        facility = ESOFacility()
+        facility.set_user(self.user)
+        self.assertEqual(facility.eso_api.username, '12345')
+
+        self.profile.p2_username = '67890'
+        self.profile.save()
+        facility = ESOFacility()
+        facility.set_user(self.user)
+
+        self.assertEqual(facility.eso_api.username, '67890')
+
+    def test_deleting_the_profile_invalidates_its_credentials(self, mock_decrypt):
+        facility = ESOFacility()
+        facility.set_user(self.user)
+
+        self.profile.delete()
+        facility = ESOFacility()
+        facility.set_user(self.user)
+
+        self.assertEqual(facility.credential_status, CredentialStatus.USING_DEFAULTS)
+        self.assertEqual(facility.get_p2_tool_url(), '')
@@ -0,0 +1,275 @@
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from tom_dataproducts.models import DataProduct
+from tom_observations.models import ObservationRecord
+from tom_targets.models import Target
+
+from tom_eso.archive import observation_block_products
+from tom_eso.downloads import DownloadError, DownloadLimiter, StreamingDownloader, download_lock
+from tom_eso.eso import ESOFacility
+
+MiB = 1024 * 1024
+PATTERN = random.Random(0).randbytes(65536 + 7)  # an odd length, so chunks don't line up with it
+
+
+def synthetic_bytes(start, end):
+    """Generate bytes [start, end) of a large synthetic file, without ever holding all of it."""
+    position = start
+    while position < end:
+        offset = position % len(PATTERN)
+        block = PATTERN[offset:offset + min(end - position, len(PATTERN) - offset)]
+        yield block
+        position += len(block)
+
+
+def synthetic_checksum(size):
+    checksum = hashlib.sha256()
+    for block in synthetic_bytes(0, size):
+        checksum.update(block)
+    return checksum.hexdigest()
+
+
+class SyntheticFileHandler(BaseHTTPRequestHandler):
+    """Serve /<size> as a synthetic file of <size> bytes, with support for Range requests."""
+    server_version = 'SyntheticArchive/1.0'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('Range'))
+        size = int(self.path.strip('/'))
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and not server.ignore_range:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('Content-Disposition', 'attachment; filename="synthetic.fits"')
+        self.end_headers()
+
+        # drop the connection part way through, the first `failures` times
+        end = size
+        if server.failures:
+            server.failures -= 1
+            end = min(size, start + server.fail_after)
+        for block in synthetic_bytes(start, end):
+            self.wfile.write(block)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SyntheticArchiveServerMixin:
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), SyntheticFileHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.server.requests = []
+        self.server.ignore_range = False
+        self.server.failures = 0
+        self.server.fail_after = 0
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+
+class TestStreamingDownloader(SyntheticArchiveServerMixin, SimpleTestCase):
+    def download(self, size, **kwargs):
+        path = os.path.join(self.directory, 'product.fits')
+        return StreamingDownloader(chunk_size=256 * 1024).download(f'{self.base_url}/{size}', path, **kwargs)
+
+    def test_large_file_is_streamed_to_disk(self):
+        size = 48 * MiB
+        tracemalloc.start()
+        try:
+            result = self.download(size)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(result.size, size)
+        self.assertEqual(os.path.getsize(result.path), size)
+        self.assertEqual(result.checksum, synthetic_checksum(size))
+        self.assertEqual(result.filename, 'synthetic.fits')
+        self.assertFalse(os.path.exists(result.path + '.part'))
+        self.assertLess(peak, 8 * MiB)  # never buffered in memory
+
+    def test_interrupted_download_is_resumed(self):
+        size = 10 * MiB
+        self.server.failures = 2
+        self.server.fail_after = 3 * MiB
+
+        result = self.download(size)
+
+        self.assertEqual(result.checksum, synthetic_checksum(size))
+        self.assertEqual(self.server.requests, [None, f'bytes={3 * MiB}-', f'bytes={6 * MiB}-'])
+
+    def test_partial_file_from_an_earlier_attempt_is_resumed(self):
+        size = 4 * MiB
+        with open(os.path.join(self.directory, 'product.fits.part'), 'wb') as part_file:
+            for block in synthetic_bytes(0, MiB):
+                part_file.write(block)
+
+        result = self.download(size)
+
+        self.assertEqual(result.resumed_from, MiB)
+        self.assertEqual(result.checksum, synthetic_checksum(size))
+        self.assertEqual(self.server.requests, [f'bytes={MiB}-'])
+
+    def test_complete_partial_file(self):
+        size = MiB
+        with open(os.path.join(self.directory, 'product.fits.part'), 'wb') as part_file:
+            for block in synthetic_bytes(0, size):
+                part_file.write(block)
+
+        self.assertEqual(self.download(size).checksum, synthetic_checksum(size))
+
+    def test_server_without_range_support(self):
+        size = 4 * MiB
+        self.server.ignore_range = True
+        self.server.failures = 1
+        self.server.fail_after = MiB
+
+        result = self.download(size)
+
+        self.assertEqual(result.checksum, synthetic_checksum(size))
+        self.assertEqual(result.size, size)
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(DownloadError):
+            self.download(MiB, expected_checksum='0' * 64)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        result = self.download(MiB, expected_checksum=synthetic_checksum(MiB).upper())
+        self.assertEqual(result.size, MiB)
+
+    def test_too_many_failures(self):
+        self.server.failures = 10
+        self.server.fail_after = 1024
+        with self.assertRaises(DownloadError):
+            self.download(MiB)
+
+
+class TestDownloadLimiter(SimpleTestCase):
+    def test_concurrent_downloads_are_limited_per_user(self):
+        limiter = DownloadLimiter(max_per_user=2)
+        active = {'alice': 0, 'bob': 0}
+        peak = {'alice': 0, 'bob': 0}
+        lock = threading.Lock()
+
+        def download(user):
+            with limiter.slot(user):
+                with lock:
+                    active[user] += 1
+                    peak[user] = max(peak[user], active[user])
+                time.sleep(0.02)
+                with lock:
+                    active[user] -= 1
+
+        threads = [threading.Thread(target=download, args=(user,)) for user in ['alice'] * 6 + ['bob'] * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(peak, {'alice': 2, 'bob': 2})
+
+
+class TestDownloadLock(SimpleTestCase):
+    def test_concurrent_downloads_of_a_path_are_serialized(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'product.fits')
+        active = []
+        peak = []
+
+        def download():
+            with download_lock(path):
+                active.append(1)
+                peak.append(len(active))
+                time.sleep(0.02)
+                active.pop()
+
+        threads = [threading.Thread(target=download) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(peak, [1, 1, 1, 1])
+        self.assertEqual(os.listdir(directory), [])  # the lock file is removed
+
+
+class TestObservationBlockProducts(SimpleTestCase):
+    def test_products_are_found_by_ob_id(self):
+        session = mock.Mock()
+        session.get.return_value.text = 'dp_id\r\nUVES.2024-01-01T00:00:00.000\r\nUVES.2024-01-01T00:10:00.000\r\n'
+
+        products = observation_block_products('123', session=session)
+
+        self.assertIn('ob_id = 123', session.get.call_args.kwargs['params']['QUERY'])
+        self.assertEqual(products[0], {
+            'id': 'UVES.2024-01-01T00:00:00.000',
+            'filename': 'UVES.2024-01-01T00:00:00.000.fits',
+            'url': 'https://dataportal.eso.org/dataportal_new/file/UVES.2024-01-01T00:00:00.000',
+        })
+        self.assertEqual(len(products), 2)
+
+
+class TestSaveDataProducts(SyntheticArchiveServerMixin, TestCase):
+    def test_data_products_are_streamed_into_storage(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        user = User.objects.create(username='eso_user')
+        target = Target.objects.create(name='M31', type=Target.SIDEREAL, ra=10.68, dec=41.27)
+        record = ObservationRecord.objects.create(target=target, user=user, facility='ESO', parameters={},
+                                                  observation_id='123', status='COMPLETED')
+        products = [{'id': f'ESO.2024-01-01T00:00:0{i}', 'filename': f'frame{i}.fits',
+                     'url': f'{self.base_url}/{(i + 1) * MiB}'} for i in range(2)]
+        facility = ESOFacility()
+        facility.user = user
+
+        with override_settings(MEDIA_ROOT=media_root, FACILITIES={'ESO': {'downloads': {'directory': self.directory}}}):
+            with (mock.patch('tom_eso.eso.observation_block_products', return_value=products) as products_of,
+                  mock.patch.object(StreamingDownloader, 'download', autospec=True,
+                                    side_effect=StreamingDownloader.download) as download):
+                saved = facility.save_data_products(record)
+                # already saved: nothing is downloaded again
+                self.assertEqual(facility.save_data_products(record), saved)
+            self.assertEqual([dp.data.size for dp in saved], [MiB, 2 * MiB])
+
+        products_of.assert_called_with('123')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(download.call_args_list[0].args[2],  # not shared with other records' downloads
+                         os.path.join(self.directory, f'{record.pk}_ESO.2024-01-01T000000'))
+        self.assertEqual(DataProduct.objects.filter(observation_record=record).count(), 2)
+        self.assertEqual(os.listdir(self.directory), [])  # the downloaded files were moved into storage
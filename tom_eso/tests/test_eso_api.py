@@ -0,0 +1,272 @@
+import threading
+import time
+from unittest import mock
+
+from django.test import TestCase
+
+from tom_eso import metrics
+from tom_eso.concurrency import SingleFlight
+from tom_eso.eso_api import ESOAPI
+
+
+@mock.patch('tom_eso.eso_api.p2api.ApiConnection')
+@mock.patch('tom_eso.eso_api.p1api.ApiConnection')
+class TestESOAPIConnections(TestCase):
+    def test_no_login_on_construction(self, mock_p1, mock_p2):
+        ESOAPI('demo', '52052', 'tutorial')
+        mock_p1.assert_not_called()
+        mock_p2.assert_not_called()
+
+    def test_phase2_logs_in_once_on_first_use(self, mock_p1, mock_p2):
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+        eso_api.api2.getRuns.return_value = ([], 'version')
+        eso_api.observing_run_choices()
+        eso_api.observing_run_choices()
+
+        mock_p2.assert_called_once_with('demo', '52052', 'tutorial')
+        mock_p1.assert_not_called()
+
+    def test_phase1_logs_in_only_when_used(self, mock_p1, mock_p2):
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+        eso_api.connect()
+        mock_p1.assert_not_called()
+
+        self.assertIs(eso_api.api1, mock_p1.return_value)
+        mock_p1.assert_called_once_with('demo', '52052', 'tutorial')
+
+    def test_failed_login_is_retried_on_next_access(self, mock_p1, mock_p2):
+        mock_p2.side_effect = [Exception('cannot login'), mock.DEFAULT]
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+        with self.assertRaises(Exception):
+            eso_api.connect()
+        self.assertIs(eso_api.connect(), mock_p2.return_value)
+
+
+@mock.patch('tom_eso.eso_api.p2api.ApiConnection')
+class TestESOAPIResponseCache(TestCase):
+    def setUp(self):
+        self.eso_api = ESOAPI('demo', '52052', 'tutorial')
+
+    def test_fresh_responses_are_served_from_cache(self, mock_p2):
+        mock_p2.return_value.getItems.return_value = ([{'obId': 1, 'name': 'OB', 'itemType': 'OB'}], '"v1"')
+        self.eso_api.folder_ob_choices(10)
+        choices = self.eso_api.folder_ob_choices(10)
+
+        self.assertEqual(choices, [(1, 'OB : OB')])
+        mock_p2.return_value.getItems.assert_called_once_with(10)
+
+    def test_stale_unchanged_response_is_revalidated(self, mock_p2):
+        api2 = mock_p2.return_value
+        api2.getItems.return_value = ([{'obId': 1, 'name': 'OB', 'itemType': 'OB'}], '"v1"')
+        api2.apiUrl = 'https://p2.example'
+        api2.session.request.return_value = mock.Mock(status_code=304)
+        self.eso_api.p2_cache.ttls['getItems'] = 0
+
+        self.eso_api.folder_ob_choices(10)
+        choices = self.eso_api.folder_ob_choices(10)
+
+        self.assertEqual(choices, [(1, 'OB : OB')])
+        api2.getItems.assert_called_once_with(10)
+        _, kwargs = api2.session.request.call_args
+        self.assertEqual(kwargs['headers']['If-None-Match'], '"v1"')
+
+    def test_stale_changed_response_is_replaced(self, mock_p2):
+        api2 = mock_p2.return_value
+        api2.getItems.return_value = ([{'obId': 1, 'name': 'OB', 'itemType': 'OB'}], '"v1"')
+        api2.apiUrl = 'https://p2.example'
+        api2.session.request.return_value = mock.Mock(
+            status_code=200, headers={'Content-Type': 'application/json', 'ETag': '"v2"'},
+            json=mock.Mock(return_value=[{'obId': 2, 'name': 'New OB', 'itemType': 'OB'}]))
+        self.eso_api.p2_cache.ttls['getItems'] = 0
+
+        self.eso_api.folder_ob_choices(10)
+        self.assertEqual(self.eso_api.folder_ob_choices(10), [(2, 'New OB : OB')])
+        self.assertEqual(self.eso_api.p2_cache.get(('getItems', 10)).version, '"v2"')
+
+    def test_cache_is_bounded(self, mock_p2):
+        mock_p2.return_value.getItems.return_value = ([], '"v1"')
+        self.eso_api.p2_cache.max_entries = 2
+        for folder_id in (1, 2, 3):
+            self.eso_api.folder_ob_choices(folder_id)
+
+        self.assertEqual(len(self.eso_api.p2_cache), 2)
+        self.assertIsNone(self.eso_api.p2_cache.get(('getItems', 1)))
+
+    def test_creating_an_ob_invalidates_its_folder(self, mock_p2):
+        api2 = mock_p2.return_value
+        api2.getItems.return_value = ([], '"v1"')
+        api2.createOB.return_value = ({'obId': 3, 'target': {}}, '"ob"')
+        self.eso_api.folder_ob_choices(10)
+        self.eso_api.create_observation_block(10, 'new OB')
+        self.eso_api.folder_ob_choices(10)
+
+        self.assertEqual(api2.getItems.call_count, 2)
+
+
+@mock.patch('tom_eso.eso_api.p2api.ApiConnection')
+class TestESOAPIContainerTraversal(TestCase):
+    ITEMS = {
+        1: [{'containerId': 2, 'name': 'Folder A', 'itemType': 'Folder'},
+            {'containerId': 3, 'name': 'Folder B', 'itemType': 'Folder'},
+            {'obId': 100, 'name': 'OB in run', 'itemType': 'OB'}],
+        2: [{'containerId': 4, 'name': 'Concatenation', 'itemType': 'Concatenation'}],
+        3: [],
+        4: [{'containerId': 5, 'name': 'Nested Folder', 'itemType': 'Folder'},
+            {'obId': 101, 'name': 'OB in concatenation', 'itemType': 'OB'}],
+        5: [{'obId': 102, 'name': 'Deep OB', 'itemType': 'OB'}],
+    }
+
+    def setUp(self):
+        self.eso_api = ESOAPI('demo', '52052', 'tutorial')
+
+    def fake_items(self, mock_p2):
+        mock_p2.return_value.getItems.side_effect = lambda container_id: (self.ITEMS[container_id], '"v"')
+
+    def test_walk_is_breadth_first(self, mock_p2):
+        self.fake_items(mock_p2)
+        walked = [(depth, parent, item.get('obId', item.get('containerId')))
+                  for depth, parent, item in self.eso_api.walk_container(1, max_workers=2)]
+
+        self.assertEqual(walked, [(0, 1, 2), (0, 1, 3), (0, 1, 100), (1, 2, 4), (2, 4, 5), (2, 4, 101), (3, 5, 102)])
+
+    def test_walk_stops_at_max_depth(self, mock_p2):
+        self.fake_items(mock_p2)
+        depths = {depth for depth, _, _ in self.eso_api.walk_container(1, max_depth=2)}
+
+        self.assertEqual(depths, {0, 1})
+        self.assertEqual(sorted(call.args[0] for call in mock_p2.return_value.getItems.call_args_list), [1, 2, 3])
+
+    def test_walk_skips_containers_that_fail(self, mock_p2):
+        def get_items(container_id):
+            if container_id == 2:
+                raise Exception('P2 error')
+            return self.ITEMS[container_id], '"v"'
+        mock_p2.return_value.getItems.side_effect = get_items
+        ids = [item.get('obId', item.get('containerId')) for _, _, item in self.eso_api.walk_container(1)]
+
+        self.assertEqual(ids, [2, 3, 100])
+
+    def test_container_tree_choices_are_indented_in_tree_order(self, mock_p2):
+        self.fake_items(mock_p2)
+        indent = '\u00a0' * 4
+
+        self.assertEqual(self.eso_api.container_tree_choices(1), [
+            (2, 'Folder A'),
+            (4, f'{indent}Concatenation : Concatenation'),
+            (5, f'{indent}{indent}Nested Folder'),
+            (3, 'Folder B'),
+        ])
+
+
+class TestSingleFlight(TestCase):
+    def test_sequential_calls_are_not_coalesced(self):
+        single_flight = SingleFlight()
+        func = mock.Mock(side_effect=['first', 'second'])
+
+        self.assertEqual(single_flight.do('key', func), ('first', False))
+        self.assertEqual(single_flight.do('key', func), ('second', False))
+
+    def test_exceptions_are_shared(self):
+        single_flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError('P2 error')
+        errors = []
+
+        def call():
+            try:
+                single_flight.do('key', fail)
+            except ValueError as ex:
+                errors.append(ex)
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=call)
+        follower.start()
+        time.sleep(0.05)  # for the follower to start waiting
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+
+@mock.patch('tom_eso.eso_api.p2api.ApiConnection')
+class TestESOAPIRequestCoalescing(TestCase):
+    CALLERS = 10
+
+    def call_concurrently(self, call):
+        """Make ``call()`` from CALLERS threads at once, while the first upstream call is held in flight."""
+        results = [None] * self.CALLERS
+        threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, call())) for i in range(self.CALLERS)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)  # for every thread to reach the in-flight call
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def slow_response(self, response):
+        self.release = threading.Event()
+
+        def respond(*args):
+            self.release.wait(5)
+            return response
+        return respond
+
+    def test_concurrent_identical_calls_make_one_upstream_call(self, mock_p2):
+        api2 = mock_p2.return_value
+        api2.getItems.side_effect = self.slow_response(([{'obId': 1, 'name': 'OB', 'itemType': 'OB'}], '"v1"'))
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+        metrics.reset()
+
+        results = self.call_concurrently(lambda: eso_api.folder_ob_choices(10))
+
+        api2.getItems.assert_called_once_with(10)
+        self.assertEqual(results, [[(1, 'OB : OB')]] * self.CALLERS)
+        self.assertEqual(metrics.get_counter('p2_calls_coalesced_total', method='getItems', environment='demo'),
+                         self.CALLERS - 1)
+
+    def test_calls_are_coalesced_across_eso_api_instances(self, mock_p2):
+        api2 = mock_p2.return_value
+        api2.getRuns.side_effect = self.slow_response(([], '"runs"'))
+        # e.g. two users with the same (programme) credentials
+        eso_apis = [ESOAPI('demo', '52052', 'tutorial') for _ in range(self.CALLERS)]
+        callers = iter(eso_apis)
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                eso_api = next(callers)
+            return eso_api.observing_run_choices()
+        self.call_concurrently(call)
+
+        api2.getRuns.assert_called_once_with()
+
+    def test_different_accounts_are_not_coalesced(self, mock_p2):
+        api2 = mock_p2.return_value
+        api2.getRuns.side_effect = self.slow_response(([], '"runs"'))
+        usernames = iter(range(self.CALLERS))
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                username = str(next(usernames))
+            return ESOAPI('demo', username, 'tutorial').observing_run_choices()
+        self.call_concurrently(call)
+
+        self.assertEqual(api2.getRuns.call_count, self.CALLERS)
+
+    def test_writes_are_not_coalesced(self, mock_p2):
+        api2 = mock_p2.return_value
+        api2.createOB.side_effect = self.slow_response(({'obId': 3, 'target': {}}, '"ob"'))
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+
+        self.call_concurrently(lambda: eso_api.create_observation_block(10, 'new OB'))
+
+        self.assertEqual(api2.createOB.call_count, self.CALLERS)
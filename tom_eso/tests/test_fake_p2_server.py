@@ -0,0 +1,72 @@
+import p2api
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from tom_eso import circuit_breaker
+from tom_eso.eso_api import ESOAPI, NOT_MODIFIED
+from tom_eso.tests.benchmarks import compare_results
+from tom_eso.tests.fake_p2_server import run_fake_p2_server
+from tom_eso.tests.test_views import TEST_FACILITIES
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestFakeP2Server(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(circuit_breaker._circuit_breakers.clear)
+
+    def test_account_size(self):
+        with run_fake_p2_server(n_runs=2, n_folders=3, n_obs=4) as server:
+            api2 = p2api.ApiConnection('demo', '52052', 'tutorial')
+            runs, _ = api2.getRuns()
+            run, _ = api2.getRun(runs[0]['runId'])
+            folders, _ = api2.getItems(run['containerId'])
+            observation_blocks, _ = api2.getItems(folders[0]['containerId'])
+
+        self.assertEqual(len(runs), 2)
+        self.assertEqual([folder['itemType'] for folder in folders], ['Folder'] * 3)
+        self.assertEqual([item['itemType'] for item in observation_blocks], ['OB'] * 4)
+        self.assertEqual(server.request_counts, {'login': 1, 'getRuns': 1, 'getRun': 1, 'getItems': 2})
+
+    def test_create_and_save_observation_block(self):
+        with run_fake_p2_server(n_runs=1, n_folders=1, n_obs=0) as server:
+            folder_id = next(iter(server.account.containers.values()))[0]['containerId']
+            eso_api = ESOAPI('demo', '52052', 'tutorial')
+
+            observation_block = eso_api.create_observation_block(folder_id, 'New OB')
+            observation_block['target']['name'] = 'M31'
+            api2 = eso_api.api2
+            saved_observation_block, _ = api2.saveOB(observation_block, api2.getOB(observation_block['obId'])[1])
+
+            self.assertEqual(eso_api.folder_ob_choices(folder_id), [(observation_block['obId'], 'New OB : OB')])
+            self.assertEqual(saved_observation_block['target']['name'], 'M31')
+            with self.assertRaises(p2api.P2Error):  # saving with an outdated version
+                api2.saveOB(observation_block, '"0"')
+
+    def test_conditional_requests(self):
+        with run_fake_p2_server() as server:
+            eso_api = ESOAPI('demo', '52052', 'tutorial')
+            _, version = eso_api.api2.getRuns()
+
+            self.assertIs(eso_api._revalidate('/obsRuns', version), NOT_MODIFIED)
+            self.assertEqual(len(eso_api._revalidate('/obsRuns', '"old"')[0]), 2)
+            self.assertEqual(server.request_counts['getRuns'], 3)
+
+    def test_error_rate(self):
+        with run_fake_p2_server(error_rate=1.0):
+            api2 = p2api.ApiConnection('demo', '52052', 'tutorial')  # logins don't fail
+            with self.assertRaises(p2api.P2Error) as raised:
+                api2.getRuns()
+        self.assertEqual(raised.exception.args[0], 503)
+
+
+class TestCompareResults(SimpleTestCase):
+    def test_only_slower_timings_are_regressions(self):
+        baseline = {'view_latency': {'cold': {'mean_ms': 100.0, 'p2_requests_per_call': 2.0}},
+                    'coordinate_formatting': {'vectorized_seconds': 1.0, 'speedup': 50.0}}
+        results = {'view_latency': {'cold': {'mean_ms': 130.0, 'p2_requests_per_call': 4.0}},
+                   'coordinate_formatting': {'vectorized_seconds': 1.1, 'speedup': 10.0},
+                   'new_benchmark': {'mean_ms': 1.0}}
+
+        self.assertEqual(compare_results(baseline, results, threshold=1.25),
+                         [('view_latency.cold.mean_ms', 100.0, 130.0)])
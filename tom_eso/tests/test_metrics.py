@@ -0,0 +1,139 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from tom_eso import metrics
+from tom_eso.eso_api import ESOAPI
+
+# publish on every update, so the tests see every metric in the cache
+METRICS_FACILITIES = {'ESO': {'metrics': {'publish_interval': 0}}}
+
+
+@override_settings(FACILITIES=METRICS_FACILITIES)
+class TestMetrics(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+
+    def test_histogram_buckets(self):
+        for value in (0.01, 0.05, 0.2, 100):
+            metrics.observe('p2_request_duration_seconds', value, buckets=(0.05, 0.1, 1), method='getRuns')
+
+        bounds, counts, total, count = metrics.get_histogram('p2_request_duration_seconds', method='getRuns')
+        self.assertEqual(bounds, (0.05, 0.1, 1))
+        self.assertEqual(counts, [2, 0, 1])  # the last value is only in the +Inf bucket
+        self.assertAlmostEqual(total, 100.26)
+        self.assertEqual(count, 4)
+
+    def test_prometheus_text_format(self):
+        metrics.increment('p2_request_errors_total', method='getItems', environment='demo')
+        metrics.observe('p2_request_duration_seconds', 0.2, buckets=(0.1, 1), method='getItems', environment='demo')
+
+        text = metrics.render_prometheus()
+
+        self.assertIn('# TYPE tom_eso_p2_request_errors_total counter\n', text)
+        self.assertIn('tom_eso_p2_request_errors_total{environment="demo",method="getItems"} 1\n', text)
+        self.assertIn('# TYPE tom_eso_p2_request_duration_seconds histogram\n', text)
+        self.assertIn('tom_eso_p2_request_duration_seconds_bucket{environment="demo",method="getItems",le="0.1"} 0\n',
+                      text)
+        self.assertIn('tom_eso_p2_request_duration_seconds_bucket{environment="demo",method="getItems",le="1.0"} 1\n',
+                      text)
+        self.assertIn('tom_eso_p2_request_duration_seconds_bucket{environment="demo",method="getItems",le="+Inf"} 1\n',
+                      text)
+        self.assertIn('tom_eso_p2_request_duration_seconds_count{environment="demo",method="getItems"} 1\n', text)
+
+    def test_metrics_of_all_processes_are_added_up(self):
+        metrics.increment('p2_logins_total', phase='Phase 2', environment='demo')
+        metrics.observe('p2_request_duration_seconds', 0.2, method='getRuns', environment='demo')
+        # another worker process, publishing to the same cache
+        with mock.patch('tom_eso.metrics.PROCESS_ID', 'other-worker'):
+            metrics.publish()
+
+        merged = metrics.collect()
+
+        self.assertEqual(merged['counters'][('p2_logins_total', (('environment', 'demo'), ('phase', 'Phase 2')))], 2)
+        key = ('p2_request_duration_seconds', (('environment', 'demo'), ('method', 'getRuns')))
+        self.assertEqual(merged['histograms'][key][3], 2)
+
+    def test_expired_processes_are_dropped(self):
+        with mock.patch('tom_eso.metrics.PROCESS_ID', 'stopped-worker'):
+            metrics.increment('p2_logins_total', phase='Phase 2', environment='demo')
+        cache.delete(f'{metrics.KEY_PREFIX}:process:stopped-worker')
+
+        metrics.collect()
+
+        self.assertEqual(cache.get(f'{metrics.KEY_PREFIX}:processes'), [metrics.PROCESS_ID])
+
+
+@override_settings(FACILITIES=METRICS_FACILITIES)
+class TestMetricsEndpoint(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+
+    def test_endpoint(self):
+        metrics.increment('p2_calls_retried_total', method='getRuns', environment='demo')
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+
+        response = self.client.get(reverse('tom_eso:metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertContains(response, 'tom_eso_p2_calls_retried_total{environment="demo",method="getRuns"} 1')
+
+    @override_settings(FACILITIES={'ESO': {'metrics': {'token': 'secret'}}})
+    def test_endpoint_token(self):
+        self.assertEqual(self.client.get(reverse('tom_eso:metrics')).status_code, 401)
+        response = self.client.get(reverse('tom_eso:metrics'), HTTP_AUTHORIZATION='Bearer not the secret')
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get(reverse('tom_eso:metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    def test_endpoint_is_closed_by_default(self):
+        self.assertEqual(self.client.get(reverse('tom_eso:metrics')).status_code, 401)
+        self.assertEqual(self.client.get(reverse('tom_eso:metrics'), HTTP_AUTHORIZATION='Bearer ').status_code, 401)
+
+        self.client.force_login(User.objects.create(username='eso_user'))
+        self.assertEqual(self.client.get(reverse('tom_eso:metrics')).status_code, 401)  # not staff
+
+
+@override_settings(FACILITIES=METRICS_FACILITIES)
+@mock.patch('tom_eso.eso_api.p2api.ApiConnection')
+class TestESOAPIInstrumentation(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_p2_calls_are_timed_and_counted(self, mock_p2):
+        mock_p2.return_value.getItems.return_value = ([], '"items"')
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+
+        eso_api.folder_ob_choices(10)
+        eso_api.folder_ob_choices(10)
+
+        labels = {'method': 'getItems', 'environment': 'demo'}
+        self.assertEqual(metrics.get_histogram('p2_request_duration_seconds', **labels)[3], 1)
+        self.assertEqual(metrics.get_counter('p2_cache_misses_total', **labels), 1)
+        self.assertEqual(metrics.get_counter('p2_cache_hits_total', **labels), 1)
+        self.assertEqual(metrics.get_counter('p2_logins_total', phase='Phase 2', environment='demo'), 1)
+
+    def test_errors_are_counted(self, mock_p2):
+        mock_p2.return_value.getOB.side_effect = Exception('P2 error')
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+
+        with self.assertRaises(Exception):
+            eso_api.getOB(12)
+
+        labels = {'method': 'getOB', 'environment': 'demo'}
+        self.assertEqual(metrics.get_counter('p2_request_errors_total', **labels), 1)
+        self.assertEqual(metrics.get_histogram('p2_request_duration_seconds', **labels)[3], 1)
+
+    def test_login_errors_are_counted(self, mock_p2):
+        mock_p2.side_effect = Exception('cannot login')
+
+        with self.assertRaises(Exception):
+            ESOAPI('demo', '52052', 'wrong').connect()
+
+        self.assertEqual(metrics.get_counter('p2_login_errors_total', phase='Phase 2', environment='demo'), 1)
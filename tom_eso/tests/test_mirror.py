@@ -0,0 +1,153 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from tom_eso.connections import get_connection_pool
+from tom_eso.eso import ESOFacility
+from tom_eso.eso_api import ESOAPI
+from tom_eso.mirror import P2Mirror, P2MirrorSync
+from tom_eso.models import ESOP2Account, ESOP2Container, ESOP2ObservationBlock, ESOP2ObservingRun
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestP2Mirror(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        self.items = {
+            10: ([{'containerId': 11, 'name': 'Folder 1', 'itemType': 'Folder'},
+                  {'containerId': 21, 'name': 'Concatenation', 'itemType': 'Concatenation'}], '"run items"'),
+            11: ([{'obId': 12, 'name': 'OB 1', 'itemType': 'OB'},
+                  {'containerId': 13, 'name': 'Nested', 'itemType': 'Folder'}], '"folder 1 items"'),
+            13: ([], '"nested items"'),
+            21: ([{'obId': 22, 'name': 'OB 2', 'itemType': 'OB'}], '"concatenation items"'),
+        }
+        self.api2 = fake_p2_connection()
+        self.api2.getItems.side_effect = lambda container_id: self.items[container_id]
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=self.api2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_connection_pool().clear)
+
+    def sync(self):
+        # a new ESOAPI each time, so the sync isn't served from the response cache
+        return P2MirrorSync(ESOAPI('demo', '52052', 'tutorial')).sync()
+
+    def mirror(self):
+        return P2Mirror('demo', '52052')
+
+    def test_sync_creates_the_mirror(self):
+        stats = self.sync()
+
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['created'], 1 + 3 + 2)  # the run, the containers and the OBs
+        account = ESOP2Account.objects.get(p2_environment='demo', p2_username='52052')
+        self.assertIsNotNone(account.synced_at)
+        self.assertEqual(account.runs_version, '"runs"')
+        container = ESOP2Container.objects.get(container_id=13)
+        self.assertEqual((container.parent_id, container.depth, container.items_version), (11, 1, '"nested items"'))
+        self.assertEqual(ESOP2ObservationBlock.objects.get(ob_id=22).container_id, 21)
+
+    def test_mirror_choices_match_the_live_choices(self):
+        self.sync()
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+        mirror = self.mirror()
+
+        self.assertEqual(mirror.observing_run_choices(), eso_api.observing_run_choices())
+        self.assertEqual(mirror.folder_name_choices(1), eso_api.folder_name_choices(1))
+        for container_id in [11, 13, 21]:
+            self.assertEqual(mirror.observation_block_choices(container_id), eso_api.folder_ob_choices(container_id))
+
+    def test_unchanged_account_writes_nothing(self):
+        self.sync()
+        self.api2.reset_mock()
+
+        with CaptureQueriesContext(connection) as queries:
+            stats = self.sync()
+
+        self.assertEqual((stats['created'], stats['updated'], stats['deleted']), (0, 0, 0))
+        self.assertEqual(stats['not_modified'], 1 + 4)  # getRuns and the four containers
+        mirror_writes = [query['sql'] for query in queries
+                         if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))
+                         and ESOP2Account._meta.db_table not in query['sql']]
+        self.assertEqual(mirror_writes, [])
+        self.assertNotIn('getRun', [name for name, _, _ in self.api2.method_calls])  # the run container is known
+
+    def test_only_changed_rows_are_written(self):
+        self.sync()
+        self.items[11] = ([{'obId': 12, 'name': 'OB 1 (renamed)', 'itemType': 'OB'},
+                           {'obId': 14, 'name': 'OB 3', 'itemType': 'OB'}], '"folder 1 items, v2"')
+
+        stats = self.sync()
+
+        # OB 1 renamed, OB 3 added, the Nested folder removed (and Folder 1's version updated)
+        self.assertEqual((stats['created'], stats['updated'], stats['deleted']), (1, 2, 1))
+        self.assertEqual(ESOP2ObservationBlock.objects.get(ob_id=12).name, 'OB 1 (renamed)')
+        self.assertFalse(ESOP2Container.objects.filter(container_id=13).exists())
+        self.assertEqual(self.mirror().observation_block_choices(11), [(12, 'OB 1 (renamed) : OB'), (14, 'OB 3 : OB')])
+
+    def test_failed_container_is_kept_and_the_mirror_is_not_fresh(self):
+        self.sync()
+        ESOP2Account.objects.update(synced_at=timezone.now() - timedelta(days=1))
+        ESOP2Container.objects.filter(container_id=21).update(items_version=None)
+        items = self.items
+
+        def get_items(container_id):
+            if container_id == 21:
+                raise Exception('P2 is down')
+            return items[container_id]
+        self.api2.getItems.side_effect = get_items
+
+        stats = self.sync()
+
+        self.assertEqual(stats['errors'], 1)
+        self.assertTrue(ESOP2ObservationBlock.objects.filter(ob_id=22).exists())
+        self.assertFalse(self.mirror().is_fresh())
+
+    def test_stale_or_invalidated_mirror_is_not_used(self):
+        self.sync()
+        self.mirror().invalidate_container(11)
+        self.assertIsNone(self.mirror().observation_block_choices(11))
+        self.assertIsNotNone(self.mirror().observation_block_choices(21))
+
+        ESOP2Account.objects.update(synced_at=timezone.now() - timedelta(hours=1))
+        self.assertIsNone(self.mirror().observing_run_choices())
+        self.assertIsNotNone(P2Mirror('demo', '52052', max_age=7200).observing_run_choices())
+        self.assertIsNone(P2Mirror('demo', '52052', enabled=False, max_age=7200).observing_run_choices())
+
+    def test_facility_serves_choices_from_a_fresh_mirror(self):
+        self.sync()
+        self.api2.reset_mock()
+        facility = ESOFacility()
+        facility.set_user(User.objects.create(username='eso_user'))
+
+        self.assertEqual(facility.get_folder_name_choices(1)[0], (11, 'Folder 1'))
+        self.assertEqual(facility.get_observation_block_choices(21), [(22, 'OB 2 : OB')])
+        self.assertEqual(self.api2.method_calls, [])
+        self.assertTrue(facility.get_facility_context_data()['p2_mirror']['is_fresh'])
+
+    def test_removed_run_is_deleted(self):
+        self.sync()
+        self.api2.getRuns.return_value = ([], '"no runs"')
+
+        self.sync()
+
+        self.assertFalse(ESOP2ObservingRun.objects.exists())
+        self.assertFalse(ESOP2Container.objects.exists())
+        self.assertFalse(ESOP2ObservationBlock.objects.exists())
+
+    def test_sync_command(self):
+        User.objects.create(username='eso_user')
+
+        result = call_command('sync_eso_p2_mirror', username='eso_user', stdout=mock.Mock())
+
+        self.assertEqual(result, 'Sync completed successfully')
+        self.assertTrue(self.mirror().is_fresh())
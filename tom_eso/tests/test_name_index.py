@@ -0,0 +1,155 @@
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from tom_eso import views
+from tom_eso.connections import get_connection_pool
+from tom_eso.eso_api import ESOAPI
+from tom_eso.mirror import P2MirrorSync
+from tom_eso.models import ESOProfile
+from tom_eso.name_index import EXACT, FUZZY, PREFIX, SUBSTRING, WORD_PREFIX, NameIndex, clear_name_indexes
+from tom_eso.tests.test_throttling import FakeClock
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+
+def ob(ob_id, name):
+    return {'obId': ob_id, 'name': name, 'itemType': 'OB'}
+
+
+def folder(container_id, name):
+    return {'containerId': container_id, 'name': name, 'itemType': 'Folder'}
+
+
+class TestNameIndex(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.index = NameIndex(clock=self.clock)
+        self.index.add_observing_runs([{'runId': 1, 'containerId': 10}])
+        self.index.update_container(10, [folder(11, 'Supernovae'), folder(12, 'Standard stars')])
+        self.index.update_container(11, [ob(101, 'SN2024abc'), ob(102, 'sn2024abc follow-up'),
+                                         ob(103, 'Host of SN2024abc'), ob(104, 'XSN2024abcd')])
+
+    def search(self, query, **kwargs):
+        return [(match.item_id, match.quality) for match in self.index.search(query, **kwargs)]
+
+    def test_ranking_by_match_quality(self):
+        self.assertEqual(self.search('sn2024abc'),
+                         [(101, EXACT), (102, PREFIX), (103, WORD_PREFIX), (104, SUBSTRING)])
+
+    def test_fuzzy_matches(self):
+        self.assertEqual(self.search('supernova')[0], (11, PREFIX))
+        self.assertEqual(self.search('supernvae'), [(11, FUZZY)])
+        self.assertEqual(self.search('qwerty'), [])
+
+    def test_word_separators(self):
+        self.assertEqual(self.search('follow up'), [(102, WORD_PREFIX)])
+        self.assertEqual(self.search('STANDARD_stars'), [(12, EXACT)])
+
+    def test_short_queries_match_word_starts(self):
+        self.assertEqual([item_id for item_id, _ in self.search('st')], [12])
+        self.assertEqual({item_id for item_id, _ in self.search('h')}, {103})
+
+    def test_recency_breaks_ties(self):
+        self.clock.sleep(1)
+        self.index.update_container(12, [ob(201, 'Star B'), ob(202, 'Star A')])
+        self.clock.sleep(1)
+        self.index.update_container(12, [ob(201, 'Star B'), ob(202, 'Star C')])  # renamed
+
+        self.assertEqual(self.search('star'), [(202, PREFIX), (201, PREFIX), (12, WORD_PREFIX)])
+
+    def test_items_removed_from_a_container_are_removed(self):
+        self.index.update_container(11, [ob(101, 'SN2024abc')])
+        self.assertEqual(self.search('sn2024abc'), [(101, EXACT)])
+
+        self.index.update_container(10, [folder(12, 'Standard stars')])  # the folder and its items are gone
+        self.assertEqual(self.search('sn2024'), [])
+        self.assertEqual(len(self.index), 1)
+
+    def test_moved_items(self):
+        self.index.update_container(12, [ob(101, 'SN2024abc')])
+        self.index.update_container(11, [ob(102, 'sn2024abc follow-up')])  # no longer lists 101
+
+        self.assertEqual([match.container_id for match in self.index.search('sn2024abc', limit=1)], [12])
+
+    def test_unchanged_versions_are_skipped(self):
+        self.index.update_container(12, [ob(201, 'Star A')], version='"1"')
+        self.index.update_container(12, [ob(202, 'Star B')], version='"1"')
+
+        self.assertEqual(self.search('star b'), [(201, FUZZY)])  # (similar to 'Star A')
+
+    def test_seeding(self):
+        index = NameIndex(clock=self.clock)
+        index.update_container(11, [ob(101, 'SN2024abc, renamed since the sync')], version='"2"')
+        runs = [{'runId': 1, 'containerId': 10}]
+        index.seed(runs, {10: [folder(11, 'Supernovae'), folder(12, 'Standard stars')],
+                          11: [ob(101, 'SN2024abc')], 12: [ob(201, 'Star A')]}, 'first sync')
+
+        self.assertEqual([match.name for match in index.search('sn2024abc')], ['SN2024abc, renamed since the sync'])
+        match, = index.search('star a', item_types=('OB',))
+        self.assertEqual((match.item_id, match.container_id, match.run_id), (201, 12, 1))
+
+        index.seed(runs, {10: [folder(11, 'Supernovae')], 11: [ob(101, 'SN2024abc')]}, 'second sync')
+
+        self.assertEqual(index.search('star'), [])  # deleted before the second sync
+        self.assertEqual(index.seeded_from, 'second sync')
+        self.assertEqual(len(index), 2)
+
+    def test_run_and_item_types(self):
+        match, = self.index.search('host')
+        self.assertEqual((match.container_id, match.run_id, match.name), (11, 1, 'Host of SN2024abc'))
+
+        self.assertEqual(self.search('s', item_types=('Folder',)), [(11, PREFIX), (12, PREFIX)])
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+@mock.patch('tom_eso.eso.get_encrypted_field', return_value='tutorial')
+class TestNameTypeahead(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_name_indexes()
+        self.addCleanup(clear_name_indexes)
+        get_connection_pool().clear()
+        self.addCleanup(get_connection_pool().clear)
+        self.api2 = fake_p2_connection()
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=self.api2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username='eso_user')
+        ESOProfile.objects.create(user=self.user, p2_environment='demo', p2_username='52052')
+
+    def typeahead(self, params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return json.loads(views.p2_name_typeahead(request).content)['results']
+
+    def test_p2_responses_are_indexed(self, mock_decrypt):
+        self.assertEqual(self.typeahead({'q': 'ob 1'}), [])
+
+        ESOAPI('demo', '52052', 'tutorial').observing_run_tree(1)
+        self.api2.reset_mock()
+
+        self.assertEqual(self.typeahead({'q': 'ob 1'}), [{
+            'id': 12, 'name': 'OB 1', 'itemType': 'OB', 'containerId': 11, 'runId': 1,
+            'p2_tool_url': 'https://www.eso.org/p2demo/home/ob/12',
+        }])
+        self.assertEqual([result['id'] for result in self.typeahead({'q': 'folder'})], [11])
+        self.assertEqual(self.api2.method_calls, [])  # the typeahead doesn't contact ESO
+
+    def test_names_are_seeded_from_the_mirror(self, mock_decrypt):
+        P2MirrorSync(ESOAPI('demo', '52052', 'tutorial')).sync()
+        clear_name_indexes()  # (the mirror is synced by another process)
+        self.api2.reset_mock()
+
+        results = self.typeahead({'q': 'ob 1'})
+
+        self.assertEqual([(result['id'], result['containerId'], result['runId']) for result in results], [(12, 11, 1)])
+        self.assertEqual(self.api2.method_calls, [])
+
+    def test_limit(self, mock_decrypt):
+        ESOAPI('demo', '52052', 'tutorial').observing_run_tree(1)
+
+        self.assertEqual(len(self.typeahead({'q': '1', 'limit': 1})), 1)
+        self.assertEqual(len(self.typeahead({'q': '1', 'limit': 'all'})), 2)
@@ -0,0 +1,130 @@
+import html
+import re
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+
+from tom_eso import views
+from tom_eso.connections import get_connection_pool
+from tom_eso.eso import ESOFacility
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+SEARCH_FACILITIES = {'ESO': {**TEST_FACILITIES['ESO'], 'observation_block_page_size': 10}}
+
+
+@override_settings(FACILITIES=SEARCH_FACILITIES)
+class TestObservationBlockSearch(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        self.addCleanup(get_connection_pool().clear)
+        self.api2 = fake_p2_connection()
+        folder_items = [{'obId': 1000 + i, 'name': f'Survey field {i:04d}', 'itemType': 'OB'} for i in range(2500)]
+        folder_items.append({'containerId': 99, 'name': 'Subfolder', 'itemType': 'Folder'})
+        self.api2.getItems.side_effect = lambda container_id: (folder_items, '"folder items"')
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=self.api2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username='eso_user')
+        self.facility = ESOFacility()
+        self.facility.set_user(self.user)
+
+    def get(self, view, params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return view(request)
+
+    def test_pages(self):
+        first_page = self.facility.search_observation_blocks(11)
+        self.assertEqual(first_page.choices[0], (1000, 'Survey field 0000 : OB'))
+        self.assertEqual((len(first_page.choices), first_page.total, first_page.has_more), (10, 2500, True))
+
+        last_page = self.facility.search_observation_blocks(11, page=250)
+        self.assertEqual(last_page.choices[-1], (3499, 'Survey field 2499 : OB'))
+        self.assertFalse(last_page.has_more)
+
+    def test_search(self):
+        page = self.facility.search_observation_blocks(11, query='FIELD 24')
+
+        self.assertEqual(page.total, 100)  # 2400-2499
+        self.assertEqual(page.choices[0], (3400, 'Survey field 2400 : OB'))
+
+    def test_folder_is_fetched_once(self):
+        for page_number in range(1, 4):
+            self.facility.search_observation_blocks(11, page=page_number)
+        self.facility.search_observation_blocks(11, query='field 1')
+
+        self.assertEqual(self.api2.getItems.call_count, 1)
+
+    def test_errors_are_shown_on_the_first_page(self):
+        self.api2.getItems.side_effect = Exception('P2 is down')
+
+        page = self.facility.search_observation_blocks(11)
+
+        self.assertEqual(page.choices, [])
+        self.assertEqual(page.notices[0][0], 0)
+
+    def get_url(self, view, url):
+        request = RequestFactory().get(url)
+        request.user = self.user
+        return view(request)
+
+    def load_more_url(self, content):
+        """Return the URL the "load more" control of a response gets, or None if it's emptied."""
+        control = re.search(r'<div id="id_observation_blocks_more" hx-swap-oob="true">(.*?)</div>', content)
+        self.assertIsNotNone(control)
+        url = re.search(r'hx-get="([^"]*)"', control.group(1))
+        return html.unescape(url.group(1)) if url else None
+
+    def test_observation_blocks_for_folder_renders_the_first_page(self):
+        response = self.get(views.observation_blocks_for_folder, {'p2_folder_name': 11})
+
+        self.assertContains(response, 'Survey field 0009')
+        self.assertNotContains(response, 'Survey field 0010')
+        self.assertContains(response, 'Showing 10 of 2500: load more')
+        self.assertEqual(self.load_more_url(response.content.decode()),
+                         '/eso/search-observation-blocks/?p2_folder_name=11&page=2')
+
+    def test_search_view(self):
+        response = self.get(views.search_observation_blocks,
+                            {'p2_folder_name': 11, 'observation_block_search': 'field 24', 'page': 2})
+
+        content = response.content.decode()
+        # the "load more" control is outside of the <select>, and comes before the options
+        self.assertTrue(content.startswith('<div id="id_observation_blocks_more" hx-swap-oob="true">'))
+        self.assertIn('</div><option value="3410">Survey field 2410 : OB</option>', content)
+        self.assertEqual(content.count('<option'), 10)
+        self.assertIn('Showing 20 of 100: load more', content)
+        self.assertEqual(self.load_more_url(content),
+                         '/eso/search-observation-blocks/?p2_folder_name=11&observation_block_search=field+24&page=3')
+
+    def test_load_more_pages_through_the_matches(self):
+        content = self.get(views.search_observation_blocks,
+                           {'p2_folder_name': 11, 'observation_block_search': 'field 24'}).content.decode()
+        options = re.findall(r'<option value="(\d+)">', content)
+        # click "load more" until the control is emptied
+        for _ in range(20):
+            url = self.load_more_url(content)
+            if url is None:
+                break
+            content = self.get_url(views.search_observation_blocks, url).content.decode()
+            options += re.findall(r'<option value="(\d+)">', content)
+
+        self.assertIsNone(self.load_more_url(content))
+        self.assertEqual(options, [str(ob_id) for ob_id in range(3400, 3500)])  # every match, once, in order
+
+    def test_search_view_without_matches(self):
+        response = self.get(views.search_observation_blocks,
+                            {'p2_folder_name': 11, 'observation_block_search': '<no such field>'})
+
+        self.assertEqual(response.content.decode(),
+                         '<div id="id_observation_blocks_more" hx-swap-oob="true"></div>'
+                         '<option value="">No matching observation blocks</option>')
+
+    def test_search_view_without_a_folder(self):
+        response = self.get(views.search_observation_blocks, {'observation_block_search': 'field'})
+
+        self.assertContains(response, 'Please select a Folder')
+        self.api2.getItems.assert_not_called()
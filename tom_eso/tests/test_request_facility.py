@@ -0,0 +1,127 @@
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import SynchronousOnlyOperation
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from tom_targets.models import Target
+
+from tom_eso import views
+from tom_eso.connections import get_connection_pool
+from tom_eso.credentials import get_credential_resolver
+from tom_eso.eso import ESOFacility
+from tom_eso.middleware import ESOFacilityMiddleware
+from tom_eso.models import ESOProfile
+from tom_eso.request_facility import aget_request_facility, get_request_facility
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+# resolve the credentials on every set_user(), so that the profile queries can be counted
+UNCACHED_CREDENTIALS_FACILITIES = {'ESO': {**TEST_FACILITIES['ESO'], 'credential_cache': {'timeout': 0}}}
+
+
+@override_settings(FACILITIES=UNCACHED_CREDENTIALS_FACILITIES)
+@mock.patch('tom_eso.eso.get_encrypted_field', return_value='secret')
+class TestRequestFacility(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_credential_resolver().clear()
+        get_connection_pool().clear()
+        self.addCleanup(get_connection_pool().clear)
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=fake_p2_connection())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username='eso_user', is_superuser=True)
+        ESOProfile.objects.create(user=self.user, p2_environment='demo', p2_username='52052')
+
+    def count_facilities_and_profile_queries(self, call):
+        """Call ``call()``; return the number of ESOFacility constructor calls and ESOProfile queries it made."""
+        with (mock.patch.object(ESOFacility, '__init__', autospec=True, side_effect=ESOFacility.__init__) as init,
+              CaptureQueriesContext(connection) as queries):
+            call()
+        return init.call_count, len([query for query in queries if ESOProfile._meta.db_table in query['sql']])
+
+    def request(self, params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return request
+
+    def test_one_facility_per_request(self, mock_decrypt):
+        request = self.request({'p2_observing_run': 1})
+        facility = get_request_facility(request)
+
+        self.assertIs(get_request_facility(request), facility)
+        self.assertIsNot(get_request_facility(self.request({})), facility)
+
+    def test_htmx_views(self, mock_decrypt):
+        for view, params in ((views.folders_for_observing_run, {'p2_observing_run': 1}),
+                             (views.folders_for_observing_run, {'p2_observing_run': 'invalid'}),
+                             (views.observation_blocks_for_folder, {'p2_folder_name': 11}),
+                             (views.show_observation_block, {'observation_blocks': 12})):
+            with self.subTest(view=view.__name__, params=params):
+                facilities, profile_queries = self.count_facilities_and_profile_queries(
+                    lambda: view(self.request(params)))
+                self.assertEqual((facilities, profile_queries), (1, 1))
+
+    def test_facilities_created_elsewhere_share_the_request_facility(self, mock_decrypt):
+        def view(request):
+            facility = get_request_facility(request)
+            other_facility = ESOFacility()  # e.g. tom_observations' ObservationCreateView
+            other_facility.set_user(request.user)
+            self.assertIs(other_facility.eso_api, facility.eso_api)
+            self.assertEqual(other_facility.credential_status, facility.credential_status)
+            return HttpResponse()
+
+        facilities, profile_queries = self.count_facilities_and_profile_queries(
+            lambda: ESOFacilityMiddleware(view)(self.request({})))
+        self.assertEqual((facilities, profile_queries), (2, 1))
+
+        # without the middleware, the other facility sets itself up
+        facilities, profile_queries = self.count_facilities_and_profile_queries(lambda: view(self.request({})))
+        self.assertEqual((facilities, profile_queries), (2, 2))
+
+    def test_other_users_do_not_share_the_request_facility(self, mock_decrypt):
+        other_user = User.objects.create(username='other_user')
+
+        def view(request):
+            facility = get_request_facility(request)
+            other_facility = ESOFacility()
+            other_facility.set_user(other_user)
+            self.assertIsNot(other_facility.eso_api, facility.eso_api)
+            return HttpResponse()
+
+        ESOFacilityMiddleware(view)(self.request({}))
+
+    async def test_the_lazy_facility_is_not_set_up_from_the_event_loop(self, mock_decrypt):
+        async def view(request):
+            with (mock.patch('tom_eso.request_facility.get_request_facility') as get_request_facility,
+                  self.assertRaises(SynchronousOnlyOperation)):
+                request.eso_facility.credential_status
+            get_request_facility.assert_not_called()  # e.g. with cached credentials, no query would raise
+            # but blocking code run in a thread can use it
+            credential_status = await sync_to_async(lambda: request.eso_facility.credential_status)()
+            self.assertEqual(credential_status, (await aget_request_facility(request)).credential_status)
+            return HttpResponse()
+
+        response = await ESOFacilityMiddleware(view)(self.request({}))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(TOM_FACILITY_CLASSES=['tom_eso.eso.ESOFacility'],
+                       MIDDLEWARE=settings.MIDDLEWARE + ['tom_eso.middleware.ESOFacilityMiddleware'])
+    def test_observation_create_view(self, mock_decrypt):
+        target = Target.objects.create(name='M31', type=Target.SIDEREAL, ra=10.68, dec=41.27)
+        self.client.force_login(self.user)
+
+        def get_observation_form():
+            response = self.client.get(reverse('tom_observations:create', kwargs={'facility': 'ESO'}),
+                                       {'target_id': target.id})
+            self.assertEqual(response.status_code, 200)
+
+        get_observation_form()  # the first request logs in
+        _, profile_queries = self.count_facilities_and_profile_queries(get_observation_form)
+        self.assertEqual(profile_queries, 1)
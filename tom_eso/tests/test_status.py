@@ -0,0 +1,128 @@
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from tom_observations.models import ObservationRecord
+from tom_targets.models import Target
+
+from tom_eso.connections import get_connection_pool
+from tom_eso.eso import ESOFacility
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestObservationStatusUpdates(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        self.user = User.objects.create(username='eso_user')
+        self.target = Target.objects.create(name='M31', type=Target.SIDEREAL, ra=10.68, dec=41.27)
+        # OBs with an odd obId have been completed, the others have been started
+        self.api2 = fake_p2_connection()
+        self.api2.getOB.side_effect = lambda ob_id: ({'obId': ob_id, 'obStatus': 'C' if ob_id % 2 else 'S'}, '"ob"')
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=self.api2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_connection_pool().clear)
+
+        self.facility = ESOFacility()
+        self.facility.set_user(self.user)
+
+    def create_records(self, observation_ids, status='DEFINED', facility='ESO'):
+        return ObservationRecord.objects.bulk_create([
+            ObservationRecord(target=self.target, user=self.user, facility=facility, parameters={},
+                              observation_id=str(observation_id), status=status)
+            for observation_id in observation_ids
+        ])
+
+    def statuses(self):
+        return {record.observation_id: record.status for record in ObservationRecord.objects.filter(facility='ESO')}
+
+    def test_get_observation_status(self):
+        self.assertEqual(self.facility.get_observation_status('101'),
+                         {'state': 'COMPLETED', 'scheduled_start': None, 'scheduled_end': None})
+        self.assertIn('COMPLETED', self.facility.get_terminal_observing_states())
+
+    def test_records_are_updated_in_one_query(self):
+        self.create_records(range(101, 111))
+        self.create_records([201], status='CANCELLED')  # terminal, so not looked up
+        self.create_records([301], facility='LCO')  # not ESO
+
+        with CaptureQueriesContext(connection) as queries:
+            failed_records = self.facility.update_all_observation_statuses()
+
+        self.assertEqual(failed_records, [])
+        statuses = self.statuses()
+        self.assertEqual(statuses['101'], 'COMPLETED')
+        self.assertEqual(statuses['102'], 'STARTED')
+        self.assertEqual(statuses['201'], 'CANCELLED')
+        self.assertEqual(sorted(call.args[0] for call in self.api2.getOB.call_args_list), list(range(101, 111)))
+        updates = [query for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+
+    def test_records_are_updated_in_batches(self):
+        self.create_records(range(101, 111))
+        self.create_records([101, 101])  # the same OB, tracked by several records, is fetched once
+
+        with override_settings(FACILITIES={'ESO': {**TEST_FACILITIES['ESO'], 'status_batch_size': 4}}):
+            with CaptureQueriesContext(connection) as queries:
+                self.facility.update_all_observation_statuses()
+
+        self.assertEqual(set(self.statuses().values()), {'COMPLETED', 'STARTED'})
+        updates = [query for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 3)  # 12 records in batches of 4
+
+    def test_unchanged_records_are_not_written(self):
+        self.create_records([102], status='STARTED')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.facility.update_all_observation_statuses()
+
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE')])
+
+    def test_state_change_hook_runs_for_changed_records(self):
+        self.create_records([101, 102])
+        self.create_records([104], status='STARTED')  # unchanged
+
+        with mock.patch('tom_eso.status.run_hook') as run_hook:
+            self.facility.update_all_observation_statuses()
+
+        self.assertEqual(sorted((call.args[0], call.args[1].observation_id, call.args[1].status, call.args[2])
+                                for call in run_hook.call_args_list),
+                         [('observation_change_state', '101', 'COMPLETED', 'DEFINED'),
+                          ('observation_change_state', '102', 'STARTED', 'DEFINED')])
+
+    def test_failures_are_reported_per_record(self):
+        self.create_records([101, 102])
+        get_ob = self.api2.getOB.side_effect
+
+        def failing_get_ob(ob_id):
+            if ob_id == 102:
+                raise Exception('OB not found')
+            return get_ob(ob_id)
+        self.api2.getOB.side_effect = failing_get_ob
+
+        failed_records = self.facility.update_all_observation_statuses()
+
+        self.assertEqual(failed_records, [('102', 'OB not found')])
+        self.assertEqual(self.statuses(), {'101': 'COMPLETED', '102': 'DEFINED'})
+
+    def test_observation_blocks_are_fetched_concurrently(self):
+        self.create_records(range(101, 117))
+        get_ob = self.api2.getOB.side_effect
+        latency = 0.05
+
+        def slow_get_ob(ob_id):
+            time.sleep(latency)
+            return get_ob(ob_id)
+        self.api2.getOB.side_effect = slow_get_ob
+
+        start = time.perf_counter()
+        self.facility.update_all_observation_statuses()
+        elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 16 * latency / 2)
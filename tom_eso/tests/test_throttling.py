@@ -0,0 +1,178 @@
+import threading
+from unittest import mock
+
+import requests
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from p2api.p2api import P2Error
+
+from tom_eso import metrics
+from tom_eso.eso_api import ESOAPI
+from tom_eso.throttling import CacheRateLimiter, TokenBucket, call_with_retries, get_rate_limiter, is_retryable
+
+NO_DELAY_FACILITIES = {
+    'ESO': {
+        'rate_limit': {'rate': None},
+        'retries': {'max_retries': 3, 'base_delay': 0, 'max_delay': 0},
+    },
+}
+
+
+class FakeClock:
+    """A clock that only moves when something sleeps."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket(TestCase):
+    def test_burst_is_allowed_then_calls_are_spaced_at_the_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, burst=5, clock=clock, sleep=clock.sleep)
+
+        waits = [bucket.acquire() for _ in range(8)]
+
+        self.assertEqual(waits[:5], [0] * 5)
+        for wait in waits[5:]:
+            self.assertAlmostEqual(wait, 0.1)
+        self.assertAlmostEqual(clock.now, 1000.3)
+
+    def test_bucket_refills_while_idle(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, burst=5, clock=clock, sleep=clock.sleep)
+        for _ in range(5):
+            bucket.acquire()
+
+        clock.now += 10  # longer than it takes to refill
+
+        self.assertEqual([bucket.acquire() for _ in range(5)], [0] * 5)
+        self.assertGreater(bucket.acquire(), 0)
+
+    def test_bucket_is_shared_between_threads(self):
+        bucket = TokenBucket(rate=1, burst=20)
+        waits = []
+
+        def take_tokens():
+            for _ in range(5):
+                waits.append(bucket.acquire())
+        threads = [threading.Thread(target=take_tokens) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # exactly the burst was handed out, without waiting
+        self.assertEqual(waits, [0] * 20)
+        self.assertLess(bucket._tokens, 1)
+
+
+class TestCacheRateLimiter(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_calls_are_limited_per_window_across_limiters(self):
+        clock = FakeClock()
+        # e.g. two worker processes, sharing the limit through the cache
+        first = CacheRateLimiter('tom_eso:test', rate=3, clock=clock, sleep=clock.sleep)
+        second = CacheRateLimiter('tom_eso:test', rate=3, clock=clock, sleep=clock.sleep)
+
+        waits = [first.acquire(), second.acquire(), first.acquire(), second.acquire()]
+
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 1.0)  # the next window
+
+
+class TestGetRateLimiter(TestCase):
+    @override_settings(FACILITIES={'ESO': {'rate_limit': {'rate': 5, 'burst': 10}}})
+    def test_one_bucket_per_account(self):
+        self.assertIs(get_rate_limiter('demo', '52052'), get_rate_limiter('demo', '52052'))
+        self.assertIsNot(get_rate_limiter('demo', '52052'), get_rate_limiter('demo', 'other'))
+        self.assertIsNot(get_rate_limiter('demo', '52052'), get_rate_limiter('production', '52052'))
+
+    @override_settings(FACILITIES={'ESO': {'rate_limit': {'rate': 5, 'shared': True}}})
+    def test_shared_limiter(self):
+        self.assertIsInstance(get_rate_limiter('demo', '52052'), CacheRateLimiter)
+
+    @override_settings(FACILITIES={'ESO': {'rate_limit': {'rate': None}}})
+    def test_rate_limit_can_be_disabled(self):
+        self.assertIsNone(get_rate_limiter('demo', '52052'))
+
+
+class TestRetries(TestCase):
+    def test_retryable_errors(self):
+        self.assertTrue(is_retryable(P2Error(503, 'GET', '/obsRuns', 'unavailable'), 'getRuns'))
+        self.assertTrue(is_retryable(P2Error(429, 'GET', '/obsRuns', 'too many requests'), 'getRuns'))
+        self.assertTrue(is_retryable(requests.ConnectionError(), 'getRuns'))
+        self.assertTrue(is_retryable(requests.Timeout(), 'getRuns'))
+        self.assertFalse(is_retryable(P2Error(404, 'GET', '/obsRuns/1', 'not found'), 'getRun'))
+        self.assertFalse(is_retryable(ValueError(), 'getRuns'))
+
+    def test_creates_are_only_retried_when_not_processed(self):
+        self.assertTrue(is_retryable(P2Error(429, 'POST', '/containers/1/items', ''), 'createOB'))
+        self.assertFalse(is_retryable(P2Error(500, 'POST', '/containers/1/items', ''), 'createOB'))
+        self.assertFalse(is_retryable(requests.ReadTimeout(), 'createOB'))
+        self.assertTrue(is_retryable(requests.exceptions.ConnectTimeout(), 'createOB'))
+
+    @override_settings(FACILITIES=NO_DELAY_FACILITIES)
+    def test_transient_failures_are_retried(self):
+        metrics.reset()
+        call = mock.Mock(side_effect=[P2Error(503, 'GET', '/obsRuns', ''), requests.ConnectionError(), 'runs'])
+
+        self.assertEqual(call_with_retries(call, 'getRuns', 'demo'), 'runs')
+        self.assertEqual(call.call_count, 3)
+        self.assertEqual(metrics.get_counter('p2_calls_retried_total', method='getRuns', environment='demo'), 2)
+
+    @override_settings(FACILITIES=NO_DELAY_FACILITIES)
+    def test_retries_give_up(self):
+        call = mock.Mock(side_effect=P2Error(503, 'GET', '/obsRuns', ''))
+
+        with self.assertRaises(P2Error):
+            call_with_retries(call, 'getRuns', 'demo')
+        self.assertEqual(call.call_count, 4)  # the call, and 3 retries
+
+    @override_settings(FACILITIES=NO_DELAY_FACILITIES)
+    def test_permanent_failures_are_not_retried(self):
+        call = mock.Mock(side_effect=P2Error(404, 'GET', '/obsRuns/1', 'not found'))
+
+        with self.assertRaises(P2Error):
+            call_with_retries(call, 'getRun', 'demo')
+        call.assert_called_once()
+
+    @override_settings(FACILITIES={'ESO': {'retries': {'max_retries': 3, 'base_delay': 1, 'max_delay': 4}}})
+    def test_backoff_is_exponential_with_jitter(self):
+        call = mock.Mock(side_effect=[P2Error(503, 'GET', '/obsRuns', '')] * 3 + ['runs'])
+        sleep = mock.Mock()
+
+        with mock.patch('tom_eso.throttling.random.uniform', side_effect=lambda low, high: high) as uniform:
+            call_with_retries(call, 'getRuns', 'demo', sleep=sleep)
+
+        self.assertEqual([c.args for c in uniform.call_args_list], [(0, 1), (0, 2), (0, 4)])
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [1, 2, 4])
+
+
+@mock.patch('tom_eso.eso_api.p2api.ApiConnection')
+class TestESOAPIThrottling(TestCase):
+    @override_settings(FACILITIES=NO_DELAY_FACILITIES)
+    def test_p2_calls_are_retried(self, mock_p2):
+        mock_p2.return_value.getRuns.side_effect = [P2Error(502, 'GET', '/obsRuns', ''), ([], '"runs"')]
+        eso_api = ESOAPI('demo', '52052', 'tutorial')
+
+        self.assertEqual(eso_api.observing_run_choices(), [])
+        self.assertEqual(mock_p2.return_value.getRuns.call_count, 2)
+
+    @override_settings(FACILITIES={'ESO': {'rate_limit': {'rate': 10, 'burst': 1}}})
+    def test_p2_calls_are_rate_limited(self, mock_p2):
+        metrics.reset()
+        mock_p2.return_value.getItems.return_value = ([], '"items"')
+        eso_api = ESOAPI('demo', 'throttled', 'tutorial')
+
+        for container_id in range(3):
+            eso_api.folder_ob_choices(container_id)
+
+        self.assertEqual(metrics.get_counter('p2_calls_throttled_total', method='getItems', environment='demo'), 2)
@@ -0,0 +1,114 @@
+import asyncio
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+
+from tom_eso import timing, views
+from tom_eso.concurrency import map_concurrently, run_blocking
+from tom_eso.connections import get_connection_pool
+from tom_eso.credentials import get_credential_resolver
+from tom_eso.middleware import ServerTimingMiddleware
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+
+
+def server_timing_phases(response):
+    """Return the names of the metrics in the response's Server-Timing header."""
+    return [metric.split(';')[0].strip() for metric in response['Server-Timing'].split(',')]
+
+
+class TestRequestTimings(TestCase):
+    def test_phases_are_added_up_and_counted(self):
+        timings = timing.RequestTimings()
+        timings.record('p2', 0.1)
+        timings.record('p2', 0.2)
+        timings.record('render', 0.05)
+
+        self.assertEqual(timings.server_timing(total=0.5),
+                         'p2;dur=300.0;desc="ESO P2 API (2)", render;dur=50.0;desc="Form field rendering", '
+                         'total;dur=500.0')
+
+    def test_nothing_is_recorded_outside_a_request(self):
+        with timing.timed('p2'):
+            pass
+        self.assertIsNone(timing.get_timings())
+
+    def test_threads_record_into_the_callers_timings(self):
+        timings, token = timing.start()
+        self.addCleanup(timing.stop, token)
+
+        def call_p2(item):
+            with timing.timed('p2'):
+                return item
+        map_concurrently(call_p2, range(4), max_workers=4)
+
+        self.assertEqual(timings.phases['p2'][1], 4)
+
+    def test_blocking_calls_from_async_code_record_into_the_callers_timings(self):
+        def login():
+            with timing.timed('eso_login'):
+                pass
+
+        async def request_with_login():
+            timings, token = timing.start()
+            try:
+                await run_blocking(login)
+                return timings
+            finally:
+                timing.stop(token)
+
+        self.assertEqual(asyncio.run(request_with_login()).phases['eso_login'][1], 1)
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestServerTimingMiddleware(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        get_credential_resolver().clear()
+        self.addCleanup(get_connection_pool().clear)
+        self.user = User.objects.create(username='eso_user')
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=fake_p2_connection())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return request
+
+    def test_htmx_fragment_timings(self):
+        middleware = ServerTimingMiddleware(views.folders_for_observing_run)
+
+        response = middleware(self.request({'p2_observing_run': 1}))
+
+        self.assertEqual(server_timing_phases(response), ['eso_login', 'eso_profile', 'p2', 'render', 'total'])
+        self.assertIn('desc="ESO P2 API (3)"', response['Server-Timing'])  # getRun, and getItems twice
+
+    async def test_async_view_timings(self):
+        middleware = ServerTimingMiddleware(views.folders_for_observing_run_async)
+
+        response = await middleware(self.request({'p2_observing_run': 1}))
+
+        self.assertIn('p2', server_timing_phases(response))
+        self.assertIn('render', server_timing_phases(response))
+
+    def test_other_responses_are_untouched(self):
+        middleware = ServerTimingMiddleware(lambda request: HttpResponse('not tom_eso'))
+
+        response = middleware(self.request({}))
+
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_existing_server_timing_is_kept(self):
+        def view(request):
+            with timing.timed('p2'):
+                response = HttpResponse()
+            response['Server-Timing'] = 'db;dur=1.0'
+            return response
+
+        response = ServerTimingMiddleware(view)(self.request({}))
+
+        self.assertTrue(response['Server-Timing'].startswith('db;dur=1.0, p2;dur='))
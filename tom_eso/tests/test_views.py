@@ -0,0 +1,139 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+
+from tom_eso import views
+from tom_eso.connections import get_connection_pool
+from tom_eso.eso import lazy_choices
+
+TEST_FACILITIES = {
+    'ESO': {
+        'p2_environment': 'demo',
+        'p2_username': '52052',
+        'p2_password': 'tutorial',
+        # the rate limiter is process-wide, so it would carry over between tests (see test_throttling.py)
+        'rate_limit': {'rate': None},
+    },
+}
+
+
+def fake_p2_connection():
+    """Return a mock p2api.ApiConnection with responses for the calls made by the HTMX views."""
+    api2 = mock.MagicMock()
+    api2.getRuns.return_value = (
+        [{'runId': 1, 'progId': '60.A-9252(M)', 'telescope': 'UT2', 'instrument': 'UVES'}], '"runs"')
+    api2.getRun.return_value = ({'runId': 1, 'containerId': 10}, '"run"')
+    api2.getItems.side_effect = lambda container_id: {
+        10: ([{'containerId': 11, 'name': 'Folder 1', 'itemType': 'Folder'}], '"run items"'),
+        11: ([{'obId': 12, 'name': 'OB 1', 'itemType': 'OB'}], '"folder items"'),
+    }[container_id]
+    return api2
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestHTMXViewP2Calls(TestCase):
+    """Each HTMX endpoint should make exactly the P2 calls it needs, and no others."""
+
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        self.user = User.objects.create(username='eso_user')
+        self.api2 = fake_p2_connection()
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=self.api2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_connection_pool().clear)
+
+    def get(self, view, params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return view(request)
+
+    def p2_calls(self):
+        return [name for name, _, _ in self.api2.method_calls]
+
+    def test_folders_for_observing_run(self):
+        response = self.get(views.folders_for_observing_run, {'p2_observing_run': 1})
+
+        self.assertContains(response, 'Folder 1')
+        # the run container, and the folder in it (which might contain nested folders)
+        self.assertEqual(self.p2_calls(), ['getRun', 'getItems', 'getItems'])
+
+    def test_folders_for_observing_run_without_a_run(self):
+        self.get(views.folders_for_observing_run, {})
+        self.assertEqual(self.p2_calls(), [])
+
+    def test_observation_blocks_for_folder(self):
+        response = self.get(views.observation_blocks_for_folder, {'p2_folder_name': 11})
+
+        self.assertContains(response, 'OB 1')
+        self.assertEqual(self.p2_calls(), ['getItems'])
+
+    def test_show_observation_block(self):
+        response = self.get(views.show_observation_block, {'observation_blocks': 12})
+
+        self.assertContains(response, '/ob/12')
+        self.assertEqual(self.p2_calls(), [])
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestObservingRunTreeView(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        self.user = User.objects.create(username='eso_user')
+        self.api2 = fake_p2_connection()
+        self.api2.getItems.side_effect = lambda container_id: {
+            10: ([{'containerId': 11, 'name': 'Folder 1', 'itemType': 'Folder'},
+                  {'containerId': 21, 'name': 'Folder 2', 'itemType': 'Folder'}], '"run items"'),
+            11: ([{'obId': 12, 'name': 'OB 1', 'itemType': 'OB'}], '"folder 1 items"'),
+            21: ([{'obId': 22, 'name': 'OB 2', 'itemType': 'OB'}], '"folder 2 items"'),
+        }[container_id]
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=self.api2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_connection_pool().clear)
+
+    def get(self, view, params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return view(request)
+
+    def test_tree_contains_every_folder_and_observation_block(self):
+        response = self.get(views.observing_run_tree, {'p2_observing_run': 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertJSONEqual(response.content, {
+            'runId': 1,
+            'containerId': 10,
+            'folders': [
+                {'id': 11, 'name': 'Folder 1', 'observation_blocks': [[12, 'OB 1 : OB']]},
+                {'id': 21, 'name': 'Folder 2', 'observation_blocks': [[22, 'OB 2 : OB']]},
+            ]})
+
+    def test_tree_warms_the_folder_dropdown(self):
+        self.get(views.observing_run_tree, {'p2_observing_run': 1})
+        self.api2.reset_mock()
+
+        response = self.get(views.observation_blocks_for_folder, {'p2_folder_name': 21})
+        self.assertContains(response, 'OB 2')
+        self.assertEqual(self.api2.method_calls, [])
+
+    def test_missing_observing_run(self):
+        response = self.get(views.observing_run_tree, {})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestLazyChoices(TestCase):
+    def test_choices_are_fetched_once(self):
+        for result in ([(1, 'Run 1')], []):  # empty choices are remembered too
+            with self.subTest(result=result):
+                get_choices = mock.Mock(return_value=result)
+                choices = lazy_choices(get_choices, 10)
+                get_choices.assert_not_called()
+
+                self.assertEqual(choices(), result)
+                self.assertEqual(choices(), result)
+                get_choices.assert_called_once_with(10)
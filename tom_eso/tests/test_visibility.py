@@ -0,0 +1,139 @@
+from datetime import date, datetime, timezone
+from unittest import mock
+
+import numpy as np
+from astropy.coordinates import get_body, get_sun
+from astropy.time import Time
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from tom_targets.models import Target
+
+from tom_eso import visibility
+from tom_eso.connections import get_connection_pool
+from tom_eso.eso import ESOFacility
+from tom_eso.tests.test_views import TEST_FACILITIES, fake_p2_connection
+from tom_eso.visibility import (NightGrid, VisibilityStore, airmass, altitude, eso_period, eso_period_dates, gmst,
+                                moon_position, sun_position, target_visibility)
+
+PARANAL = ESOFacility().get_observing_sites()['PARANAL']
+
+
+class TestAstronomy(SimpleTestCase):
+    def test_eso_periods(self):
+        self.assertEqual(eso_period(datetime(2024, 3, 31)), 112)
+        self.assertEqual(eso_period(datetime(2024, 4, 1)), 113)
+        self.assertEqual(eso_period(datetime(2024, 10, 1)), 114)
+        self.assertEqual(eso_period_dates(113), (datetime(2024, 4, 1, tzinfo=timezone.utc),
+                                                 datetime(2024, 10, 1, tzinfo=timezone.utc)))
+        self.assertEqual(eso_period_dates(114)[1], datetime(2025, 4, 1, tzinfo=timezone.utc))
+
+    def test_sun_and_moon_positions(self):
+        jd = np.linspace(2460400.0, 2460800.0, 17)
+        sun, moon = get_sun(Time(jd, format='jd')), get_body('moon', Time(jd, format='jd'))
+
+        # (the low-precision positions are for the equinox of date, so they differ by the precession since J2000)
+        for (ra, dec), expected, tolerance in ((sun_position(jd), sun, 0.5), (moon_position(jd), moon, 1.0)):
+            np.testing.assert_allclose(np.degrees(dec), expected.dec.deg, atol=tolerance)
+            ra_difference = (np.degrees(ra) - expected.ra.deg + 180) % 360 - 180
+            np.testing.assert_allclose(ra_difference, 0, atol=tolerance)
+
+    def test_altitude_and_airmass(self):
+        self.assertAlmostEqual(np.degrees(gmst(2451545.0)), 280.46061837)
+        latitude = np.radians(PARANAL['latitude'])
+
+        zenith = altitude(1.0, latitude, latitude, 1.0)  # a target at the zenith, crossing the meridian
+        self.assertAlmostEqual(np.degrees(zenith), 90.0)
+        self.assertAlmostEqual(airmass(zenith), 1.0, places=3)
+        self.assertAlmostEqual(airmass(np.radians(30.0)), 2.0, delta=0.01)
+        self.assertEqual(airmass(np.radians(-1.0)), np.inf)
+
+
+class TestNightGrid(SimpleTestCase):
+    def setUp(self):
+        self.grid = NightGrid(PARANAL, 114)
+
+    def test_nights(self):
+        self.assertEqual(self.grid.n_nights, 182)
+        self.assertEqual((self.grid.night_date(0), self.grid.night_date(181)), (date(2024, 10, 1), date(2025, 3, 31)))
+        self.assertEqual(set(self.grid.night), set(range(182)))  # every night has dark time
+
+    def test_vectorized_matches_per_target(self):
+        rng = np.random.default_rng(0)
+        ras, decs = rng.uniform(0, 360, 40), rng.uniform(-90, 90, 40)
+
+        with mock.patch.object(visibility, 'TARGET_CHUNK_SIZE', 16):
+            result = self.grid.visibility(ras, decs)
+        for index, (ra, dec) in enumerate(zip(ras, decs)):
+            single = self.grid.visibility([ra], [dec])
+            np.testing.assert_array_equal(result.nightly_steps[index], single.nightly_steps[0])
+            np.testing.assert_array_equal(result.nightly_best_airmass[index], single.nightly_best_airmass[0])
+            np.testing.assert_array_equal(result.min_moon_distance[index], single.min_moon_distance[0])
+
+    def test_constraints(self):
+        # a target that never rises at Paranal, and one that culminates near the zenith at midnight in December
+        result = self.grid.visibility([0.0, 90.0], [80.0, -25.0])
+
+        self.assertEqual(result.nightly_steps[0].sum(), 0)
+        self.assertTrue(np.isnan(result.min_moon_distance[0]))
+        self.assertGreater(result.nightly_steps[1, 80], 10)  # 20 December: all night, at 30 minute steps
+        self.assertLess(np.nanmin(result.nightly_best_airmass[1]), 1.01)
+
+        strict = self.grid.visibility([90.0], [-25.0], max_airmass=1.2, min_moon_distance=90)
+        self.assertLess(strict.nightly_steps.sum(), result.nightly_steps[1].sum())
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestVisibilityStore(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_serialization(self):
+        steps, best_airmass = np.array([0, 3, 18], dtype=np.uint16), np.array([np.nan, 1.5, 1.02])
+        data = VisibilityStore.serialize(steps, best_airmass, 42.5)
+
+        stored_steps, stored_airmass, moon_distance = VisibilityStore.deserialize(data, 3)
+        np.testing.assert_array_equal(stored_steps, steps)
+        np.testing.assert_allclose(stored_airmass, best_airmass, rtol=1e-3)
+        self.assertEqual(moon_distance, 42.5)
+
+    def test_only_new_targets_are_computed(self):
+        with mock.patch.object(NightGrid, 'visibility', autospec=True, side_effect=NightGrid.visibility) as compute:
+            _, first = target_visibility([10.0, 20.0], [-30.0, -40.0], PARANAL, 114)
+            _, second = target_visibility([20.0, 30.0, 10.0], [-40.0, -50.0, -30.0], PARANAL, 114)
+
+        self.assertEqual([len(call.args[1]) for call in compute.call_args_list], [2, 1])
+        np.testing.assert_array_equal(second.nightly_steps[[2, 0]], first.nightly_steps)
+        np.testing.assert_allclose(second.nightly_best_airmass[[2, 0]], first.nightly_best_airmass, rtol=1e-3)
+
+
+@override_settings(FACILITIES=TEST_FACILITIES)
+class TestTargetVisibilityRanking(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_connection_pool().clear()
+        self.addCleanup(get_connection_pool().clear)
+        patcher = mock.patch('tom_eso.eso_api.p2api.ApiConnection', return_value=fake_p2_connection())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.facility = ESOFacility()
+        self.facility.set_user(User.objects.create(username='eso_user'))
+
+    def test_ranking(self):
+        targets = [
+            Target.objects.create(name='Polaris', type=Target.SIDEREAL, ra=37.95, dec=89.26),
+            Target.objects.create(name='Orion', type=Target.SIDEREAL, ra=83.82, dec=-5.39),
+            Target.objects.create(name='Sgr A*', type=Target.SIDEREAL, ra=266.42, dec=-29.01),
+            Target.objects.create(name='Comet', type=Target.NON_SIDEREAL),
+        ]
+
+        result = self.facility.get_target_visibility(targets, period=114)  # October to March
+
+        self.assertEqual((result['start'], result['end']), (date(2024, 10, 1), date(2025, 3, 31)))
+        self.assertEqual(result['sites'], ['PARANAL', 'LA_SILLA'])
+        self.assertEqual([row['target'].name for row in result['ranking']], ['Orion', 'Sgr A*', 'Polaris'])
+        orion, _, polaris = result['ranking']
+        self.assertEqual(orion['hours'], max(orion['site_hours']))
+        self.assertLess(orion['first_night'], orion['last_night'])
+        self.assertEqual((polaris['site'], polaris['hours'], polaris['best_airmass']), (None, 0.0, None))
+        self.assertEqual(result['unranked'], [targets[3]])
@@ -0,0 +1,197 @@
+"""
+Rate limiting and retries for the calls tom_eso makes to the ESO Phase 2 API.
+
+Every upstream P2 call made by ``ESOAPI`` first takes a token from its ESO account's
+``TokenBucket`` (shared by all the threads of the process), so a burst of dropdown changes or a
+bulk job can't flood ESO. With ``'shared': True`` the limit is instead enforced across all
+processes, through the Django cache (see ``CacheRateLimiter``).
+
+Calls that fail with a transient error (a connection error or timeout, or an HTTP 408, 429 or
+5xx response) are retried with jittered exponential backoff; calls that create something in P2
+are only retried when ESO certainly didn't process them (HTTP 429 or 503).
+
+Both are configured in ``settings.FACILITIES['ESO']`` (the defaults are shown):
+
+    'ESO': {
+        ...
+        'rate_limit': {
+            'rate': 10,  # calls per second per ESO account (None to disable the rate limit)
+            'burst': 20,  # calls that may be made at once after a quiet period
+            'shared': False,  # True to share the limit between processes through the Django cache
+            'cache_alias': 'default',
+        },
+        'retries': {
+            'max_retries': 3,
+            'base_delay': 0.5,  # seconds
+            'max_delay': 8.0,  # seconds
+        },
+    }
+"""
+import logging
+import random
+import threading
+import time
+
+import requests
+from django.core.cache import caches
+from p2api.p2api import P2Error
+
+from tom_eso import metrics
+from tom_eso.choice_cache import credential_key
+from tom_eso.conf import get_eso_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE = 10  # calls per second
+DEFAULT_BURST = 20
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BASE_DELAY = 0.5  # seconds
+DEFAULT_MAX_DELAY = 8.0  # seconds
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# status codes of the responses to requests that ESO did not process, so that it is safe to repeat any request
+UNPROCESSED_STATUS_CODES = {429, 503}
+# p2api methods that create something, which must not be repeated if ESO might have processed them
+NON_IDEMPOTENT_PREFIXES = ('create', 'duplicate', 'add', 'submit', 'copy')
+
+
+class TokenBucket:
+    """A thread-safe token bucket: ``rate`` tokens per second, holding at most ``burst`` tokens."""
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = burst
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if necessary. Return the number of seconds waited.
+
+        A caller that finds the bucket empty reserves the next token (leaving the bucket in debt)
+        and sleeps until it is due, so concurrent callers are served in turn.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+class CacheRateLimiter:
+    """A rate limiter shared between processes through a Django cache backend.
+
+    The Django cache API has no compare-and-set, so instead of a token bucket this counts the calls
+    in each one-second window with the (atomic, on Redis and Memcached) ``incr()``, allowing up to
+    ``rate`` calls per window. Once a window is full, callers wait for the next one.
+    """
+
+    def __init__(self, key, rate, cache_alias='default', clock=time.time, sleep=time.sleep):
+        self.key = key
+        self.rate = rate
+        self.cache_alias = cache_alias
+        self._clock = clock
+        self._sleep = sleep
+
+    def acquire(self):
+        """Count a call in the current window, waiting for a window with room if necessary.
+        Return the number of seconds waited.
+        """
+        cache = caches[self.cache_alias]
+        waited = 0.0
+        while True:
+            now = self._clock()
+            window = int(now)
+            window_key = f'{self.key}:{window}'
+            try:
+                cache.add(window_key, 0, timeout=5)
+                calls = cache.incr(window_key)
+            except Exception as ex:
+                logger.warning(f'CacheRateLimiter: cache unavailable, not rate limiting: {ex}')
+                return waited
+            if calls <= self.rate:
+                return waited
+            wait = window + 1 - now
+            self._sleep(wait)
+            waited += wait
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(environment, username):
+    """Return the rate limiter of the ESO account, or None if rate limiting is disabled."""
+    rate_limit_settings = get_eso_setting('rate_limit', {})
+    rate = rate_limit_settings.get('rate', DEFAULT_RATE)
+    if not rate:
+        return None
+
+    key = f'tom_eso:rate_limit:{credential_key(environment, username)}'
+    if rate_limit_settings.get('shared', False):
+        return CacheRateLimiter(key, rate, cache_alias=rate_limit_settings.get('cache_alias', 'default'))
+
+    burst = rate_limit_settings.get('burst', DEFAULT_BURST)
+    with _rate_limiters_lock:
+        rate_limiter = _rate_limiters.get(key)
+        if rate_limiter is None or (rate_limiter.rate, rate_limiter.burst) != (rate, burst):
+            rate_limiter = _rate_limiters[key] = TokenBucket(rate, burst)
+        return rate_limiter
+
+
+def is_transient_error(exception):
+    """Return True if ``exception`` is a failure that may well not happen again (ESO being down or overloaded)."""
+    if isinstance(exception, P2Error):
+        return (exception.args[0] if exception.args else None) in RETRYABLE_STATUS_CODES
+    return isinstance(exception, (requests.ConnectionError, requests.Timeout))
+
+
+def is_retryable(exception, method_name):
+    """Return True if the call ``method_name`` that raised ``exception`` should be retried."""
+    if not is_transient_error(exception):
+        return False
+    if not method_name.startswith(NON_IDEMPOTENT_PREFIXES):
+        return True
+    if isinstance(exception, P2Error):
+        return exception.args[0] in UNPROCESSED_STATUS_CODES
+    # a create that timed out (or lost its connection) might have been processed, unless it never connected
+    return isinstance(exception, requests.exceptions.ConnectTimeout)
+
+
+def backoff_delay(attempt, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+    """Return the delay before retry number ``attempt`` (0-based): exponential backoff with full jitter."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def throttle(rate_limiter, method_name, environment):
+    """Wait for the ``rate_limiter`` (if any) to allow a call, counting the calls that had to wait."""
+    if rate_limiter is not None and rate_limiter.acquire() > 0:
+        metrics.increment('p2_calls_throttled_total', method=method_name, environment=environment)
+
+
+def call_with_retries(call, method_name, environment, rate_limiter=None, sleep=time.sleep):
+    """Return ``call()``, rate limited by ``rate_limiter``, retrying transient failures with backoff."""
+    retry_settings = get_eso_setting('retries', {})
+    max_retries = retry_settings.get('max_retries', DEFAULT_MAX_RETRIES)
+    base_delay = retry_settings.get('base_delay', DEFAULT_BASE_DELAY)
+    max_delay = retry_settings.get('max_delay', DEFAULT_MAX_DELAY)
+
+    attempt = 0
+    while True:
+        throttle(rate_limiter, method_name, environment)
+        try:
+            return call()
+        except Exception as ex:
+            if attempt >= max_retries or not is_retryable(ex, method_name):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            logger.warning(f'P2 call {method_name} failed ({ex}); retrying in {delay:.2f}s')
+            metrics.increment('p2_calls_retried_total', method=method_name, environment=environment)
+            sleep(delay)
+            attempt += 1
@@ -0,0 +1,93 @@
+"""
+A per-request breakdown of where the time of a tom_eso request goes, for the ``Server-Timing`` header.
+
+``ServerTimingMiddleware`` (see tom_eso/middleware.py) starts a ``RequestTimings`` collector for
+each request, in a context variable, and the tom_eso code records its phases in it with::
+
+    with timing.timed('p2'):
+        ...
+
+The phases are the ESOProfile query (``eso_profile``), the decryption of the P2 password
+(``decrypt``), ESO logins (``eso_login``), requests to the P2 API (``p2``), the rendering of
+the HTMX fragments (``render``) and the target visibility computations (``visibility``). A phase
+can be timed several times in a request (and from several threads at once, for concurrent P2
+calls): its durations are added up, and counted. Outside of a request (or without the middleware),
+``timed()`` records nothing.
+
+The threads of ``map_concurrently()`` and ``run_blocking()`` (tom_eso/concurrency.py) run in a
+copy of the caller's context, so they record into the caller's collector.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# the descriptions of the phases, for the Server-Timing header
+PHASE_DESCRIPTIONS = {
+    'eso_profile': 'ESOProfile query',
+    'decrypt': 'P2 password decryption',
+    'eso_login': 'ESO login',
+    'p2': 'ESO P2 API',
+    'render': 'Form field rendering',
+    'visibility': 'Target visibility',
+}
+
+_current_timings = contextvars.ContextVar('tom_eso_request_timings', default=None)
+
+
+class RequestTimings:
+    """The total duration, and number, of each of the timed phases of a request."""
+
+    def __init__(self):
+        self.phases = {}  # name -> [total duration in seconds, count]
+        self._lock = threading.Lock()
+
+    def record(self, name, duration):
+        with self._lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += duration
+            phase[1] += 1
+
+    def server_timing(self, total=None):
+        """Return the value of the ``Server-Timing`` header (durations in milliseconds)."""
+        with self._lock:
+            phases = sorted(self.phases.items())
+        metrics = []
+        for name, (duration, count) in phases:
+            description = PHASE_DESCRIPTIONS.get(name, name)
+            if count > 1:
+                description += f' ({count})'
+            metrics.append(f'{name};dur={duration * 1000:.1f};desc="{description}"')
+        if total is not None:
+            metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+def start():
+    """Start collecting the timings of the current request. Return the collector and a token for ``stop()``."""
+    timings = RequestTimings()
+    return timings, _current_timings.set(timings)
+
+
+def stop(token):
+    """Stop collecting the timings of the current request."""
+    _current_timings.reset(token)
+
+
+def get_timings():
+    """Return the ``RequestTimings`` of the current request, or None if its timings aren't being collected."""
+    return _current_timings.get()
+
+
+@contextmanager
+def timed(name):
+    """Record the duration of the ``with`` block (even if it raises) as the phase ``name`` of the current request."""
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.record(name, time.perf_counter() - start_time)
@@ -3,8 +3,16 @@ from django.urls import path
 from tom_eso.views import (
     folders_for_observing_run,
     observation_blocks_for_folder,
+    search_observation_blocks,
     show_observation_block,
-    ProfileUpdateView
+    observing_run_tree,
+    p2_name_typeahead,
+    metrics_endpoint,
+    folders_for_observing_run_async,
+    observation_blocks_for_folder_async,
+    show_observation_block_async,
+    ProfileUpdateView,
+    TargetListObservationBlocksView,
 )
 
 app_name = 'tom_eso'
@@ -14,7 +22,20 @@ app_name = 'tom_eso'
 urlpatterns = [
     path('observing-run-folders/', folders_for_observing_run, name='observing-run-folders'),
     path('folder-observation-blocks/', observation_blocks_for_folder, name='folder-observation-blocks'),
+    path('search-observation-blocks/', search_observation_blocks, name='search-observation-blocks'),
     path('show-observation-block/', show_observation_block, name='show-observation-block'),
+    path('observing-run-tree/', observing_run_tree, name='observing-run-tree'),
+    path('p2-name-typeahead/', p2_name_typeahead, name='p2-name-typeahead'),
+    path('metrics/', metrics_endpoint, name='metrics'),
+
+    # async versions of the HTMX endpoints (for ASGI deployments; see views.py)
+    path('async/observing-run-folders/', folders_for_observing_run_async, name='observing-run-folders-async'),
+    path('async/folder-observation-blocks/', observation_blocks_for_folder_async,
+         name='folder-observation-blocks-async'),
+    path('async/show-observation-block/', show_observation_block_async, name='show-observation-block-async'),
+
+    path('targetlists/<int:pk>/observation-blocks/', TargetListObservationBlocksView.as_view(),
+         name='targetlist-observation-blocks'),
 
     path('users/<int:pk>/update/', ProfileUpdateView.as_view(), name='eso-profile-update'),
 ]
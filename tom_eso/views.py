@@ -1,19 +1,40 @@
+import hmac
 import logging
 
+from asgiref.sync import sync_to_async
+
 # from django.shortcuts import render
-from django.http import HttpResponse
-from django.views.generic.edit import UpdateView
-from django.urls import reverse_lazy
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.html import format_html, format_html_join
+from django.utils.http import urlencode
+from django.views.generic.edit import FormView, UpdateView
+from django.urls import reverse, reverse_lazy
 
 from crispy_forms.templatetags.crispy_forms_filters import as_crispy_field
 
-from tom_eso.eso import ESOObservationForm, ESOFacility
+from tom_eso import metrics, timing
+from tom_eso.concurrency import run_blocking
+from tom_eso.conf import get_eso_setting
+from tom_eso.eso import DEFAULT_NAME_SEARCH_LIMIT, ESOObservationForm
 from tom_eso.models import ESOProfile
-from tom_eso.forms import ESOProfileForm
+from tom_eso.forms import ESOBulkObservationBlockForm, ESOProfileForm
+from tom_eso.request_facility import aget_request_facility, get_request_facility
+from tom_targets.models import TargetList
+from tom_targets.permissions import targets_for_user
 
 
 logger = logging.getLogger(__name__)
 
+MAX_NAME_SEARCH_LIMIT = 100  # the most results p2_name_typeahead() returns
+
+
+def _render_field(bound_field):
+    """Render a form field as a Bootstrap-styled HTML fragment (timed, for the Server-Timing header)."""
+    with timing.timed('render'):
+        return as_crispy_field(bound_field)
+
 
 def folders_for_observing_run(request):
     """
@@ -49,10 +70,9 @@ def folders_for_observing_run(request):
     if 'p2_observing_run' not in request.GET:
         logger.error(f'Missing p2_observing_run parameter in request: {request.GET}')
         # Return empty choices with facility context
-        facility = ESOFacility()
-        facility.set_user(request.user)
+        facility = get_request_facility(request)
         form = ESOObservationForm(facility=facility)
-        field_html = as_crispy_field(form['p2_folder_name'])
+        field_html = _render_field(form['p2_folder_name'])
         return HttpResponse(field_html)
 
     try:
@@ -60,22 +80,19 @@ def folders_for_observing_run(request):
         observing_run_id = int(request.GET['p2_observing_run'])
         # Skip processing if it's the default "Please select" value
         if observing_run_id == 0:
-            facility = ESOFacility()
-            facility.set_user(request.user)
+            facility = get_request_facility(request)
             form = ESOObservationForm(facility=facility)
-            field_html = as_crispy_field(form['p2_folder_name'])
+            field_html = _render_field(form['p2_folder_name'])
             return HttpResponse(field_html)
     except (ValueError, TypeError):
         logger.error(f'Invalid p2_observing_run value: {request.GET.get("p2_observing_run")}')
-        facility = ESOFacility()
-        facility.set_user(request.user)
+        facility = get_request_facility(request)
         form = ESOObservationForm(facility=facility)
-        field_html = as_crispy_field(form['p2_folder_name'])
+        field_html = _render_field(form['p2_folder_name'])
         return HttpResponse(field_html)
 
     # Use facility to get folder choices (eliminates credential duplication)
-    facility = ESOFacility()
-    facility.set_user(request.user)
+    facility = get_request_facility(request)
     folder_name_choices = facility.get_folder_name_choices(observing_run_id)
 
     # Create form with facility context and update choices
@@ -83,7 +100,7 @@ def folders_for_observing_run(request):
     form.fields['p2_folder_name'].choices = folder_name_choices
 
     # Render field as HTML fragment for HTMX swap
-    field_html = as_crispy_field(form['p2_folder_name'])
+    field_html = _render_field(form['p2_folder_name'])
     return HttpResponse(field_html)
 
 
@@ -107,10 +124,9 @@ def observation_blocks_for_folder(request):
     # Validate required GET parameter
     if 'p2_folder_name' not in request.GET:
         logger.error(f'Missing p2_folder_name parameter in request: {request.GET}')
-        facility = ESOFacility()
-        facility.set_user(request.user)
+        facility = get_request_facility(request)
         form = ESOObservationForm(facility=facility)
-        field_html = as_crispy_field(form['observation_blocks'])
+        field_html = _render_field(form['observation_blocks'])
         return HttpResponse(field_html)
 
     try:
@@ -120,24 +136,80 @@ def observation_blocks_for_folder(request):
         logger.error(f'folder_id is not an integer: {request.GET["p2_folder_name"]}')
         for key, value in request.GET.items():
             logger.error(f'{key}: {value}')
-        facility = ESOFacility()
-        facility.set_user(request.user)
+        facility = get_request_facility(request)
         form = ESOObservationForm(facility=facility)
-        field_html = as_crispy_field(form['observation_blocks'])
+        field_html = _render_field(form['observation_blocks'])
         return HttpResponse(field_html)
 
-    # Use facility to get observation block choices
-    facility = ESOFacility()
-    facility.set_user(request.user)
-    observation_block_choices = facility.get_observation_block_choices(folder_id)
+    # Use facility to get the first page of the observation block choices (large folders are
+    # searched and paged through with search_observation_blocks(), below)
+    facility = get_request_facility(request)
+    page = facility.search_observation_blocks(folder_id)
 
     # Create form with facility context and update choices
     form = ESOObservationForm(facility=facility)
-    form.fields['observation_blocks'].choices = observation_block_choices
+    form.fields['observation_blocks'].choices = page.notices + page.choices
 
-    # Render field as HTML fragment for HTMX swap
-    field_html = as_crispy_field(form['observation_blocks'])
-    return HttpResponse(field_html)
+    # Render field as HTML fragment for HTMX swap (with the control loading the next page)
+    field_html = _render_field(form['observation_blocks'])
+    return HttpResponse(field_html + _load_more_observation_blocks(page, {'p2_folder_name': folder_id}))
+
+
+def _load_more_observation_blocks(page, params):
+    """Return the out-of-band swap of the "load more" control below the observation_blocks dropdown.
+
+    The control lives outside of the <select> (whose <option>s can't trigger requests of their
+    own): clicking it appends the next page of the search ``params`` to the dropdown, and replaces
+    itself with the control for the page after. If there are no more observation blocks, the
+    control is emptied.
+    """
+    if page is None or not page.has_more:
+        return format_html('<div id="id_observation_blocks_more" hx-swap-oob="true"></div>')
+    shown = page.page * len(page.choices)  # the pages before the last are full
+    return format_html(
+        '<div id="id_observation_blocks_more" hx-swap-oob="true">'
+        '<button type="button" class="btn btn-link btn-sm px-0" hx-get="{}?{}" '
+        'hx-target="#id_observation_blocks" hx-swap="beforeend">{}</button></div>',
+        reverse('tom_eso:search-observation-blocks'), urlencode({**params, 'page': page.page + 1}),
+        f'Showing {shown} of {page.total}: load more')
+
+
+def search_observation_blocks(request):
+    """
+    HTMX endpoint for the observation block search box (typeahead), and for paging through the
+    observation blocks of a folder ("load more").
+
+    Returns the <option> elements, not the whole dropdown, for a page of the observation blocks of
+    the p2_folder_name folder that match the observation_block_search text (see
+    ESOFacility.search_observation_blocks). The filtering and paging happen on the server, against
+    the cached choices of the folder, so a folder with thousands of observation blocks is never
+    shipped to the browser all at once. The options are preceded by the out-of-band swap of the
+    "load more" control below the dropdown, which appends the next page of options (if there are
+    more matches).
+
+    :param request: HTTP request with p2_folder_name, and optional observation_block_search and page, parameters
+    :return: HTTPResponse containing the "load more" control and the <option> elements
+    """
+    folder_id = _get_int_parameter(request, 'p2_folder_name')
+    if not folder_id:
+        return HttpResponse(_load_more_observation_blocks(None, {}) +
+                            format_html('<option value="0">{}</option>', 'Please select a Folder'))
+    try:
+        page_number = int(request.GET.get('page', 1))
+    except ValueError:
+        page_number = 1
+
+    facility = get_request_facility(request)
+    query = request.GET.get('observation_block_search', '')
+    page = facility.search_observation_blocks(folder_id, query, page_number)
+
+    with timing.timed('render'):
+        # the control comes first: htmx would drop it from a response starting with an <option>
+        html = _load_more_observation_blocks(page, {'p2_folder_name': folder_id, 'observation_block_search': query})
+        html += format_html_join('', '<option value="{}">{}</option>', page.notices + page.choices)
+        if page.total == 0 and not page.notices:
+            html += format_html('<option value="">{}</option>', 'No matching observation blocks')
+    return HttpResponse(html)
 
 
 def show_observation_block(request):
@@ -182,9 +254,8 @@ def show_observation_block(request):
         return HttpResponse(html)
 
     # get the ESO P2 tool URL for this observation block
-    # Create facility instance with user context
-    facility = ESOFacility()
-    facility.set_user(request.user)
+    # the facility of this request, set up with the user's ESO credentials
+    facility = get_request_facility(request)
     iframe_url = facility.get_p2_tool_url(observation_block_id=observation_block_id)
 
     # return just the iframe element with the new URL
@@ -192,6 +263,212 @@ def show_observation_block(request):
     return HttpResponse(html)
 
 
+def observing_run_tree(request):
+    """
+    Endpoint that returns, as JSON, every folder of an observing run with the observation blocks
+    in each folder.
+
+    Where folders_for_observing_run() and observation_blocks_for_folder() cost one round trip
+    per level of the run -> folder -> observation block cascade, this endpoint fetches the whole
+    tree under the run at once (fetching the folders concurrently; see ESOAPI.observing_run_tree),
+    so that a client can switch between folders without waiting on the server. As a side effect,
+    the per-folder choices are cached, so observation_blocks_for_folder() is fast afterwards too.
+
+    :param request: HTTP request with p2_observing_run parameter
+    :return: JsonResponse with the tree, or with an ``error`` message and status 400
+    """
+    try:
+        observing_run_id = int(request.GET['p2_observing_run'])
+    except (KeyError, ValueError, TypeError):
+        logger.error(f'Missing or invalid p2_observing_run parameter in request: {request.GET}')
+        return JsonResponse({'error': 'A valid p2_observing_run parameter is required'}, status=400)
+
+    facility = get_request_facility(request)
+    tree = facility.get_observing_run_tree(observing_run_id)
+    return JsonResponse(tree, status=400 if 'error' in tree else 200)
+
+
+def p2_name_typeahead(request):
+    """
+    Typeahead endpoint that returns, as JSON, the containers and observation blocks of the user's
+    P2 account (in any observing run) whose names best match the q parameter.
+
+    Rather than drilling down through the run -> folder -> observation block dropdowns, a client
+    can look an observation block up by name as the user types. The names come from an in-memory
+    index of the local P2 mirror and the P2 responses received since (see tom_eso/name_index.py),
+    so ESO is not contacted.
+
+    :param request: HTTP request with q, and optional limit, parameters
+    :return: JsonResponse with the ``results``, best first
+    """
+    query = request.GET.get('q', '')
+    try:
+        limit = min(max(int(request.GET.get('limit', DEFAULT_NAME_SEARCH_LIMIT)), 1), MAX_NAME_SEARCH_LIMIT)
+    except ValueError:
+        limit = DEFAULT_NAME_SEARCH_LIMIT
+
+    facility = get_request_facility(request)
+    return JsonResponse({'results': facility.search_p2_names(query, limit)})
+
+
+def metrics_endpoint(request):
+    """
+    Endpoint that returns the tom_eso metrics (P2 latencies, errors, cache hits, logins, ...) of all
+    the workers in the Prometheus text exposition format, for a Prometheus server to scrape.
+
+    The metrics of the workers are added up through the Django cache (see tom_eso/metrics.py), so
+    it doesn't matter which worker serves the scrape. The endpoint is only open to staff users and
+    to scrapes that send settings.FACILITIES['ESO']['metrics']['token'] (if it is set) as a bearer
+    token (``Authorization: Bearer <token>``).
+
+    :param request: HTTP request
+    :return: HttpResponse with the metrics as text/plain, or status 401 without the token
+    """
+    if not (_has_metrics_token(request) or (request.user.is_authenticated and request.user.is_staff)):
+        # (not 403, which tom_common's Raise403Middleware turns into a redirect to the login page)
+        response = HttpResponse('Unauthorized', status=401, content_type='text/plain')
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _has_metrics_token(request):
+    """Return True if the request sends the metrics token as its bearer token (and there is one)."""
+    token = get_eso_setting('metrics', {}).get('token')
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                               f'Bearer {token}'.encode('utf-8'))
+
+
+# Async versions of the HTMX endpoints above, for deployment under ASGI.
+#
+# The synchronous endpoints hold a worker for the whole ESO login and P2 call, which is often
+# seconds, so a few users changing dropdowns can exhaust a WSGI worker pool. These views do the
+# ORM and credential work through sync_to_async, and run the blocking p2api calls in a bounded
+# executor (see tom_eso/concurrency.py), so the event loop keeps serving other requests meanwhile.
+# Set settings.FACILITIES['ESO']['async_views'] = True to point the form's dropdowns at them.
+
+def _get_int_parameter(request, name):
+    """Return the integer value of the GET parameter ``name``, or None if it is missing or invalid."""
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError, TypeError):
+        logger.error(f'Missing or invalid {name} parameter in request: {request.GET}')
+        return None
+
+
+def _render_form_field(facility, field_name, choices=None):
+    """Render one field of an ESOObservationForm as an HTML fragment, with the given choices if any."""
+    form = ESOObservationForm(facility=facility)
+    if choices is not None:
+        form.fields[field_name].choices = choices
+    return _render_field(form[field_name])
+
+
+async def folders_for_observing_run_async(request):
+    """Async version of folders_for_observing_run().
+
+    :param request: HTTP request with p2_observing_run parameter
+    :return: HTTPResponse containing HTML for updated folder dropdown
+    """
+    facility = await aget_request_facility(request)
+
+    folder_name_choices = None
+    observing_run_id = _get_int_parameter(request, 'p2_observing_run')
+    if observing_run_id:  # skip the default "Please select" value (0)
+        await facility.aprefetch_mirror_choices('folders', observing_run_id)
+        folder_name_choices = await run_blocking(facility.get_folder_name_choices, observing_run_id)
+
+    field_html = await sync_to_async(_render_form_field)(facility, 'p2_folder_name', folder_name_choices)
+    return HttpResponse(field_html)
+
+
+async def observation_blocks_for_folder_async(request):
+    """Async version of observation_blocks_for_folder().
+
+    :param request: HTTP request with p2_folder_name parameter
+    :return: HTTPResponse containing HTML for updated observation blocks dropdown
+    """
+    facility = await aget_request_facility(request)
+
+    observation_block_choices = page = None
+    folder_id = _get_int_parameter(request, 'p2_folder_name')
+    if folder_id is not None:
+        await facility.aprefetch_mirror_choices('observation_blocks', folder_id)
+        page = await run_blocking(facility.search_observation_blocks, folder_id)
+        observation_block_choices = page.notices + page.choices
+
+    field_html = await sync_to_async(_render_form_field)(facility, 'observation_blocks', observation_block_choices)
+    return HttpResponse(field_html + _load_more_observation_blocks(page, {'p2_folder_name': folder_id}))
+
+
+async def show_observation_block_async(request):
+    """Async version of show_observation_block().
+
+    :param request: HTTP request with observation_blocks parameter
+    :return: HTTPResponse containing iframe HTML element
+    """
+    iframe_url = 'about:blank'
+    observation_block_id = _get_int_parameter(request, 'observation_blocks')
+    if observation_block_id is not None:
+        facility = await aget_request_facility(request)
+        iframe_url = await sync_to_async(facility.get_p2_tool_url)(observation_block_id=observation_block_id)
+
+    html = f'<iframe id="id_eso_p2_tool_iframe" height="100%" width="100%" src="{iframe_url}"></iframe>'
+    return HttpResponse(html)
+
+
+class TargetListObservationBlocksView(LoginRequiredMixin, FormView):
+    """
+    View for creating an ESO observation block for each target of a TargetList in one go.
+
+    The user picks an observing run and folder (with the same HTMX dropdowns as the ESO
+    observation form) and the targets of the list to include. The observation blocks are
+    then created concurrently by ``ESOFacility.submit_observation_blocks_for_targets()``,
+    and the result for each target is shown on the page.
+    """
+    template_name = 'tom_eso/targetlist_observation_blocks.html'
+    form_class = ESOBulkObservationBlockForm
+
+    def dispatch(self, request, *args, **kwargs):
+        self.target_list = get_object_or_404(TargetList, pk=kwargs['pk'])
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_facility(self):
+        return get_request_facility(self.request)
+
+    def get_targets(self):
+        return targets_for_user(self.request.user, self.target_list.targets.all(), 'view_target')
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['facility'] = self.get_facility()
+        kwargs['targets'] = self.get_targets()
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        facility = self.get_facility()
+        # rank the targets by how observable they are in the ESO period (by default, the current one)
+        period = _get_int_parameter(self.request, 'period') if 'period' in self.request.GET else None
+        context.update({
+            'target_list': self.target_list,
+            'credential_status': facility.credential_status,
+            'iframe_url': facility.get_p2_tool_url(),
+            'visibility': facility.get_target_visibility(self.get_targets(), period=period),
+        })
+        return context
+
+    def form_valid(self, form):
+        bulk_result = self.get_facility().submit_observation_blocks_for_targets(
+            folder_id=form.cleaned_data['p2_folder_name'],
+            targets=form.cleaned_data['targets'],
+            ob_name_template=form.cleaned_data['ob_name_template'],
+        )
+        return self.render_to_response(self.get_context_data(form=form, bulk_result=bulk_result))
+
+
 class ProfileUpdateView(UpdateView):
     """
     View that handles updating of a user's ``ESOProfile``.
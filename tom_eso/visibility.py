@@ -0,0 +1,322 @@
+"""
+Visibility of targets from the ESO observing sites over an ESO observing period.
+
+For the targets of a TargetList, ``target_visibility()`` works out, for every night of an ESO
+period (see ``eso_period_dates()``) at a site (see ``ESOFacility.get_observing_sites``), how long
+each target is observable (during astronomical night, below the maximum airmass, and far enough
+from the Moon if it is up), its best airmass, and its closest approach to the Moon.
+
+Everything is computed with NumPy on (targets x times) arrays, over a time grid covering the whole
+period, rather than target by target: the positions of the Sun and Moon (with the low-precision
+formulas of the Astronomical Almanac, good to about 0.01 degrees for the Sun and a few tenths of
+a degree for the Moon, which is plenty for planning) and the sidereal time are computed once per
+time step, and the altitudes, airmasses and Moon distances of all the targets in one go (in
+chunks of ``TARGET_CHUNK_SIZE`` targets, to bound the memory used).
+
+The results are cached per target, site, period and constraints in a Django cache backend (see
+``VisibilityStore``), as a compact array of a few hundred bytes per target, so a TargetList only
+pays for the targets that weren't computed before.
+
+The constraints and the cache are configured with the optional ``visibility`` dictionary in
+``settings.FACILITIES['ESO']``:
+
+    'ESO': {
+        ...
+        'visibility': {
+            'max_airmass': 2.0,
+            'min_moon_distance': 30,  # degrees (while the Moon is up)
+            'sun_altitude': -18,  # degrees: the Sun is below this at night
+            'time_step': 30,  # minutes
+            'alias': 'default',  # the settings.CACHES entry to use
+            'timeout': 2592000,  # seconds
+        },
+    }
+"""
+import hashlib
+import logging
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from django.core.cache import caches
+
+from tom_eso.conf import get_eso_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AIRMASS = 2.0
+DEFAULT_MIN_MOON_DISTANCE = 30.0  # degrees
+DEFAULT_SUN_ALTITUDE = -18.0  # degrees: astronomical night
+DEFAULT_TIME_STEP = 30  # minutes
+DEFAULT_CACHE_ALIAS = 'default'
+DEFAULT_TIMEOUT = 30 * 24 * 60 * 60  # seconds
+KEY_PREFIX = 'tom_eso:visibility'
+
+TARGET_CHUNK_SIZE = 256  # targets per (targets x times) array
+J2000 = 2451545.0  # Julian date of J2000.0
+UNIX_EPOCH = 2440587.5  # Julian date of 1970-01-01T00:00:00 UTC
+
+# The visibility of some targets from a site over the nights of a period. For each target,
+# ``nightly_steps`` are the numbers of observable time steps in each night (n_targets x n_nights),
+# ``nightly_best_airmass`` are the best airmasses while observable (NaN if not observable), and
+# ``min_moon_distance`` is the closest (in degrees) the target gets to the Moon at night while
+# below the maximum airmass (NaN if it never is).
+Visibility = namedtuple('Visibility', ['nightly_steps', 'nightly_best_airmass', 'min_moon_distance'])
+
+
+def eso_period(date):
+    """Return the ESO observing period that ``date`` is in.
+
+    Odd periods run from 1 April to 30 September, and even ones from 1 October to 31 March
+    (P113 started on 1 April 2024).
+    """
+    if date.month < 4:
+        return 2 * (date.year - 1968)
+    if date.month < 10:
+        return 2 * (date.year - 1968) + 1
+    return 2 * (date.year - 1967)
+
+
+def eso_period_dates(period):
+    """Return the (start, end) UTC datetimes of ESO period ``period``; the end is exclusive."""
+    if period % 2:
+        year = 1968 + (period - 1) // 2
+        return (datetime(year, 4, 1, tzinfo=timezone.utc), datetime(year, 10, 1, tzinfo=timezone.utc))
+    year = 1967 + period // 2
+    return (datetime(year, 10, 1, tzinfo=timezone.utc), datetime(year + 1, 4, 1, tzinfo=timezone.utc))
+
+
+def julian_dates(start, end, step_minutes):
+    """Return the Julian dates from ``start`` (inclusive) to ``end`` (exclusive), ``step_minutes`` apart."""
+    return (UNIX_EPOCH + start.timestamp() / 86400.0
+            + np.arange(0.0, (end - start).total_seconds() / 60.0, step_minutes) / 1440.0)
+
+
+def julian_date_to_date(jd):
+    """Return the UTC date of Julian date ``jd``."""
+    return (datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(days=float(jd) - UNIX_EPOCH)).date()
+
+
+def gmst(jd):
+    """Return the Greenwich mean sidereal time(s) of the Julian date(s) ``jd``, in radians."""
+    return np.radians((280.46061837 + 360.98564736629 * (jd - J2000)) % 360.0)
+
+
+def _ecliptic_to_equatorial(longitude, latitude, obliquity):
+    """Return the (RA, Dec) in radians of ecliptic coordinates in radians."""
+    x = np.cos(latitude) * np.cos(longitude)
+    y = np.cos(obliquity) * np.cos(latitude) * np.sin(longitude) - np.sin(obliquity) * np.sin(latitude)
+    z = np.sin(obliquity) * np.cos(latitude) * np.sin(longitude) + np.cos(obliquity) * np.sin(latitude)
+    return np.arctan2(y, x) % (2 * np.pi), np.arcsin(z)
+
+
+def sun_position(jd):
+    """Return the geocentric (RA, Dec) of the Sun at Julian date(s) ``jd``, in radians."""
+    n = jd - J2000
+    mean_longitude = 280.460 + 0.9856474 * n
+    mean_anomaly = np.radians(357.528 + 0.9856003 * n)
+    longitude = np.radians(mean_longitude + 1.915 * np.sin(mean_anomaly) + 0.020 * np.sin(2 * mean_anomaly))
+    obliquity = np.radians(23.439 - 0.0000004 * n)
+    return _ecliptic_to_equatorial(longitude, 0.0, obliquity)
+
+
+def moon_position(jd):
+    """Return the geocentric (RA, Dec) of the Moon at Julian date(s) ``jd``, in radians."""
+    t = (jd - J2000) / 36525.0
+    longitude = np.radians(218.32 + 481267.881 * t
+                           + 6.29 * np.sin(np.radians(135.0 + 477198.87 * t))
+                           - 1.27 * np.sin(np.radians(259.3 - 413335.36 * t))
+                           + 0.66 * np.sin(np.radians(235.7 + 890534.22 * t))
+                           + 0.21 * np.sin(np.radians(269.9 + 954397.74 * t))
+                           - 0.19 * np.sin(np.radians(357.5 + 35999.05 * t))
+                           - 0.11 * np.sin(np.radians(186.5 + 966404.03 * t)))
+    latitude = np.radians(5.13 * np.sin(np.radians(93.3 + 483202.02 * t))
+                          + 0.28 * np.sin(np.radians(228.2 + 960400.89 * t))
+                          - 0.28 * np.sin(np.radians(318.3 + 6003.15 * t))
+                          - 0.17 * np.sin(np.radians(217.6 - 407332.21 * t)))
+    obliquity = np.radians(23.439 - 0.0000004 * (jd - J2000))
+    return _ecliptic_to_equatorial(longitude, latitude, obliquity)
+
+
+def altitude(ra, dec, latitude, local_sidereal_time):
+    """Return the altitude(s), in radians, of (RA, Dec) seen from ``latitude`` at the local sidereal time(s).
+
+    All angles are in radians; the arguments are broadcast against each other.
+    """
+    hour_angle = local_sidereal_time - ra
+    return np.arcsin(np.sin(latitude) * np.sin(dec) + np.cos(latitude) * np.cos(dec) * np.cos(hour_angle))
+
+
+def airmass(altitude):
+    """Return the airmass(es) at ``altitude`` (in radians), with the formula of Kasten & Young (1989).
+
+    The airmass below the horizon is infinite.
+    """
+    altitude_degrees = np.degrees(altitude)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = 1.0 / (np.sin(altitude) + 0.50572 * (altitude_degrees + 6.07995) ** -1.6364)
+    return np.where(altitude > 0, result, np.inf)
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """Return the angular distance(s), in radians, between (RA, Dec) pairs in radians (broadcast)."""
+    cos_distance = np.sin(dec1) * np.sin(dec2) + np.cos(dec1) * np.cos(dec2) * np.cos(ra1 - ra2)
+    return np.arccos(np.clip(cos_distance, -1.0, 1.0))
+
+
+class NightGrid:
+    """The night-time steps of an ESO period at a site, with everything about them that doesn't
+    depend on the targets (sidereal time, Moon position and altitude, night of each step).
+    """
+
+    def __init__(self, site, period, time_step=DEFAULT_TIME_STEP, sun_altitude=DEFAULT_SUN_ALTITUDE):
+        self.latitude = np.radians(site['latitude'])
+        longitude = np.radians(site['longitude'])  # east positive
+        self.time_step = time_step
+
+        # the nights of the period, from local (mean solar) noon on its first day to local noon after its last night
+        jd = julian_dates(*eso_period_dates(period), time_step) + 0.5 - site['longitude'] / 360.0
+        local_sidereal_time = gmst(jd) + longitude
+        local_days = np.floor(jd + site['longitude'] / 360.0)  # Julian day numbers change at local noon
+        self.first_night = local_days[0]
+        self.n_nights = int(local_days[-1] - local_days[0]) + 1
+
+        is_night = altitude(*sun_position(jd), self.latitude, local_sidereal_time) < np.radians(sun_altitude)
+        self.jd = jd[is_night]
+        self.local_sidereal_time = local_sidereal_time[is_night]
+        self.night = (local_days[is_night] - self.first_night).astype(np.intp)
+        self.moon_ra, self.moon_dec = moon_position(self.jd)
+        self.moon_is_up = altitude(self.moon_ra, self.moon_dec, self.latitude, self.local_sidereal_time) > 0
+
+        # the first step of each night that has any dark time, for reducing per night
+        self.night_starts = np.flatnonzero(np.diff(self.night, prepend=-1))
+        self.nights_with_steps = self.night[self.night_starts]
+
+    def night_date(self, night):
+        """Return the local date of the evening of night ``night``."""
+        return julian_date_to_date(self.first_night + night)
+
+    def visibility(self, ras, decs, max_airmass=DEFAULT_MAX_AIRMASS, min_moon_distance=DEFAULT_MIN_MOON_DISTANCE):
+        """Return the ``Visibility`` of the targets at ``ras`` and ``decs`` (arrays, in degrees)."""
+        ras = np.radians(np.asarray(ras, dtype=float))
+        decs = np.radians(np.asarray(decs, dtype=float))
+        n_targets = len(ras)
+        nightly_steps = np.zeros((n_targets, self.n_nights), dtype=np.uint16)
+        nightly_best_airmass = np.full((n_targets, self.n_nights), np.nan)
+        min_moon_distance_degrees = np.full(n_targets, np.nan)
+        if not len(self.jd):
+            return Visibility(nightly_steps, nightly_best_airmass, min_moon_distance_degrees)
+
+        for start in range(0, n_targets, TARGET_CHUNK_SIZE):
+            chunk = slice(start, start + TARGET_CHUNK_SIZE)
+            ra, dec = ras[chunk, np.newaxis], decs[chunk, np.newaxis]  # (targets x 1), against the (times) arrays
+
+            target_airmass = airmass(altitude(ra, dec, self.latitude, self.local_sidereal_time))
+            below_max_airmass = target_airmass <= max_airmass
+            moon_distance = np.degrees(angular_distance(ra, dec, self.moon_ra, self.moon_dec))
+            observable = below_max_airmass & (~self.moon_is_up | (moon_distance >= min_moon_distance))
+
+            nightly_steps[chunk, self.nights_with_steps] = np.add.reduceat(observable, self.night_starts, axis=1)
+            best_airmass = np.minimum.reduceat(np.where(observable, target_airmass, np.inf), self.night_starts, axis=1)
+            nightly_best_airmass[chunk, self.nights_with_steps] = np.where(np.isfinite(best_airmass),
+                                                                           best_airmass, np.nan)
+            closest_moon = np.min(np.where(below_max_airmass, moon_distance, np.inf), axis=1)
+            min_moon_distance_degrees[chunk] = np.where(np.isfinite(closest_moon), closest_moon, np.nan)
+
+        return Visibility(nightly_steps, nightly_best_airmass, min_moon_distance_degrees)
+
+
+class VisibilityStore:
+    """Store and fetch the visibility of single targets in a Django cache backend.
+
+    Each target's visibility is stored as one zlib-compressed array: its ``nightly_steps`` (uint16),
+    ``nightly_best_airmass`` and ``min_moon_distance`` (float16).
+    """
+
+    def __init__(self, alias=DEFAULT_CACHE_ALIAS, timeout=DEFAULT_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def make_key(grid_key, ra, dec):
+        return f'{KEY_PREFIX}:{grid_key}:{ra:.5f}:{dec:.5f}'
+
+    @staticmethod
+    def serialize(nightly_steps, nightly_best_airmass, min_moon_distance):
+        return zlib.compress(nightly_steps.astype('<u2').tobytes()
+                             + nightly_best_airmass.astype('<f2').tobytes()
+                             + np.float16(min_moon_distance).astype('<f2').tobytes())
+
+    @staticmethod
+    def deserialize(data, n_nights):
+        data = zlib.decompress(data)
+        nightly_steps = np.frombuffer(data, dtype='<u2', count=n_nights)
+        values = np.frombuffer(data, dtype='<f2', offset=2 * n_nights).astype(float)
+        return nightly_steps, values[:n_nights], values[n_nights]
+
+    def get_many(self, grid_key, ras, decs, n_nights):
+        """Return {index: (nightly_steps, nightly_best_airmass, min_moon_distance)} of the cached targets."""
+        keys = {self.make_key(grid_key, ra, dec): index for index, (ra, dec) in enumerate(zip(ras, decs))}
+        try:
+            cached = self.cache.get_many(list(keys))
+        except Exception as ex:
+            logger.warning(f'VisibilityStore.get_many: cache unavailable: {ex}')
+            return {}
+        return {keys[key]: self.deserialize(data, n_nights) for key, data in cached.items()}
+
+    def set_many(self, grid_key, ras, decs, visibility):
+        try:
+            self.cache.set_many({
+                self.make_key(grid_key, ra, dec): self.serialize(visibility.nightly_steps[index],
+                                                                 visibility.nightly_best_airmass[index],
+                                                                 visibility.min_moon_distance[index])
+                for index, (ra, dec) in enumerate(zip(ras, decs))
+            }, self.timeout)
+        except Exception as ex:
+            logger.warning(f'VisibilityStore.set_many: cache unavailable: {ex}')
+
+
+def target_visibility(ras, decs, site, period, store=None):
+    """Return the ``NightGrid`` of ``site`` in ``period`` and the ``Visibility`` of the targets at
+    ``ras`` and ``decs`` (in degrees) from it, with the constraints of the ``visibility`` setting.
+
+    The targets found in the ``VisibilityStore`` (``store``, or else one configured from the
+    settings) are not computed again; the others are computed together, and stored.
+    """
+    settings = get_eso_setting('visibility', {})
+    time_step = settings.get('time_step', DEFAULT_TIME_STEP)
+    sun_altitude = settings.get('sun_altitude', DEFAULT_SUN_ALTITUDE)
+    max_airmass = settings.get('max_airmass', DEFAULT_MAX_AIRMASS)
+    min_moon_distance = settings.get('min_moon_distance', DEFAULT_MIN_MOON_DISTANCE)
+    if store is None:
+        store = VisibilityStore(**{name: settings[name] for name in ('alias', 'timeout') if name in settings})
+
+    grid = NightGrid(site, period, time_step=time_step, sun_altitude=sun_altitude)
+    grid_key = hashlib.sha256(repr((site['latitude'], site['longitude'], period, time_step, sun_altitude,
+                                    max_airmass, min_moon_distance)).encode('utf-8')).hexdigest()[:32]
+    ras = np.asarray(ras, dtype=float)
+    decs = np.asarray(decs, dtype=float)
+
+    nightly_steps = np.zeros((len(ras), grid.n_nights), dtype=np.uint16)
+    nightly_best_airmass = np.full((len(ras), grid.n_nights), np.nan)
+    min_moon_distance_degrees = np.full(len(ras), np.nan)
+    cached = store.get_many(grid_key, ras, decs, grid.n_nights)
+    for index, (steps, best_airmass, moon_distance) in cached.items():
+        nightly_steps[index], nightly_best_airmass[index], min_moon_distance_degrees[index] = (
+            steps, best_airmass, moon_distance)
+
+    missing = np.array([index for index in range(len(ras)) if index not in cached], dtype=np.intp)
+    if len(missing):
+        computed = grid.visibility(ras[missing], decs[missing], max_airmass=max_airmass,
+                                   min_moon_distance=min_moon_distance)
+        nightly_steps[missing] = computed.nightly_steps
+        nightly_best_airmass[missing] = computed.nightly_best_airmass
+        min_moon_distance_degrees[missing] = computed.min_moon_distance
+        store.set_many(grid_key, ras[missing], decs[missing], computed)
+
+    return grid, Visibility(nightly_steps, nightly_best_airmass, min_moon_distance_degrees)